@@ -0,0 +1,26 @@
+"""prefilter decision
+
+Revision ID: 2e9b7d4c6f18
+Revises: 8c4d2e6f1a3b
+Create Date: 2026-10-18 10:48:03.512377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e9b7d4c6f18'
+down_revision = '8c4d2e6f1a3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jokes', sa.Column('prefilter_decision', sa.String(length=20), nullable=True))
+    op.add_column('jokes', sa.Column('prefilter_reason', sa.String(length=100), nullable=True))
+
+
+def downgrade():
+    op.drop_column('jokes', 'prefilter_reason')
+    op.drop_column('jokes', 'prefilter_decision')
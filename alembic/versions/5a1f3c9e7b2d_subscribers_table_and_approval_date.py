@@ -0,0 +1,32 @@
+"""subscribers table and approval date
+
+Revision ID: 5a1f3c9e7b2d
+Revises: bc12e3b6a579
+Create Date: 2026-10-18 09:12:41.306528
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1f3c9e7b2d'
+down_revision = 'bc12e3b6a579'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('subscribers',
+    sa.Column('chat_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('subscribed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('chat_id')
+    )
+    op.add_column('jokes', sa.Column('approved_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_jokes_approved_at', 'jokes', ['approved_at'])
+
+
+def downgrade():
+    op.drop_index('ix_jokes_approved_at', table_name='jokes')
+    op.drop_column('jokes', 'approved_at')
+    op.drop_table('subscribers')
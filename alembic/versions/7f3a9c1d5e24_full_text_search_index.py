@@ -0,0 +1,58 @@
+"""full-text search index
+
+Revision ID: 7f3a9c1d5e24
+Revises: 2e9b7d4c6f18
+Create Date: 2026-10-18 11:35:52.204918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3a9c1d5e24'
+down_revision = '2e9b7d4c6f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        # FTS5 external content table, `jokes` stays the only copy of joke bodies
+        op.execute("CREATE VIRTUAL TABLE jokes_fts USING fts5(body, content='jokes', content_rowid='id')")
+        op.execute("INSERT INTO jokes_fts(jokes_fts) VALUES ('rebuild')")
+        op.execute("""
+            CREATE TRIGGER jokes_fts_insert AFTER INSERT ON jokes BEGIN
+                INSERT INTO jokes_fts(rowid, body) VALUES (new.id, new.body);
+            END""")
+        op.execute("""
+            CREATE TRIGGER jokes_fts_delete AFTER DELETE ON jokes BEGIN
+                INSERT INTO jokes_fts(jokes_fts, rowid, body) VALUES ('delete', old.id, old.body);
+            END""")
+        op.execute("""
+            CREATE TRIGGER jokes_fts_update AFTER UPDATE OF body ON jokes BEGIN
+                INSERT INTO jokes_fts(jokes_fts, rowid, body) VALUES ('delete', old.id, old.body);
+                INSERT INTO jokes_fts(rowid, body) VALUES (new.id, new.body);
+            END""")
+        return
+
+    op.add_column('jokes', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    op.execute("UPDATE jokes SET search_vector = to_tsvector('pg_catalog.english', coalesce(body, ''))")
+    op.create_index('ix_jokes_search_vector', 'jokes', ['search_vector'], postgresql_using='gin')
+    op.execute("""
+        CREATE TRIGGER jokes_search_vector_update BEFORE INSERT OR UPDATE OF body ON jokes
+        FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.english', body)""")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TRIGGER jokes_fts_update')
+        op.execute('DROP TRIGGER jokes_fts_delete')
+        op.execute('DROP TRIGGER jokes_fts_insert')
+        op.execute('DROP TABLE jokes_fts')
+        return
+
+    op.execute('DROP TRIGGER jokes_search_vector_update ON jokes')
+    op.drop_index('ix_jokes_search_vector', table_name='jokes')
+    op.drop_column('jokes', 'search_vector')
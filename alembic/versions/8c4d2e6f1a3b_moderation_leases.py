@@ -0,0 +1,26 @@
+"""moderation leases
+
+Revision ID: 8c4d2e6f1a3b
+Revises: 5a1f3c9e7b2d
+Create Date: 2026-10-18 10:02:17.845120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4d2e6f1a3b'
+down_revision = '5a1f3c9e7b2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jokes', sa.Column('leased_by', sa.Integer(), nullable=True))
+    op.add_column('jokes', sa.Column('lease_expires', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('jokes', 'lease_expires')
+    op.drop_column('jokes', 'leased_by')
@@ -0,0 +1,26 @@
+"""user jokes index
+
+Revision ID: a3e8d5c7f2b1
+Revises: f1c7b3e9d2a4
+Create Date: 2026-10-18 19:42:07.316254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e8d5c7f2b1'
+down_revision = 'f1c7b3e9d2a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /my_jokes pages and trust of authors filter by user and sort by score, the score index alone can't serve them
+    # In the order /my_jokes shows them, best first and ties by id
+    op.create_index('ix_jokes_user_id_wilson_score_id', 'jokes', ['user_id', sa.text('wilson_score DESC'), 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_jokes_user_id_wilson_score_id', table_name='jokes')
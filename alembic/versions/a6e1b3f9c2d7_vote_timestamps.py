@@ -0,0 +1,31 @@
+"""vote timestamps
+
+Revision ID: a6e1b3f9c2d7
+Revises: 7f3a9c1d5e24
+Create Date: 2026-10-18 13:04:26.981342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e1b3f9c2d7'
+down_revision = '7f3a9c1d5e24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing votes keep NULL, their time is unknown. Only new votes get a timestamp.
+    with op.batch_alter_table('association') as batch_op:
+        batch_op.add_column(sa.Column('voted_at', sa.DateTime(), nullable=True))
+    with op.batch_alter_table('association') as batch_op:
+        batch_op.alter_column('voted_at', server_default=sa.func.now())
+    op.create_index('ix_association_voted_at', 'association', ['voted_at'])
+
+
+def downgrade():
+    op.drop_index('ix_association_voted_at', table_name='association')
+    with op.batch_alter_table('association') as batch_op:
+        batch_op.drop_column('voted_at')
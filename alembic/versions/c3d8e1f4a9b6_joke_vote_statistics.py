@@ -0,0 +1,73 @@
+"""joke vote statistics
+
+Revision ID: c3d8e1f4a9b6
+Revises: a6e1b3f9c2d7
+Create Date: 2026-10-18 14:22:09.537164
+
+"""
+import math
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d8e1f4a9b6'
+down_revision = 'a6e1b3f9c2d7'
+branch_labels = None
+depends_on = None
+
+WILSON_Z = 1.96
+
+# A positive vote is stored twice in `association` table, a negative one once
+VOTE_COUNTS = """
+SELECT jokes_id,
+       SUM(CASE WHEN votes > 1 THEN 1 ELSE 0 END) AS positive_votes,
+       SUM(CASE WHEN votes = 1 THEN 1 ELSE 0 END) AS negative_votes
+FROM (SELECT users_id, jokes_id, COUNT(*) AS votes FROM association GROUP BY users_id, jokes_id) user_votes
+GROUP BY jokes_id
+"""
+
+
+def wilson_lower_bound(positive, negative):
+    # Copy of app.models.wilson_lower_bound, migrations don't import application code
+    total = positive + negative
+    ratio = positive / total
+    z_squared = WILSON_Z ** 2
+    return (ratio + z_squared / (2 * total) -
+            WILSON_Z * math.sqrt((ratio * (1 - ratio) + z_squared / (4 * total)) / total)) / (1 + z_squared / total)
+
+
+def upgrade():
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.add_column(sa.Column('positive_votes', sa.Integer(), nullable=True, server_default='0'))
+        batch_op.add_column(sa.Column('negative_votes', sa.Integer(), nullable=True, server_default='0'))
+        batch_op.add_column(sa.Column('hah_ratio', sa.Float(), nullable=True, server_default='0'))
+        batch_op.add_column(sa.Column('wilson_score', sa.Float(), nullable=True, server_default='0'))
+
+    connection = op.get_bind()
+    statistics = []
+    for joke_id, positive_votes, negative_votes in connection.execute(sa.text(VOTE_COUNTS)):
+        statistics.append({
+            'joke_id': joke_id,
+            'positive_votes': positive_votes,
+            'negative_votes': negative_votes,
+            'hah_ratio': positive_votes / (positive_votes + negative_votes),
+            'wilson_score': wilson_lower_bound(positive_votes, negative_votes),
+        })
+    if statistics:
+        connection.execute(sa.text("""
+            UPDATE jokes SET positive_votes = :positive_votes, negative_votes = :negative_votes,
+                             hah_ratio = :hah_ratio, wilson_score = :wilson_score
+            WHERE id = :joke_id"""), statistics)
+
+    op.create_index('ix_jokes_wilson_score', 'jokes', ['wilson_score'])
+
+
+def downgrade():
+    op.drop_index('ix_jokes_wilson_score', table_name='jokes')
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.drop_column('wilson_score')
+        batch_op.drop_column('hah_ratio')
+        batch_op.drop_column('negative_votes')
+        batch_op.drop_column('positive_votes')
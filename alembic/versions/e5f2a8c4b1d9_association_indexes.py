@@ -0,0 +1,27 @@
+"""association indexes
+
+Revision ID: e5f2a8c4b1d9
+Revises: c3d8e1f4a9b6
+Create Date: 2026-10-18 16:41:52.208716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f2a8c4b1d9'
+down_revision = 'c3d8e1f4a9b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Votes of a user (unseen jokes, favorites, scores) and votes for a joke (vote counts) were full scans
+    op.create_index('ix_association_users_id_jokes_id', 'association', ['users_id', 'jokes_id'])
+    op.create_index('ix_association_jokes_id_users_id', 'association', ['jokes_id', 'users_id'])
+
+
+def downgrade():
+    op.drop_index('ix_association_jokes_id_users_id', table_name='association')
+    op.drop_index('ix_association_users_id_jokes_id', table_name='association')
@@ -0,0 +1,43 @@
+"""cascade deletes
+
+Revision ID: f1c7b3e9d2a4
+Revises: e5f2a8c4b1d9
+Create Date: 2026-10-18 18:05:13.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c7b3e9d2a4'
+down_revision = 'e5f2a8c4b1d9'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table), the constraints were created unnamed
+FOREIGN_KEYS = [
+    ('jokes', 'user_id', 'users'),
+    ('association', 'users_id', 'users'),
+    ('association', 'jokes_id', 'jokes'),
+]
+# Name PostgreSQL gives unnamed constraints, on SQLite it's given to the reflected ones when the table is copied
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def replace_foreign_key(table, column, referred_table, ondelete):
+    name = NAMING_CONVENTION['fk'] % {'table_name': table, 'column_0_name': column}
+    with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(name, type_='foreignkey')
+        batch_op.create_foreign_key(name, referred_table, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    # Removing a joke or a user is one DELETE, its votes (and jokes of the user) are deleted by the database
+    for table, column, referred_table in FOREIGN_KEYS:
+        replace_foreign_key(table, column, referred_table, 'CASCADE')
+
+
+def downgrade():
+    for table, column, referred_table in FOREIGN_KEYS:
+        replace_foreign_key(table, column, referred_table, None)
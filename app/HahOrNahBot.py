@@ -1,16 +1,40 @@
-from telegram.ext import Updater, Filters, CommandHandler, ConversationHandler, RegexHandler, MessageHandler
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.ext import Filters, CommandHandler, ConversationHandler, RegexHandler, MessageHandler, CallbackQueryHandler, \
+    InlineQueryHandler, TypeHandler
+from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, \
+    InlineQueryResultArticle, InputTextMessageContent
 
 import logging
-from random import choice, shuffle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import time
+from io import BytesIO
+from threading import Event
+from time import perf_counter
+from random import choice
 from string import ascii_letters, digits
 
 from app.TelegramBotHelper import HahOrNahBotHelper
 from app.TelegramBotResponses import TelegramBotResponses
-from app.models import Joke, User
+from app.notifications import AuthorNotifier
+from app.digest import DailyDigest
+from app.prefilter import AutoModerator
+from app.dedup import DuplicateIndex
+from app.search import JokeSearch
+from app.inline import InlineJokeCache
+from app.recommender import Recommender
+from app.trending import TrendingJokes
+from app.group_votes import GroupVoteBuffer
+from app.ratelimit import RateLimiter
+from app.joke_cache import JokeBodyCache
+from app.metrics import BotMetrics, WebhookUpdater
+from app.query_stats import QueryAccountant
+from app.profiler import UpdateProfiler
+from app.reconcile import VoteReconciler
+from app.models import Joke, User, Subscriber
 from app.exceptions import *
 
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import func, select
+from sqlalchemy.pool import QueuePool
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +43,68 @@ JOKE_RECEIVED, CANCEL = 0, 1
 MJ_CHOOSING, MJ_NEXT, MJ_CANCEL = range(3)
 RJ_RECEIVED, RJ_CONFIRM, RJ_REMOVE = range(3)
 AJ_VOTED, AJ_NEXT = range(2)
+SEARCH_CHOOSING = 0
+
+# States used by handlers, responses file is rejected if any of them is missing
+RESPONSE_STATES = [
+    'user_not_registered', 'user_new_keyboard_button', 'user_new_prompt', 'user_register_success',
+    'username_too_short', 'username_too_long', 'username_invalid_characters',
+    'joke_no_favorite', 'joke_new_prompt', 'joke_new_keyboard_button', 'joke_new_ask',
+    'joke_too_short', 'joke_too_long', 'joke_duplicate', 'joke_submitted',
+    'menu', 'no_new_jokes', 'cancel', 'next_cancel_keyboard',
+    'my_jokes_all_jokes_shown', 'my_jokes_invalid_choice', 'my_jokes_no_jokes',
+    'remove_joke_select', 'remove_joke_received_not_integer', 'remove_joke_confirm', 'remove_joke_success',
+    'remove_joke_invalid_id', 'search_usage', 'search_no_results', 'search_all_results_shown',
+    'approval_keyboard', 'approve_jokes_approved', 'approve_jokes_removed', 'approve_jokes_lease_lost',
+    'approve_jokes_approve_button', 'approve_jokes_remove_button', 'duplicates_none', 'duplicates_found',
+    'permission_denied', 'invalid_command',
+    'notification_approved', 'notification_votes', 'notification_milestone',
+    'subscribe_success', 'subscribe_already', 'unsubscribe_success', 'unsubscribe_not_subscribed', 'digest_header',
+    'trending_header', 'trending_none',
+    'vote_hah_button', 'vote_nah_button', 'vote_recorded', 'vote_invalid', 'vote_joke_removed',
+    'group_vote_tally', 'group_vote_not_registered', 'rate_limited',
+    'profiler_usage', 'profiler_started', 'profiler_already_running', 'profiler_not_running', 'profiler_report_attached',
+    'purge_usage', 'purge_jokes_done', 'purge_user_done', 'purge_user_not_found',
+]
+# States whose first response is used to build handlers when the bot starts
+FIXED_RESPONSE_STATES = ['user_new_keyboard_button']
+# States formatted with `str.format` -> placeholders with example values, responses file is rejected on mismatch
+RESPONSE_PLACEHOLDERS = {
+    'duplicates_found': {'groups': 2, 'removed': 3},
+    'notification_approved': {'count': 2},
+    'notification_votes': {'jokes': 2, 'hahs': 10},
+    'notification_milestone': {'id': 1, 'votes': 100},
+    'group_vote_tally': {'hahs': 10, 'nahs': 2},
+    'profiler_usage': {'max_seconds': 900},
+    'profiler_started': {'seconds': 60.0, 'fraction': 0.1},
+    'purge_jokes_done': {'removed': 3},
+    'purge_user_done': {'jokes': 3},
+}
 
 class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
-    def __init__(self, token, database_url):
+    def __init__(self, token, database_url, bot=None, engine_options=None, update_log_filename=None,
+                 update_log_key=None, rate_limits=None, metrics_token=None):
+        """
+        Arguments:
+            token: string, Telegram bot token
+            database_url: string
+            bot: telegram.Bot, used instead of a bot created from `token`, e.g. a stub in benchmarks
+            engine_options: dict, keyword arguments passed to `create_engine`
+            update_log_filename: string, incoming updates are recorded anonymized to this file if given,
+                                 see `benchmarks.replay`
+            update_log_key: string, secret key of pseudonyms in the update log, keeps them stable across restarts
+            rate_limits: dict, command class -> (burst size, tokens added per second), replaces the limits
+                         configured below for the given classes, e.g. to lift them in load tests
+            metrics_token: string, secret part of the path metrics are served on in webhook mode, e.g.
+                           `/metrics/<token>`, metrics aren't served if not given
+
+        Caches are filled by `self.warm_up`, which has to be called before updates are processed.
+        """
+        init_start_time = perf_counter()
+
         # Configuration variables
         BOT_RESPONSES_FILENAME = 'bot_responses/bot_responses.json'
+        BOT_RESPONSES_RELOAD_INTERVAL = 30  # seconds
         JOKE_LENGTH_MIN = 10
         JOKE_LENGTH_MAX = 1000
         USERNAME_LENGTH_MIN = 5
@@ -31,17 +112,137 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         USERNAME_ALLOWED_CHARACTERS = set(ascii_letters + digits + '-_')
         self.MY_JOKES_PER_MESSAGE = 5
         self.MODERATORS = [452678368]
+        self.MODERATION_BATCH_SIZE = 5
+        MODERATION_LEASE_SECONDS = 10 * 60
+        NOTIFICATION_WINDOW = 15 * 60  # seconds
+        NOTIFICATION_SEND_INTERVAL = 1  # seconds
+        NOTIFICATIONS_PER_INTERVAL = 20
+        VOTE_MILESTONES = [10, 25, 50, 100, 250, 500, 1000]  # hahs of a joke reported to its author
+        NOTIFICATION_OUTBOX_SIZE = 10000  # messages waiting to be sent, the oldest are dropped beyond it
+        DIGEST_SIZE = 5
+        DIGEST_TIME = time(hour=8)  # UTC
+        DIGEST_DELIVERY_HOURS = 12
+        DIGEST_BATCH_INTERVAL = 10  # seconds
+        DIGEST_MIN_BATCH_SIZE = 10
+        BLOCKLIST_FILENAME = 'moderation/blocklist.txt'
+        PREFILTER_WORKERS = 2
+        TRUSTED_AUTHOR_JOKES = 10  # jokes approved by moderators after which new jokes are approved automatically
+        TRUSTED_AUTHOR_WILSON_SCORE = 0.5  # average of these jokes
+        DUPLICATE_BANDS = 8
+        DUPLICATE_ROWS_PER_BAND = 4
+        DUPLICATE_SHINGLE_SIZE = 5
+        DUPLICATE_THRESHOLD = 0.7
+        SEARCH_PAGE_SIZE = 5
+        INLINE_CACHE_SIZE = 5000
+        INLINE_CACHE_REFRESH_INTERVAL = 5 * 60  # seconds
+        INLINE_RESULT_CACHE_SIZE = 10000
+        INLINE_PAGE_SIZE = 20
+        self.INLINE_CACHE_TIME = 5 * 60  # seconds Telegram may cache our answer for
+        self.INLINE_TITLE_LENGTH = 50
+        RECOMMENDER_NEIGHBOURS = 20
+        RECOMMENDER_REBUILD_INTERVAL = 6 * 60 * 60  # seconds
+        self.RECOMMENDER_RECENT_LIKES = 20
+        self.RECOMMENDATION_CANDIDATES = 50
+        TRENDING_HALF_LIFE = 6 * 60 * 60  # seconds
+        TRENDING_SIZE = 50
+        TRENDING_SNAPSHOT_FILENAME = 'trending_snapshot.json'
+        TRENDING_SNAPSHOT_INTERVAL = 5 * 60  # seconds
+        self.TRENDING_SHOWN = 10
+        GROUP_VOTE_FLUSH_INTERVAL = 1  # seconds, group message is edited at most once per interval
+        GROUP_VOTE_MESSAGE_CACHE_SIZE = 1000
+        RATE_LIMITS = {  # command class -> (burst size, tokens added per second)
+            'cheap': (20, 1),
+            'expensive': (5, 0.2),
+            'write': (10, 0.5),
+        }
+        if rate_limits is not None:
+            RATE_LIMITS.update(rate_limits)
+        RATE_LIMIT_COMMAND_CLASSES = {
+            '/random_joke': 'expensive',
+            '/recommended_joke': 'expensive',
+            '/random_favorite_joke': 'expensive',
+            '/my_jokes': 'expensive',
+            '/search': 'expensive',
+            '/next': 'expensive',
+            '/profile': 'expensive',
+            '/stats': 'expensive',
+            '/duplicates': 'expensive',
+            '/add_joke': 'write',
+            '/remove_joke': 'write',
+            '/subscribe': 'write',
+            '/unsubscribe': 'write',
+            'callback_query': 'write',  # votes and moderation
+            'inline_query': 'cheap',  # served from memory
+            'text': 'write',  # jokes and usernames sent in conversations
+        }
+        RATE_LIMIT_MAX_BUCKETS = 100000
+        RATE_LIMIT_EVICT_INTERVAL = 60  # seconds
+        SLOW_QUERY_SECONDS = 0.5
+        REPEATED_QUERY_THRESHOLD = 5  # executions of the same statement within an update logged as N+1 queries
+        JOKE_CACHE_BYTES = 16 * 1024 * 1024
+        self.JOKE_CACHE_WARM_SIZE = 1000  # best scored jokes loaded at startup
+        STATS_REFRESH_INTERVAL = 60  # seconds
+        PROFILER_SAMPLE_INTERVAL = 0.005  # seconds
+        PROFILER_TOP_FUNCTIONS = 15
+        self.PROFILER_DEFAULT_SECONDS = 60
+        self.PROFILER_MAX_SECONDS = 15 * 60
+        self.PROFILER_DEFAULT_FRACTION = 0.1  # share of updates run under cProfile
+        self.MESSAGE_LENGTH_MAX = 4096  # longer reports are sent as a file
+        RECONCILE_INTERVAL = 6 * 60 * 60  # seconds
+        RECONCILE_BATCH_SIZE = 1000  # rows checked per transaction
+        RECONCILE_PAUSE = 0.05  # seconds between batches
 
         joke_limits = {'min':JOKE_LENGTH_MIN, 'max':JOKE_LENGTH_MAX}
         username_limits = {'min':USERNAME_LENGTH_MIN, 'max':USERNAME_LENGTH_MAX}
 
-        TelegramBotResponses.__init__(self, BOT_RESPONSES_FILENAME)
-        HahOrNahBotHelper.__init__(self, database_url, joke_limits, username_limits, USERNAME_ALLOWED_CHARACTERS)
+        TelegramBotResponses.__init__(self, BOT_RESPONSES_FILENAME, RESPONSE_STATES, FIXED_RESPONSE_STATES,
+                                      RESPONSE_PLACEHOLDERS)
+        duplicate_index = DuplicateIndex(DUPLICATE_BANDS, DUPLICATE_ROWS_PER_BAND, DUPLICATE_SHINGLE_SIZE, DUPLICATE_THRESHOLD)
+        HahOrNahBotHelper.__init__(self, database_url, joke_limits, username_limits, USERNAME_ALLOWED_CHARACTERS,
+                                   MODERATION_LEASE_SECONDS, duplicate_index, JokeBodyCache(JOKE_CACHE_BYTES), engine_options)
 
         self.token = token
         self.database_url = database_url
-        self.updater = Updater(token=token)
+        self.metrics_token = metrics_token
+        if bot is None:
+            self.updater = WebhookUpdater(token=token)
+        else:
+            self.updater = WebhookUpdater(bot=bot)
         self.dispatcher = self.updater.dispatcher
+        self.job_queue = self.updater.job_queue
+        self.job_queue.run_repeating(self.reload_responses, BOT_RESPONSES_RELOAD_INTERVAL)
+
+        self.notifier = AuthorNotifier(self, NOTIFICATION_WINDOW, NOTIFICATIONS_PER_INTERVAL, VOTE_MILESTONES,
+                                       NOTIFICATION_OUTBOX_SIZE)
+        self.job_queue.run_repeating(self.notifier.send_notifications, NOTIFICATION_SEND_INTERVAL)
+
+        self.digest = DailyDigest(self.Session, self, DIGEST_SIZE, DIGEST_DELIVERY_HOURS, DIGEST_BATCH_INTERVAL, DIGEST_MIN_BATCH_SIZE)
+        self.job_queue.run_daily(self.digest.compute, DIGEST_TIME)
+        self.job_queue.run_repeating(self.digest.deliver, DIGEST_BATCH_INTERVAL)
+
+        self.joke_search = JokeSearch(self.engine.dialect.name, SEARCH_PAGE_SIZE)
+        self.inline_cache = InlineJokeCache(self.Session, INLINE_CACHE_SIZE, INLINE_PAGE_SIZE, INLINE_RESULT_CACHE_SIZE)
+        self.job_queue.run_repeating(self.inline_cache.refresh, INLINE_CACHE_REFRESH_INTERVAL)
+
+        self.recommender = Recommender(database_url, RECOMMENDER_NEIGHBOURS, self.RECOMMENDER_RECENT_LIKES)
+        self.job_queue.run_repeating(self.recommender.rebuild, RECOMMENDER_REBUILD_INTERVAL, first=0)
+
+        self.trending = TrendingJokes(TRENDING_HALF_LIFE, TRENDING_SIZE, TRENDING_SNAPSHOT_FILENAME)
+        self.job_queue.run_repeating(self.trending.save_snapshot, TRENDING_SNAPSHOT_INTERVAL)
+
+        self.group_votes = GroupVoteBuffer(self.Session, self, self.vote_recorded, GROUP_VOTE_MESSAGE_CACHE_SIZE)
+        self.job_queue.run_repeating(self.group_votes.flush, GROUP_VOTE_FLUSH_INTERVAL)
+
+        self.rate_limiter = RateLimiter(self, RATE_LIMITS, RATE_LIMIT_COMMAND_CLASSES, 'cheap', RATE_LIMIT_MAX_BUCKETS)
+        self.job_queue.run_repeating(self.rate_limiter.evict_idle, RATE_LIMIT_EVICT_INTERVAL)
+
+        self.stats_counts = {'jokes': 0, 'users': 0}
+        self.job_queue.run_repeating(self.refresh_stats_counts, STATS_REFRESH_INTERVAL)
+
+        self.reconciler = VoteReconciler(self.engine, RECONCILE_BATCH_SIZE, RECONCILE_PAUSE)
+        self.job_queue.run_repeating(self.reconciler.run, RECONCILE_INTERVAL)
+        self.auto_moderator = AutoModerator(self.Session, self.notifier, BLOCKLIST_FILENAME, PREFILTER_WORKERS,
+                                            TRUSTED_AUTHOR_JOKES, TRUSTED_AUTHOR_WILSON_SCORE)
 
         menu_handler = CommandHandler('menu', self.menu, pass_user_data=True)
         start_handler = CommandHandler('start', self.menu, pass_user_data=True)
@@ -49,9 +250,13 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         stats_handler = CommandHandler('stats', self.stats)
         cancel_handler = CommandHandler('cancel', self.cancel_conversation)
         random_joke_handler = CommandHandler('random_joke', self.display_random_joke, pass_user_data=True)
+        recommended_joke_handler = CommandHandler('recommended_joke', self.display_recommended_joke, pass_user_data=True)
+        trending_handler = CommandHandler('trending', self.display_trending_jokes)
         random_favorite_joke_handler = CommandHandler('random_favorite_joke', self.display_random_favorite_joke, pass_user_data=True)
-        vote_handler = RegexHandler('^(/hah|/nah)$', self.vote_for_joke, pass_user_data=True)
+        vote_handler = CallbackQueryHandler(self.vote_for_joke, pattern='^vote:', pass_user_data=True)
         profile_handler = CommandHandler('profile', self.profile, pass_user_data=True)
+        subscribe_handler = CommandHandler('subscribe', self.subscribe)
+        unsubscribe_handler = CommandHandler('unsubscribe', self.unsubscribe)
 
         # Whenever the method `self.private_get_user` raises an exception, keyboard with two options is displayed.
         # /whatever string is stored in 'user_new_keyboard_button' in bot_responses.json and /cancel
@@ -99,6 +304,22 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
                 AJ_NEXT: [CommandHandler('next', self.approve_jokes_show, pass_user_data=True)]},
             fallbacks=[cancel_handler])
 
+        search_handler = ConversationHandler(
+            entry_points=[CommandHandler('search', self.search, pass_args=True, pass_user_data=True)],
+            states={
+                SEARCH_CHOOSING: [RegexHandler('^(/next|/cancel)$', self.search_choosing, pass_user_data=True)],
+            },
+            fallbacks=[cancel_handler])
+
+        inline_query_handler = InlineQueryHandler(self.inline_query)
+        perf_stats_handler = CommandHandler('perf_stats', self.perf_stats)
+        profiler_handler = CommandHandler('profiler', self.profiler_command, pass_args=True)
+
+        approve_batch_handler = CommandHandler('approve_batch', self.approve_jokes_batch)
+        moderation_handler = CallbackQueryHandler(self.approve_jokes_batch_voted, pattern='^moderate:')
+        duplicates_handler = CommandHandler('duplicates', self.remove_duplicates)
+        purge_handler = CommandHandler('purge', self.purge_command, pass_args=True)
+
         invalid_command_handler = RegexHandler('/.*', self.invalid_command_handler)
         handlers = [start_handler,
                     menu_handler,
@@ -108,19 +329,128 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
                     new_joke_handler,
                     remove_joke_handler,
                     approve_jokes_handler,
+                    approve_batch_handler,
+                    moderation_handler,
+                    duplicates_handler,
+                    purge_handler,
+                    perf_stats_handler,
+                    profiler_handler,
+                    inline_query_handler,
 
                     random_joke_handler,
+                    recommended_joke_handler,
+                    trending_handler,
                     random_favorite_joke_handler,
                     vote_handler,
 
                     my_jokes_handler,
+                    search_handler,
                     profile_handler,
+                    subscribe_handler,
+                    unsubscribe_handler,
                     invalid_command_handler,
                     ]
 
+        # Group -2 records every update, including those over the rate limit
+        self.recorder = None
+        if update_log_filename:
+            from app.recorder import UpdateRecorder  # only imported when recording is enabled
+            self.recorder = UpdateRecorder(update_log_filename, [new_user_keyboard_string,
+                                                                 self.get_one_response('joke_new_keyboard_button')],
+                                           update_log_key)
+            self.dispatcher.add_handler(TypeHandler(Update, self.recorder.record), group=-2)
+        # Group -1 runs before the handlers above and stops updates over the rate limit
+        self.dispatcher.add_handler(TypeHandler(Update, self.rate_limiter.check_update), group=-1)
         for handler in handlers:
             self.dispatcher.add_handler(handler)
 
+        self.metrics = BotMetrics()
+        self.metrics.instrument_dispatcher(self.dispatcher)
+        self.metrics.instrument_engine(self.engine)
+        self.metrics.instrument_request(self.updater.bot.request)
+
+        self.query_stats = QueryAccountant(SLOW_QUERY_SECONDS, REPEATED_QUERY_THRESHOLD)
+        self.query_stats.listen(self.engine)
+        self.query_stats.instrument_dispatcher(self.dispatcher)
+
+        self.profiler = UpdateProfiler(PROFILER_SAMPLE_INTERVAL, PROFILER_TOP_FUNCTIONS)
+        self.profiler.instrument_dispatcher(self.dispatcher)
+        self.profiler_job = None
+
+        self.ready = Event()  # set by `self.warm_up`, webhook updates are refused until then
+        self.startup_timings = OrderedDict([('init', perf_counter() - init_start_time)])
+
+    def warm_up(self):
+        """
+        Open database connections, fill caches and resolve the bot's own user in parallel, then mark the bot ready.
+
+        Steps mostly wait for the database and Telegram, so they overlap in threads. An exception in any step
+        is raised here, the bot must not take updates with a half-built duplicate index.
+
+        Returns:
+            OrderedDict: step -> seconds, including the total as `warm_up`
+        """
+        steps = OrderedDict([
+            ('database', self.open_connections),
+            ('bot', self.updater.bot.get_me),  # command handlers need the bot's username
+            ('duplicate_index', lambda: self.with_session(self.duplicate_index.build)),
+            ('inline_cache', self.inline_cache.refresh),
+            ('trending', lambda: self.with_session(self.trending.load)),
+            ('joke_cache', lambda: self.with_session(self.joke_cache.warm, self.JOKE_CACHE_WARM_SIZE)),
+            ('stats_counts', self.refresh_stats_counts),
+        ])
+
+        def timed(step):
+            start_time = perf_counter()
+            step()
+            return perf_counter() - start_time
+
+        start_time = perf_counter()
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='warm_up') as executor:
+            futures = OrderedDict((name, executor.submit(timed, step)) for name, step in steps.items())
+            for name, future in futures.items():
+                self.startup_timings[name] = future.result()
+        self.startup_timings['warm_up'] = perf_counter() - start_time
+
+        self.metrics.observe_startup(self.startup_timings)
+        self.ready.set()
+        logger.info('Ready, startup took {}'.format(
+            ', '.join('{} {:.2f} s'.format(name, seconds) for name, seconds in self.startup_timings.items())))
+        return self.startup_timings
+
+    def with_session(self, function, *args):
+        """
+        Call `function(session, *args)` with a new session, for code running outside of the dispatcher thread
+        """
+        session = self.Session()
+        try:
+            return function(session, *args)
+        finally:
+            session.close()
+
+    def open_connections(self):
+        """
+        Fill the connection pool and check every connection, so first updates don't wait for connecting
+        """
+        pool_size = self.engine.pool.size() if isinstance(self.engine.pool, QueuePool) else 1
+        connections = [self.engine.connect() for _ in range(pool_size)]
+        for connection in connections:
+            connection.scalar(select([1]))
+            connection.close()
+
+    def refresh_stats_counts(self, bot=None, job=None):
+        """
+        Job callback. Count approved jokes and users shown by /stats.
+        """
+        session = self.Session()
+        try:
+            self.stats_counts = {
+                'jokes': session.query(func.count(Joke.id)).filter(Joke.approved == True).scalar(),
+                'users': session.query(func.count(User.id)).scalar(),
+            }
+        finally:
+            session.close()
+
     def display_new_user_keyboard(self, bot, update):
         """
         Display keyboard prompt to register new user.
@@ -154,6 +484,8 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         """
         menu_options = [
             [KeyboardButton('/random_joke')],
+            [KeyboardButton('/recommended_joke')],
+            [KeyboardButton('/trending')],
             [KeyboardButton('/random_favorite_joke')],
             [KeyboardButton('/add_joke')],
             [KeyboardButton('/remove_joke')],
@@ -169,23 +501,6 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
                          reply_markup=keyboard)
         return
 
-    def display_vote_keyboard(self, bot, update):
-        """
-        Display vote options.
-
-        /hah | /nah
-        """
-        vote_options = [
-            [KeyboardButton('/hah')],
-            [KeyboardButton('/nah')],
-        ]
-
-        vote_options_keyboard = ReplyKeyboardMarkup(vote_options, one_time_keyboard=True)
-        bot.send_message(chat_id=update.message.chat.id,
-                         text=self.get_random_response('hah_or_nah'),
-                         reply_markup=vote_options_keyboard)
-        return
-
     def display_approval_keyboard(self, bot, update):
         """
         /approve | /remove
@@ -258,11 +573,16 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         /help - Display this message
         /stats - Display bot's stats
         /menu - Display commands keyboard
-        /random\_joke - Display random joke
+        /random\_joke - Display random joke, in a group everyone can vote on it
+        /recommended\_joke - Display joke similar to the ones you liked
+        /trending - Display jokes with most hahs lately
         /random\_favorite\_joke - Display random joke from favorites
         /add\_joke - Proceed to add a joke
         /remove\_joke - Proceed to remove a joke
+        /search - Search jokes, e.g. /search cats
         /profile - Display user profile
+        /subscribe - Receive daily digest of best new jokes
+        /unsubscribe - Stop receiving daily digest
         /cancel - Cancel current action (adding joke/registering user)
         '''
         message.reply_markdown(help_message)
@@ -270,8 +590,9 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
 
     def stats(self, bot, update):
         message = update.message
-        all_jokes_count = len(self.session.query(Joke).filter_by(approved=True).all())
-        all_users_count = len(self.session.query(User).all())
+        # Counted by a job, /stats used to load every joke and user
+        all_jokes_count = self.stats_counts['jokes']
+        all_users_count = self.stats_counts['users']
 
         stats_message = "Jokes = {all_jokes_count}\nUsers = {all_users_count}".\
             format(all_jokes_count=all_jokes_count, all_users_count=all_users_count)
@@ -373,7 +694,8 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
 
         joke_body = message.text
         try:
-            self.add_joke(joke_body, user)
+            joke = self.add_joke(joke_body, user)
+            self.auto_moderator.submit(joke)
             self.display_menu_keyboard(bot, update, self.get_random_response('joke_submitted'))
             return ConversationHandler.END
         except TooShort:
@@ -382,6 +704,9 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         except TooLong:
             error_message = self.get_random_response('joke_too_long')
             message.reply_text(error_message)
+        except DuplicateJoke:
+            error_message = self.get_random_response('joke_duplicate')
+            message.reply_text(error_message)
 
     def remove_joke_select(self, bot, update, user_data):
         """
@@ -417,19 +742,15 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             message.reply_text(self.get_random_response('remove_joke_received_not_integer'))
             return
 
-        try:
-            joke = self.session.query(Joke).filter(Joke.id==joke_id).one()
-        except SQLAlchemyError:
+        # Only the author can remove the joke
+        user_is_author = self.session.query(Joke.id).filter(Joke.id == joke_id, Joke.user_id == user.get_id()).scalar()
+        if user_is_author is None:
             message.reply_text(self.get_random_response('remove_joke_invalid_id'))
             return
 
-        user_is_author = joke in user.jokes_submitted
-        if not user_is_author:
-            message.reply_text(self.get_random_response('remove_joke_invalid_id'))
-            return
-
-        user_data['joke_to_remove'] = joke
-        reply_message = '{joke}\n{confirm}'.format(joke=joke.get_body(), confirm=self.get_random_response('remove_joke_confirm'))
+        user_data['joke_to_remove'] = joke_id
+        joke_body = self.joke_cache.get_body(self.session, joke_id)
+        reply_message = '{joke}\n{confirm}'.format(joke=joke_body, confirm=self.get_random_response('remove_joke_confirm'))
         message.reply_text(reply_message)
         self.display_confirmation_keyboard(bot, update)
         return RJ_CONFIRM
@@ -456,9 +777,9 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         """
         message = update.message
 
-        joke = user_data['joke_to_remove']
-        self.session.delete(joke)
-        self.session.commit()
+        joke = self.session.query(Joke).get(user_data.pop('joke_to_remove'))
+        if joke is not None:
+            self.remove_joke(joke)
 
         self.display_menu_keyboard(bot, update, self.get_random_response('remove_joke_success'))
 
@@ -467,6 +788,9 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         Display random joke
         """
         message = update.message
+        if message.chat.type != 'private':
+            self.display_group_joke(bot, update)
+            return
 
         # Check if user is registered
         try:
@@ -475,28 +799,89 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             self.display_new_user_keyboard(bot, update)
             return
 
-        # Check if database is not empty
-        all_jokes = self.session.query(Joke).filter_by(approved=True).all()
+        joke_id = self.get_random_unseen_joke_id(user)
+        if joke_id is None:
+            message.reply_text(self.get_random_response('no_new_jokes'))
+            return
+
+        self.display_joke_for_vote(bot, update, joke_id)
+        return
+
+    def display_recommended_joke(self, bot, update, user_data):
+        """
+        Display joke similar to the jokes user laughed at, falls back to random joke if there is no recommendation.
+        """
+        message = update.message
+
+        # Check if user is registered
         try:
-            joke = all_jokes[0]
-        except IndexError:
+            user = self.get_user(message, user_data)
+        except UserDoesNotExist:
+            self.display_new_user_keyboard(bot, update)
+            return
+
+        liked_joke_ids = self.recommender.get_recent_likes(user.get_id())
+        if not liked_joke_ids:
+            liked_joke_ids = self.get_liked_joke_ids(user, self.RECOMMENDER_RECENT_LIKES)
+
+        recommended_joke_ids = self.recommender.recommend(liked_joke_ids, self.RECOMMENDATION_CANDIDATES)
+        unseen_joke_ids = self.get_unseen_joke_ids(user, recommended_joke_ids)
+        if not unseen_joke_ids:
+            self.display_random_joke(bot, update, user_data)
+            return
+
+        self.display_joke_for_vote(bot, update, unseen_joke_ids[0])
+        return
+
+    def display_trending_jokes(self, bot, update):
+        """
+        Display approved jokes with the highest time-decayed number of hahs
+        """
+        message = update.message
+
+        joke_ids = [joke_id for joke_id, score in self.trending.top(self.TRENDING_SHOWN)]
+        # Jokes may have been removed since they were voted for
+        approved_joke_ids = {joke_id for joke_id, in self.session.query(Joke.id).
+                             filter(Joke.id.in_(joke_ids), Joke.approved == True)} if joke_ids else set()
+        # Bodies of jokes removed after the query above are missing as well
+        bodies = self.joke_cache.get_bodies(self.session, [joke_id for joke_id in joke_ids if joke_id in approved_joke_ids])
+        shown_joke_ids = [joke_id for joke_id in joke_ids if joke_id in bodies and joke_id in approved_joke_ids]
+        if not shown_joke_ids:
+            message.reply_text(self.get_random_response('trending_none'))
+            return
+
+        lines = [self.get_random_response('trending_header')]
+        lines += ['{}. {}'.format(rank, bodies[joke_id]) for rank, joke_id in enumerate(shown_joke_ids, start=1)]
+        message.reply_text('\n\n'.join(lines))
+        return
+
+    def display_group_joke(self, bot, update):
+        """
+        Post random joke in group chat, members vote with inline buttons and see the tally on the message
+        """
+        message = update.message
+        joke = self.get_first_after_random_id(self.session.query(Joke).filter(Joke.approved == True))
+        if joke is None:
             message.reply_text(self.get_random_response('no_new_jokes'))
             return
 
-        shuffle(all_jokes)
+        message.reply_text(self.group_votes.format_message(joke), reply_markup=self.group_votes.get_vote_buttons(joke.get_id()))
+        return
 
-        for random_joke in all_jokes:
-            voted_already = random_joke in user.jokes_voted_for
-            user_is_author = random_joke in user.jokes_submitted
-            if not voted_already and not user_is_author:
-                # Remember last joke displayed - used in self.vote_for_joke to vote for right joke
-                user_data['last_joke'] = random_joke
-                # Display joke
-                message.reply_text(random_joke.get_body())
-                self.display_vote_keyboard(bot, update)
-                return
+    def display_joke_for_vote(self, bot, update, joke_id):
+        """
+        Display joke with inline vote buttons
+
+        Callback data of the buttons has format `vote:<hah|nah>:<joke id>`, handled by `self.vote_for_joke`
+        """
+        message = update.message
+        joke_body = self.joke_cache.get_body(self.session, joke_id)
+        # Joke may have been removed since its id was picked
+        if joke_body is None:
+            message.reply_text(self.get_random_response('vote_joke_removed'))
+            return
 
-        message.reply_text(self.get_random_response('no_new_jokes'))
+        message.reply_text(joke_body, reply_markup=self.group_votes.get_vote_buttons(joke_id))
         return
 
     def display_random_favorite_joke(self, bot, update, user_data):
@@ -513,57 +898,103 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             return
 
         # Check if there are any jokes marked as favorite
-        all_favorite_jokes = user.get_jokes_voted_positive()
+        favorite_joke_ids = self.get_liked_joke_ids(user)
         try:
-            random_joke = choice(all_favorite_jokes)
+            joke_id = choice(favorite_joke_ids)
         except IndexError:
             message.reply_text(self.get_random_response('joke_no_favorite'))
             return
 
         # Display joke
-        message.reply_text(random_joke.get_body())
+        message.reply_text(self.joke_cache.get_body(self.session, joke_id))
         return
 
     def vote_for_joke(self, bot, update, user_data):
         """
-        Register user's vote for joke.
+        Register user's vote for joke whose inline button was pressed and remove the buttons.
+
+        Callback data has format `vote:<hah|nah>:<joke id>`, so no state is needed between showing a joke and voting.
+        Votes in group chats are passed to `self.group_votes`.
         """
-        message = update.message
+        query = update.callback_query
+        message = self.get_message(update)
+        if message.chat.type != 'private':
+            self.vote_in_group(bot, update)
+            return
+
         # Check if user is registered
         try:
             user = self.get_user(message, user_data)
         except UserDoesNotExist:
-            self.display_new_user_keyboard(bot, update)
+            query.answer(text=self.get_random_response('user_not_registered'))
             return
 
-        # Check if is called after displaying a joke
-        try:
-            joke = user_data['last_joke']
-        except KeyError:
-            self.display_menu_keyboard(bot, update, self.get_random_response('joke_no_current'))
+        _, vote, joke_id = query.data.split(':')
+        joke = self.session.query(Joke).get(int(joke_id))
+        # Joke may have been removed since it was displayed
+        if joke is None or not joke.is_approved():
+            query.answer(text=self.get_random_response('vote_joke_removed'))
+            query.edit_message_reply_markup(reply_markup=None)
             return
 
         try:
-            if 'hah' in message.text:
-                user.vote_for_joke(joke, positive=True)
-            else:
-                user.vote_for_joke(joke, positive=False)
-
-            self.session.add(user, joke)
-            self.session.commit()
-
+            self.record_vote(user, joke, positive=vote == 'hah')
         except InvalidVote as e:
             logger.error(e)
+            query.answer(text=self.get_random_response('vote_invalid'))
+        else:
+            query.answer(text=self.get_random_response('vote_recorded'))
 
-        finally:
-            self.display_menu_keyboard(bot, update, self.get_random_response('menu'))
-            del user_data['last_joke']
+        query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    def vote_in_group(self, bot, update):
+        """
+        Buffer vote cast on joke posted in group chat, it is saved and shown in the tally by `self.group_votes.flush`
+        """
+        query = update.callback_query
+        user_id = query.from_user.id
+        # Users are registered in private chat, their id is the id of that chat
+        if self.session.query(User.id).filter(User.id == user_id).first() is None:
+            query.answer(text=self.get_random_response('group_vote_not_registered'))
             return
 
+        _, vote, joke_id = query.data.split(':')
+        added = self.group_votes.add_vote(query.message.chat.id, query.message.message_id, user_id, int(joke_id),
+                                          positive=vote == 'hah')
+        if added:
+            query.answer(text=self.get_random_response('vote_recorded'))
+        else:
+            query.answer(text=self.get_random_response('vote_invalid'))
+        return
+
+    def record_vote(self, user, joke, positive):
+        """
+        Save user's vote and pass it to components that follow votes
+
+        Raises:
+            InvalidVote
+        """
+        user.vote_for_joke(joke, positive=positive)
+        self.session.add(user, joke)
+        self.session.commit()
+        self.vote_recorded(user.get_id(), joke, positive)
+
+    def vote_recorded(self, user_id, joke, positive, positive_votes=None):
+        """
+        Pass saved vote to components that follow votes, for votes from private and group chats
+
+        Arguments:
+            positive_votes: int, positive votes of joke right after this vote, see `AuthorNotifier.joke_voted`
+        """
+        self.notifier.joke_voted(joke, positive=positive, positive_votes=positive_votes)
+        self.recommender.record_vote(user_id, joke.get_id(), positive=positive)
+        if positive:
+            self.trending.record_vote(joke.get_id())
 
     def my_jokes(self, bot, update, user_data):
         """
-        Display jokes submitted by user sorted by score.
+        Display jokes submitted by user sorted by Wilson score.
 
         Afterwards displays a keyboard to show next jokes or cancel.
         Uses `self.MY_JOKES_PER_MESSAGE` variable to get the number of jokes to be displayed.
@@ -583,11 +1014,15 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             first_joke_index = 0
 
         last_joke_index = first_joke_index + self.MY_JOKES_PER_MESSAGE
-        all_jokes = self.session.query(Joke).order_by(Joke.vote_count).all()
-        user_jokes = [joke for joke in all_jokes if user.is_author(joke)]
-        user_data['user_jokes'] = user_jokes
+        # One more joke than shown tells whether there is a next page, served by index on
+        # (user_id, wilson_score DESC, id)
+        page_jokes = self.session.query(Joke).\
+            filter(Joke.user_id == user.get_id()).\
+            order_by(Joke.wilson_score.desc(), Joke.id).\
+            offset(first_joke_index).limit(self.MY_JOKES_PER_MESSAGE + 1).all()
 
-        reply_message, all_jokes_shown = self.format_jokes(user_jokes, first_joke_index, last_joke_index)
+        reply_message, _ = self.format_jokes(page_jokes, 0, self.MY_JOKES_PER_MESSAGE)
+        all_jokes_shown = len(page_jokes) <= self.MY_JOKES_PER_MESSAGE
 
         if len(reply_message) == 0:
             if first_joke_index == 0: # user didn't submit any joke
@@ -634,6 +1069,69 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         else:
             return ConversationHandler.END
 
+    def display_search_results(self, bot, update, user_data):
+        """
+        Display next page of search results for query stored in `user_data`.
+
+        Uses `search_query` and `search_cursor` keys in `user_data` to keep track of the query and the last joke shown.
+
+        Returns:
+            next state of ConversationHandler
+        """
+        message = update.message
+        query_text = user_data['search_query']
+        cursor = user_data.get('search_cursor')
+
+        results, next_cursor = self.joke_search.search(self.session, query_text, cursor)
+        if not results:
+            if cursor is None:
+                reply_message = self.get_random_response('search_no_results')
+            else:
+                reply_message = self.get_random_response('search_all_results_shown')
+            self.display_menu_keyboard(bot, update, reply_message)
+            return ConversationHandler.END
+
+        reply_message = '\n\n'.join('(id={id})\n{body}'.format(id=joke_id, body=body) for joke_id, body in results)
+        message.reply_text(reply_message)
+        if next_cursor is None:
+            self.display_menu_keyboard(bot, update, self.get_random_response('search_all_results_shown'))
+            return ConversationHandler.END
+
+        user_data['search_cursor'] = next_cursor
+        self.display_confirmation_keyboard(bot, update)
+        return SEARCH_CHOOSING
+
+    def search(self, bot, update, args, user_data):
+        """
+        Search approved jokes by text, e.g. `/search cats`
+
+        Entry point in ConversationHandler, displays first page of results, next pages are displayed by `self.search_choosing`
+        """
+        message = update.message
+        query_text = ' '.join(args)
+        if not query_text:
+            message.reply_text(self.get_random_response('search_usage'))
+            return ConversationHandler.END
+
+        user_data['search_query'] = query_text
+        user_data['search_cursor'] = None
+        return self.display_search_results(bot, update, user_data)
+
+    def search_choosing(self, bot, update, user_data):
+        message = update.message
+        user_choice = message.text
+        try:
+            proceed = self.process_confirmation_response(update, user_choice)
+        except InvalidChoice:
+            message.reply_text(self.get_random_response('my_jokes_invalid_choice'))
+            return
+
+        if proceed:
+            return self.display_search_results(bot, update, user_data)
+
+        self.display_menu_keyboard(bot, update, self.get_random_response('cancel'))
+        return ConversationHandler.END
+
     def profile(self, bot, update, user_data):
         """
         Display information about user.
@@ -660,25 +1158,82 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message.reply_markdown(user_info)
         return
 
+    def subscribe(self, bot, update):
+        """
+        Subscribe chat to the daily digest
+        """
+        message = update.message
+        chat_id = message.chat.id
+
+        subscriber = self.session.query(Subscriber).filter(Subscriber.chat_id == chat_id).first()
+        if subscriber is not None:
+            message.reply_text(self.get_random_response('subscribe_already'))
+            return
+
+        self.session.add(Subscriber(chat_id=chat_id))
+        self.session.commit()
+        message.reply_text(self.get_random_response('subscribe_success'))
+        return
+
+    def unsubscribe(self, bot, update):
+        """
+        Unsubscribe chat from the daily digest
+        """
+        message = update.message
+        chat_id = message.chat.id
+
+        removed = self.session.query(Subscriber).filter(Subscriber.chat_id == chat_id).delete()
+        self.session.commit()
+        if removed:
+            message.reply_text(self.get_random_response('unsubscribe_success'))
+        else:
+            message.reply_text(self.get_random_response('unsubscribe_not_subscribed'))
+        return
+
+    def moderate_joke(self, joke, approve):
+        """
+        Approve or remove joke and notify its author about approval.
+
+        Arguments:
+            joke: Joke
+            approve: bool, True to approve, False to remove the joke
+
+        Returns:
+            string: reply message
+        """
+        self.joke_cache.invalidate(joke.get_id())
+        if approve:
+            joke.approve()
+            self.session.commit()
+            self.duplicate_index.add(joke.get_id(), joke.get_body())
+            self.notifier.joke_approved(joke)
+            return self.get_random_response('approve_jokes_approved')
+
+        self.remove_joke(joke)
+        return self.get_random_response('approve_jokes_removed')
+
     def approve_jokes_show(self, bot, update, user_data):
         """
         Display joke, display keyboard to approve/not approve
 
+        The joke is leased to the moderator, so other moderators are shown different jokes.
+
         Entry point in ConversationHandler, next is approve_joke_voted.
         /cancel cancels the conversation
         """
         message = update.message
         user_id = message.from_user.id
         if user_id not in self.MODERATORS:
-            message.reply_text(self.get_random_response('permisson_denied'))
+            message.reply_text(self.get_random_response('permission_denied'))
             return ConversationHandler.END
 
-        unapproved_joke = self.session.query(Joke).filter_by(approved=False).order_by(Joke.id).first()
-        if unapproved_joke is None:
+        leased_jokes = self.lease_unapproved_jokes(user_id, 1)
+        if not leased_jokes:
             self.remove_keyboard(bot, update, self.get_random_response('no_new_jokes'))
             return ConversationHandler.END
 
-        user_data['unapproved_joke'] = unapproved_joke
+        unapproved_joke = leased_jokes[0]
+        user_data['unapproved_joke_id'] = unapproved_joke.get_id()
         message.reply_text('{joke}  ({author})'.format(joke=unapproved_joke.get_body(), author=unapproved_joke.get_author().username))
         self.display_approval_keyboard(bot, update)
         return AJ_VOTED
@@ -692,33 +1247,260 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         assert '/approve' in message.text or '/remove' in message.text
 
-        unapproved_joke = user_data['unapproved_joke']
-        if '/approve' in message.text:
-            unapproved_joke.approve()
-            reply_text = self.get_random_response('approve_jokes_approved')
-        elif '/remove' in message.text:
-            self.session.delete(unapproved_joke)
-            reply_text = self.get_random_response('approve_jokes_removed')
-
-        self.session.commit()
+        unapproved_joke = self.get_leased_joke(user_data['unapproved_joke_id'], message.from_user.id)
+        if unapproved_joke is None:
+            reply_text = self.get_random_response('approve_jokes_lease_lost')
+        else:
+            reply_text = self.moderate_joke(unapproved_joke, approve='/approve' in message.text)
 
         self.remove_keyboard(bot, update, reply_text)
         self.display_confirmation_keyboard(bot, update)
         return AJ_NEXT
 
+    def approve_jokes_batch(self, bot, update):
+        """
+        Display `self.MODERATION_BATCH_SIZE` unapproved jokes, each with inline buttons to approve/remove it.
+
+        Jokes are leased to the moderator, buttons are handled by `self.approve_jokes_batch_voted`
+        """
+        message = update.message
+        user_id = message.from_user.id
+        if user_id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        leased_jokes = self.lease_unapproved_jokes(user_id, self.MODERATION_BATCH_SIZE)
+        if not leased_jokes:
+            message.reply_text(self.get_random_response('no_new_jokes'))
+            return
+
+        approve_text = self.get_one_response('approve_jokes_approve_button')
+        remove_text = self.get_one_response('approve_jokes_remove_button')
+        for joke in leased_jokes:
+            keyboard = InlineKeyboardMarkup([[
+                InlineKeyboardButton(approve_text, callback_data='moderate:approve:{}'.format(joke.get_id())),
+                InlineKeyboardButton(remove_text, callback_data='moderate:remove:{}'.format(joke.get_id())),
+            ]])
+            message.reply_text('{joke}  ({author})'.format(joke=joke.get_body(), author=joke.get_author().username),
+                               reply_markup=keyboard)
+        return
+
+    def approve_jokes_batch_voted(self, bot, update):
+        """
+        Approve or remove joke whose inline button was pressed and replace the buttons with the result.
+
+        Callback data has format `moderate:<approve|remove>:<joke id>`
+        """
+        query = update.callback_query
+        user_id = query.from_user.id
+        if user_id not in self.MODERATORS:
+            query.answer(text=self.get_random_response('permission_denied'))
+            return
+
+        _, action, joke_id = query.data.split(':')
+        unapproved_joke = self.get_leased_joke(int(joke_id), user_id)
+        if unapproved_joke is None:
+            reply_text = self.get_random_response('approve_jokes_lease_lost')
+        else:
+            reply_text = self.moderate_joke(unapproved_joke, approve=action == 'approve')
+
+        query.answer()
+        query.edit_message_text(text='{joke}\n\n{result}'.format(joke=query.message.text, result=reply_text))
+        return
+
+    def remove_duplicates(self, bot, update):
+        """
+        Find groups of near-duplicate jokes in the whole catalogue.
+
+        In every group the first approved joke (or the oldest one if none is approved) is kept and the other
+        unapproved jokes are removed. Groups with several approved jokes are listed for moderator to decide.
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        groups = self.duplicate_index.find_duplicate_groups()
+        if not groups:
+            message.reply_text(self.get_random_response('duplicates_none'))
+            return
+
+        removed_joke_ids = []
+        group_lines = []
+        for group in groups:
+            jokes = self.session.query(Joke).filter(Joke.id.in_(group)).order_by(Joke.id).all()
+            approved_jokes = [joke for joke in jokes if joke.is_approved()]
+            kept_jokes = approved_jokes or jokes[:1]
+            removed_joke_ids.extend(joke.get_id() for joke in jokes if joke not in kept_jokes)
+
+            if len(kept_jokes) > 1:
+                group_lines.append('approved: {}'.format(', '.join(str(joke.get_id()) for joke in kept_jokes)))
+
+        removed_count = len(self.purge_jokes(removed_joke_ids))
+        reply_message = self.get_random_response('duplicates_found').format(groups=len(groups), removed=removed_count)
+        if group_lines:
+            reply_message = '{}\n{}'.format(reply_message, '\n'.join(group_lines))
+        message.reply_text(reply_message)
+        return
+
+    def purge_command(self, bot, update, args):
+        """
+        Remove jokes or a user with all their jokes and votes, only for moderators
+
+        `/purge jokes <id> [<id> ...]` removes jokes, `/purge user <id>` removes user. Rows are deleted by one
+        statement each, votes are deleted by the database (ON DELETE CASCADE).
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        try:
+            ids = [int(arg) for arg in args[1:]]
+        except ValueError:
+            ids = []
+        if not ids or args[0] not in ('jokes', 'user') or (args[0] == 'user' and len(ids) > 1):
+            message.reply_text(self.get_random_response('purge_usage'))
+            return
+
+        if args[0] == 'jokes':
+            joke_ids = self.purge_jokes(ids)
+            reply_message = self.get_random_response('purge_jokes_done').format(removed=len(joke_ids))
+        else:
+            joke_ids = self.purge_user(ids[0])
+            if joke_ids is None:
+                message.reply_text(self.get_random_response('purge_user_not_found'))
+                return
+            # Cached user object and conversation state of the removed user
+            self.dispatcher.user_data.pop(ids[0], None)
+            reply_message = self.get_random_response('purge_user_done').format(jokes=len(joke_ids))
+
+        for joke_id in joke_ids:
+            self.trending.forget(joke_id)
+        logger.info('Moderator {} purged {} {}, {} jokes removed'.format(message.from_user.id, args[0], ids, len(joke_ids)))
+        message.reply_text(reply_message)
+        return
+
+    def inline_query(self, bot, update):
+        """
+        Answer inline query (`@HahOrNahBot cats`) with jokes from `self.inline_cache`.
+
+        Offset of the next page is passed to Telegram as `next_offset` and comes back in the next query.
+        """
+        inline_query = update.inline_query
+        try:
+            offset = int(inline_query.offset or 0)
+        except ValueError:
+            offset = 0
+
+        jokes, next_offset = self.inline_cache.get_page(inline_query.query, offset)
+        results = [InlineQueryResultArticle(id=str(joke_id),
+                                            title=body[:self.INLINE_TITLE_LENGTH],
+                                            description=body,
+                                            input_message_content=InputTextMessageContent(body))
+                   for joke_id, body in jokes]
+        inline_query.answer(results, cache_time=self.INLINE_CACHE_TIME, next_offset=next_offset)
+        return
+
+    def perf_stats(self, bot, update):
+        """
+        Display statistics of caches, rate limiter, queries, reconciliation and notifications, only for moderators
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        stats_lines = [self.inline_cache.format_stats(), self.joke_cache.format_stats(), self.rate_limiter.format_stats(),
+                       self.query_stats.format_stats(), self.reconciler.format_stats(), self.notifier.format_stats()]
+        message.reply_text('\n'.join(stats_lines))
+        return
+
+    def profiler_command(self, bot, update, args):
+        """
+        Profile updates for a while and send the report when done, only for moderators
+
+        `/profiler [seconds] [fraction]` starts profiling, e.g. `/profiler 60 0.1` runs cProfile for 10% of updates
+        for a minute, `/profiler stop` sends the report early.
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        if args and args[0] == 'stop':
+            if not self.profiler.active:
+                message.reply_text(self.get_random_response('profiler_not_running'))
+                return
+            self.profiler_job.schedule_removal()
+            self.send_profiler_report(bot, message.chat_id)
+            return
+
+        try:
+            seconds = float(args[0]) if args else self.PROFILER_DEFAULT_SECONDS
+            fraction = float(args[1]) if len(args) > 1 else self.PROFILER_DEFAULT_FRACTION
+        except ValueError:
+            seconds = fraction = -1
+        if not 0 < seconds <= self.PROFILER_MAX_SECONDS or not 0 <= fraction <= 1:
+            message.reply_text(self.get_random_response('profiler_usage').format(max_seconds=self.PROFILER_MAX_SECONDS))
+            return
+
+        if not self.profiler.start(fraction):
+            message.reply_text(self.get_random_response('profiler_already_running'))
+            return
+        self.profiler_job = self.job_queue.run_once(self.profiler_finished, seconds, context=message.chat_id)
+        message.reply_text(self.get_random_response('profiler_started').format(seconds=seconds, fraction=fraction))
+        return
+
+    def profiler_finished(self, bot, job):
+        self.send_profiler_report(bot, job.context)
+
+    def send_profiler_report(self, bot, chat_id):
+        report = self.profiler.stop()
+        if report is None:  # already sent after `/profiler stop`
+            return
+        if len(report) <= self.MESSAGE_LENGTH_MAX:
+            bot.send_message(chat_id, report)
+            return
+        bot.send_document(chat_id, BytesIO(report.encode('utf-8')), filename='profile.txt',
+                          caption=self.get_random_response('profiler_report_attached'))
+
     def invalid_command_handler(self, bot, update):
         message = update.message
         self.display_menu_keyboard(bot, update, self.get_random_response('invalid_command'))
         return
 
     def start_webhook(self, url, port):
+        # The request handler also serves /metrics and /ready, and answers updates with 503 until the bot is warm
+        # so Telegram delivers them again later
+        self.updater.webhook_handler_class = self.metrics.webhook_handler_class(self.ready, self.metrics_token)
+        # Port is bound before warming up, Heroku stops dynos which don't bind it soon enough
         self.updater.start_webhook(listen="0.0.0.0",
                                    port=port,
                                    url_path=self.token)
+        try:
+            self.warm_up()
+        except Exception:
+            self.updater.stop()
+            raise
         self.updater.bot.set_webhook(url + self.token)
         self.updater.idle()
+        self.shutdown()
         return
 
     def start_local(self):
+        self.warm_up()
         self.updater.start_polling()
-        self.updater.idle()
\ No newline at end of file
+        self.updater.idle()
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop worker processes, save trending scores and close the update log, called after the updater has stopped
+        """
+        self.trending.save_snapshot()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.auto_moderator.shutdown()
+        self.recommender.shutdown()
+        self.reconciler.shutdown()
@@ -1,34 +1,58 @@
 import logging
-from sqlalchemy import create_engine
+from datetime import datetime, timedelta
+from random import randint
+from sqlalchemy import create_engine, event, func, or_, and_, exists
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.util import identity_key
 
-from app.models import Joke, User
+from app.models import Joke, User, association_table
 from app.exceptions import *
 
 logger = logging.getLogger(__name__)
 
+
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, including ON DELETE CASCADE of votes, unless enabled for every connection
+    dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
 class HahOrNahBotHelper():
     """
     Class to provide helper methods for HahOrNahBot.
     """
 
-    def __init__(self, database_url, joke_limits, user_limits, user_allowed_characters):
+    def __init__(self, database_url, joke_limits, user_limits, user_allowed_characters, moderation_lease_seconds,
+                 duplicate_index, joke_cache, engine_options=None):
         """
         Arguments:
             database_url: string
             joke_limits: dict, with `min` and `max` keys. Used to restrict length of new jokes
             user_limits: dict, with `min` and `max` keys. Used to restrict length of new usernames
             user_allowed_characters: string. Characters which can be used in a username
+            moderation_lease_seconds: int. For how long a joke shown to moderator is hidden from other moderators
+            duplicate_index: DuplicateIndex. Used to reject near-duplicates, filled with all jokes in database by
+                             `HahOrNahBot.warm_up`
+            joke_cache: JokeBodyCache. Bodies of jokes, invalidated when a joke is removed
+            engine_options: dict. Keyword arguments passed to `create_engine`
         """
         self.JOKE_LENGTH_MIN = joke_limits['min']
         self.JOKE_LENGTH_MAX = joke_limits['max']
         self.USERNAME_LENGTH_MIN = user_limits['min']
         self.USERNAME_LENGTH_MAX = user_limits['max']
         self.USERNAME_ALLOWED_CHARACTERS = user_allowed_characters
+        self.MODERATION_LEASE_SECONDS = moderation_lease_seconds
 
-        engine = create_engine(database_url)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        self.engine = create_engine(database_url, **(engine_options or {}))
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', enable_foreign_keys)
+        # Session factory for jobs running outside of the dispatcher thread, `self.session` is used by handlers only
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+
+        self.joke_cache = joke_cache
+        self.duplicate_index = duplicate_index
+        # InlineJokeCache, set by the subclass because it loads jokes with `self.Session`
+        self.inline_cache = None
 
     def get_user(self, message, user_data):
         """
@@ -98,12 +122,13 @@ class HahOrNahBotHelper():
             author: User
 
         Returns:
-            None
+            Joke
 
         Raises:
             InvalidCharacters
             TooShort
             TooLong
+            DuplicateJoke
         """
         if len(joke_body) < self.JOKE_LENGTH_MIN:
             raise TooShort
@@ -111,19 +136,201 @@ class HahOrNahBotHelper():
         if self.JOKE_LENGTH_MAX < len(joke_body):
             raise TooLong
 
+        duplicate_id = self.duplicate_index.find_duplicate(joke_body)
+        if duplicate_id is not None:
+            logger.info('Joke is a near-duplicate of joke {}'.format(duplicate_id))
+            raise DuplicateJoke
+
         # Calculate id by adding one to last joke's id
-        all_jokes = self.session.query(Joke).order_by(Joke.id).all()
-        try:
-            last_joke = all_jokes[-1]
-            last_joke_id = last_joke.get_id()
-            joke_id = last_joke_id + 1
-        except IndexError:  # no jokes in database
+        last_joke_id = self.session.query(func.max(Joke.id)).scalar()
+        if last_joke_id is None:  # no jokes in database
             joke_id = 0
+        else:
+            joke_id = last_joke_id + 1
 
-        new_joke = Joke(id=joke_id, body=joke_body, vote_count=0, author=author)
+        new_joke = Joke(id=joke_id, body=joke_body, vote_count=0, positive_votes=0, negative_votes=0, hah_ratio=0,
+                        wilson_score=0, author=author)
         self.session.add(new_joke)
         self.session.commit()
-        return
+        self.duplicate_index.add(joke_id, joke_body)
+        return new_joke
+
+    def remove_joke(self, joke):
+        """
+        Remove joke from database, from duplicate index, from joke cache and from inline cache
+
+        Arguments:
+            joke: Joke
+        """
+        joke_id = joke.get_id()
+        self.session.delete(joke)
+        self.session.commit()
+        self.duplicate_index.remove(joke_id)
+        self.joke_cache.invalidate(joke_id)
+        if self.inline_cache is not None:
+            self.inline_cache.remove(joke_id)
+
+    def purge_jokes(self, joke_ids):
+        """
+        Remove jokes with one DELETE, their votes are deleted by the database (ON DELETE CASCADE)
+
+        Arguments:
+            joke_ids: list of ints
+
+        Returns:
+            list of ids of removed jokes, ids of missing jokes are left out
+        """
+        joke_ids = [joke_id for joke_id, in self.session.query(Joke.id).filter(Joke.id.in_(joke_ids))]
+        if joke_ids:
+            self.forget_removed(Joke, joke_ids)
+            self.session.query(Joke).filter(Joke.id.in_(joke_ids)).delete(synchronize_session=False)
+        self.session.commit()
+        return joke_ids
+
+    def purge_user(self, user_id):
+        """
+        Remove user with one DELETE, jokes and votes of the user are deleted by the database (ON DELETE CASCADE)
+
+        Returns:
+            list of ids of removed jokes of the user, None if the user doesn't exist
+        """
+        joke_ids = [joke_id for joke_id, in self.session.query(Joke.id).filter(Joke.user_id == user_id)]
+        self.forget_removed(Joke, joke_ids)
+        self.forget_removed(User, [user_id])
+        removed = self.session.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        self.session.commit()
+        return joke_ids if removed else None
+
+    def forget_removed(self, model, ids):
+        """
+        Expunge objects deleted in bulk from `self.session`, remove jokes from duplicate index, joke cache and
+        inline cache
+        """
+        for object_id in ids:
+            instance = self.session.identity_map.get(identity_key(model, object_id))
+            if instance is not None:
+                self.session.expunge(instance)
+            if model is Joke:
+                self.duplicate_index.remove(object_id)
+                self.joke_cache.invalidate(object_id)
+                if self.inline_cache is not None:
+                    self.inline_cache.remove(object_id)
+
+    def lease_unapproved_jokes(self, moderator_id, count):
+        """
+        Lease unapproved jokes to moderator, so that other moderators are shown different jokes.
+
+        Jokes whose lease has expired and jokes already leased to the moderator can be leased again.
+        Jokes rejected by the prefilter are skipped.
+        Rows locked by a concurrent call are skipped instead of waited for.
+
+        Arguments:
+            moderator_id: int
+            count: int, maximum number of jokes to lease
+
+        Returns:
+            list of Joke
+        """
+        now = datetime.utcnow()
+        jokes = self.session.query(Joke).\
+            filter_by(approved=False).\
+            filter(or_(Joke.prefilter_decision == None, Joke.prefilter_decision != 'rejected')).\
+            filter(or_(Joke.lease_expires == None, Joke.lease_expires < now, Joke.leased_by == moderator_id)).\
+            order_by(Joke.id).\
+            limit(count).\
+            with_for_update(skip_locked=True).\
+            all()
+
+        expires = now + timedelta(seconds=self.MODERATION_LEASE_SECONDS)
+        for joke in jokes:
+            joke.lease(moderator_id, expires)
+        self.session.commit()
+        return jokes
+
+    def get_leased_joke(self, joke_id, moderator_id):
+        """
+        Get unapproved joke leased to moderator.
+
+        Returns:
+            Joke, None if the joke was removed, approved or leased to another moderator in the meantime
+        """
+        joke = self.session.query(Joke).filter(Joke.id == joke_id).first()
+        if joke is None or joke.is_approved() or not joke.is_leased_by(moderator_id):
+            return None
+        return joke
+
+    def get_liked_joke_ids(self, user, limit=None):
+        """
+        Get ids of jokes user voted positively for. Positive votes are stored twice in `association` table.
+
+        Arguments:
+            user: User
+            limit: int, maximum number of ids, all ids if None
+
+        Returns:
+            list of ints
+        """
+        rows = self.session.query(association_table.c.jokes_id).\
+            filter(association_table.c.users_id == user.get_id()).\
+            group_by(association_table.c.jokes_id).\
+            having(func.count() > 1).\
+            limit(limit).all()
+        return [joke_id for joke_id, in rows]
+
+    def get_unseen_joke_ids(self, user, joke_ids):
+        """
+        Get ids of approved jokes from `joke_ids` which user neither submitted nor voted for.
+
+        Returns:
+            list of ints, in the order of `joke_ids`
+        """
+        if not joke_ids:
+            return []
+
+        unseen_joke_ids = self.unseen_jokes_query(user).filter(Joke.id.in_(joke_ids)).all()
+        unseen_joke_ids = {joke_id for joke_id, in unseen_joke_ids}
+        return [joke_id for joke_id in joke_ids if joke_id in unseen_joke_ids]
+
+    def unseen_jokes_query(self, user):
+        """
+        Returns:
+            Query selecting ids of approved jokes which user neither submitted nor voted for
+        """
+        voted = exists().where(and_(association_table.c.jokes_id == Joke.id,
+                                    association_table.c.users_id == user.get_id()))
+        return self.session.query(Joke.id).\
+            filter(Joke.approved == True, Joke.user_id != user.get_id(), ~voted)
+
+    def get_random_unseen_joke_id(self, user):
+        """
+        Get id of random approved joke which user neither submitted nor voted for.
+
+        Returns:
+            int, None if there is no such joke
+        """
+        row = self.get_first_after_random_id(self.unseen_jokes_query(user))
+        return row.id if row is not None else None
+
+    def get_first_after_random_id(self, query):
+        """
+        Get the first result of query after a random joke id (wrapping around), so only an index range is scanned
+        instead of all jokes. Jokes following long gaps in ids are picked a bit more often.
+
+        Arguments:
+            query: Query selecting jokes or columns of `jokes` table
+
+        Returns:
+            first result of query, None if there is none
+        """
+        max_joke_id = self.session.query(func.max(Joke.id)).scalar()
+        if max_joke_id is None:
+            return None
+
+        pivot = randint(0, max_joke_id)
+        result = query.filter(Joke.id >= pivot).order_by(Joke.id).first()
+        if result is None:
+            result = query.filter(Joke.id < pivot).order_by(Joke.id.desc()).first()
+        return result
 
     def get_message(self, update):
         """
@@ -161,8 +368,10 @@ class HahOrNahBotHelper():
                 all_jokes_shown = True
                 break
 
-            joke_message = "{vote_count} votes(id={id})\n{joke_body}\napproved: {approved}".format(
-                vote_count=joke.get_vote_count(), id=joke.get_id(), joke_body=joke.get_body(), approved=joke.is_approved()
+            joke_message = "{positive} hah / {negative} nah, {ratio:.0%} hah, score {score:.2f} (id={id})\n{joke_body}\napproved: {approved}".format(
+                positive=joke.get_positive_votes(), negative=joke.get_negative_votes(),
+                ratio=joke.get_hah_ratio(), score=joke.get_wilson_score(),
+                id=joke.get_id(), joke_body=joke.get_body(), approved=joke.is_approved()
             )
             jokes_string.append(joke_message)
 
@@ -1,31 +1,152 @@
 import logging
 import json
+import os
 from random import choice
+from string import Formatter
+from types import MappingProxyType
+
+from app.exceptions import InvalidResponses
 
 logger = logging.getLogger(__name__)
 
 class TelegramBotResponses:
     """
     Class that provides an interface to bot response file - file that stores list of bot responses
+
+    Responses are compiled into an immutable table (state -> tuple of strings). The table can be reloaded
+    while the bot is running, a new table replaces the old one only if it passes validation.
     """
-    def __init__(self, filename):
-        self.responses = self.get_responses(filename)
+    def __init__(self, filename, required_states, fixed_states=(), placeholders=None):
+        """
+        Arguments:
+            filename: string, path to responses file
+            required_states: iterable of strings, states which have to be defined in responses file
+            fixed_states: iterable of strings, states whose first response can't change on reload
+                          (e.g. texts of keyboard buttons matched by handlers)
+            placeholders: dict, state -> dict of placeholder name -> example value, for states formatted with
+                          `str.format`. Every response of the state has to use exactly these placeholders
+        """
+        self.responses_filename = filename
+        self.required_states = frozenset(required_states)
+        self.fixed_states = frozenset(fixed_states)
+        self.placeholders = placeholders or {}
+        self.responses_mtime = None
+
+        try:
+            self.responses = self.get_responses(filename)
+        except InvalidResponses as e:
+            logger.info('Responses file {} is invalid ({}). Exiting'.format(filename, e))
+            exit()
+
+    def compile_responses(self, raw_responses):
+        """
+        Validate responses loaded from responses file and compile them into a lookup table
+
+        Arguments:
+            raw_responses: object loaded from responses file
+
+        Returns:
+            mappingproxy: state -> tuple of strings
+
+        Raises:
+            InvalidResponses
+        """
+        if not isinstance(raw_responses, dict):
+            raise InvalidResponses('responses file has to contain an object')
+
+        table = {}
+        for state, responses in raw_responses.items():
+            if not isinstance(responses, list) or len(responses) == 0:
+                raise InvalidResponses('{} has to be a non-empty list'.format(state))
+
+            if not all(isinstance(response, str) and response for response in responses):
+                raise InvalidResponses('{} has to contain only non-empty strings'.format(state))
+
+            if state in self.placeholders:
+                for response in responses:
+                    self.check_placeholders(state, response)
+
+            table[state] = tuple(responses)
+
+        missing_states = self.required_states - table.keys()
+        if missing_states:
+            raise InvalidResponses('missing states: {}'.format(', '.join(sorted(missing_states))))
+
+        return MappingProxyType(table)
+
+    def check_placeholders(self, state, response):
+        """
+        Check that response uses exactly the placeholders declared for its state and can be formatted
+
+        Raises:
+            InvalidResponses
+        """
+        examples = self.placeholders[state]
+        try:
+            fields = {field_name for _, field_name, _, _ in Formatter().parse(response) if field_name is not None}
+            # `{joke.id}` and `{jokes[0]}` are placeholders `joke` and `jokes`
+            names = {field.split('.', 1)[0].split('[', 1)[0] for field in fields}
+            if names != examples.keys():
+                raise InvalidResponses('{} has to use placeholders {}, found {}: {}'.format(
+                    state, sorted(examples), sorted(names), response))
+            response.format(**examples)
+        except (ValueError, KeyError, IndexError, AttributeError) as e:
+            raise InvalidResponses('{} can\'t be formatted ({}): {}'.format(state, e, response))
 
     def get_responses(self, responses_file):
         """
-        Get bot responses defined in self.RESPONSES_FILE
+        Get bot responses defined in responses file
 
         Returns:
-            dict
+            mappingproxy: state -> tuple of strings
+
+        Raises:
+            InvalidResponses
         """
         try:
-            with open(responses_file, 'r') as fp:
-                responses = json.load(fp)
-            return responses
+            mtime = os.stat(responses_file).st_mtime
+            with open(responses_file, 'r', encoding='utf-8') as fp:
+                raw_responses = json.load(fp)
+        except FileNotFoundError:
+            raise InvalidResponses('file not found')
+        except ValueError as e:
+            raise InvalidResponses('invalid JSON: {}'.format(e))
+
+        responses = self.compile_responses(raw_responses)
+        self.responses_mtime = mtime
+        return responses
 
+    def reload_responses(self, bot, job):
+        """
+        Job callback. Reload responses file if it has changed since it was last loaded.
+
+        Invalid file is rejected and the bot keeps using the current responses.
+        """
+        try:
+            mtime = os.stat(self.responses_filename).st_mtime
         except FileNotFoundError:
-            logger.info('Responses file {} not found. Exiting'.format(responses_file))
-            exit()
+            logger.error('Responses file {} not found, keeping current responses'.format(self.responses_filename))
+            return
+
+        if mtime == self.responses_mtime:
+            return
+
+        try:
+            responses = self.get_responses(self.responses_filename)
+        except InvalidResponses as e:
+            self.responses_mtime = mtime  # don't retry until the file changes again
+            logger.error('Responses file {} rejected: {}'.format(self.responses_filename, e))
+            return
+
+        for state in self.fixed_states:
+            if responses[state][0] != self.responses[state][0]:
+                logger.error('Responses file {} rejected: first response of {} can\'t change without a restart'.format(
+                    self.responses_filename, state))
+                return
+
+        # Replacing the reference is atomic, handlers see either the old or the new table
+        self.responses = responses
+        logger.info('Responses file {} reloaded'.format(self.responses_filename))
 
     def get_random_response(self, state):
         """
@@ -35,13 +156,12 @@ class TelegramBotResponses:
             string
         """
         try:
-            assert state in self.responses.keys()  # should be called only with states defined in self.RESPONSES_FILE
-        except AssertionError:
-            logger.info('No response found for ' + state)
-            logger.info(self.responses.keys())
-            exit()
+            responses = self.responses[state]
+        except KeyError:
+            logger.error('No response found for ' + state)
+            raise
 
-        response = choice(self.responses[state])
+        response = choice(responses)
         return response
 
     def get_one_response(self, state):
@@ -53,11 +173,10 @@ class TelegramBotResponses:
 
         """
         try:
-            assert state in self.responses.keys()  # should be called only with states defined in self.RESPONSES_FILE
-        except AssertionError:
-            logger.info('No response found for ' + state)
-            logger.info(self.responses.keys())
-            exit()
+            responses = self.responses[state]
+        except KeyError:
+            logger.error('No response found for ' + state)
+            raise
 
-        response = self.responses[state][0]
-        return response
\ No newline at end of file
+        response = responses[0]
+        return response
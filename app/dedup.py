@@ -0,0 +1,173 @@
+import logging
+import random
+import re
+from array import array
+from zlib import crc32
+
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+
+
+class DuplicateIndex:
+    """
+    In-memory MinHash + locality-sensitive hashing index of joke bodies, used to find near-duplicates.
+
+    Every joke gets a MinHash signature of its character shingles. Signature is split into bands,
+    jokes sharing at least one band are candidates and candidates whose signatures agree on at least
+    `threshold` of positions are considered duplicates.
+    """
+
+    def __init__(self, bands, rows_per_band, shingle_size, threshold, seed=0):
+        """
+        Arguments:
+            bands: int, number of LSH bands
+            rows_per_band: int, number of signature values in one band
+            shingle_size: int, number of characters in one shingle
+            threshold: float, estimated Jaccard similarity from which two jokes are duplicates
+            seed: int, seed of hash functions, has to be the same for signatures to be comparable
+        """
+        self.bands = bands
+        self.rows_per_band = rows_per_band
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+
+        # XOR with a random mask permutes 32-bit shingle hashes, one mask per signature value
+        generator = random.Random(seed)
+        self.masks = [generator.getrandbits(32) for _ in range(bands * rows_per_band)]
+
+        self.signatures = {}  # joke id -> array of signature values
+        self.buckets = [{} for _ in range(bands)]  # band -> {hash of band values: set of joke ids}
+
+    def get_shingle_hashes(self, body):
+        """
+        Return hashes of character shingles of normalized body
+
+        Returns:
+            set of ints
+        """
+        text = NON_ALPHANUMERIC.sub(' ', body.lower()).strip()
+        if len(text) <= self.shingle_size:
+            return {crc32(text.encode('utf-8'))}
+
+        encoded = text.encode('utf-8')
+        return {crc32(encoded[i:i + self.shingle_size]) for i in range(len(encoded) - self.shingle_size + 1)}
+
+    def get_signature(self, body):
+        """
+        Return MinHash signature of body
+
+        Returns:
+            array of ints
+        """
+        hashes = self.get_shingle_hashes(body)
+        return array('L', [min(map(mask.__xor__, hashes)) for mask in self.masks])
+
+    def get_band_keys(self, signature):
+        rows = self.rows_per_band
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def similarity(self, signature, other_signature):
+        """
+        Return estimated Jaccard similarity of two signatures
+
+        Returns:
+            float
+        """
+        same = sum(1 for value, other_value in zip(signature, other_signature) if value == other_value)
+        return same / len(signature)
+
+    def add(self, joke_id, body):
+        """
+        Add joke to index, replacing its previous body if it is already indexed.
+        """
+        if joke_id in self.signatures:
+            self.remove(joke_id)
+
+        signature = self.get_signature(body)
+        self.signatures[joke_id] = signature
+        for bucket, key in zip(self.buckets, self.get_band_keys(signature)):
+            bucket.setdefault(key, set()).add(joke_id)
+
+    def remove(self, joke_id):
+        """
+        Remove joke from index, does nothing if the joke is not indexed.
+        """
+        signature = self.signatures.pop(joke_id, None)
+        if signature is None:
+            return
+
+        for bucket, key in zip(self.buckets, self.get_band_keys(signature)):
+            joke_ids = bucket[key]
+            joke_ids.discard(joke_id)
+            if not joke_ids:
+                del bucket[key]
+
+    def get_candidates(self, signature):
+        candidates = set()
+        for bucket, key in zip(self.buckets, self.get_band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        return candidates
+
+    def find_duplicate(self, body):
+        """
+        Return id of an indexed joke which is a near-duplicate of body.
+
+        Returns:
+            int, None if there is no duplicate
+        """
+        signature = self.get_signature(body)
+        best_id, best_similarity = None, self.threshold
+        for joke_id in self.get_candidates(signature):
+            similarity = self.similarity(signature, self.signatures[joke_id])
+            if similarity >= best_similarity:
+                best_id, best_similarity = joke_id, similarity
+        return best_id
+
+    def build(self, session, batch_size=1000):
+        """
+        Index all jokes in database. Bodies are streamed in batches instead of loading all of them at once.
+        """
+        query = session.query(Joke.id, Joke.body).\
+            execution_options(stream_results=True).\
+            yield_per(batch_size)
+
+        for joke_id, body in query:
+            self.add(joke_id, body)
+        logger.info('Duplicate index built with {} jokes'.format(len(self.signatures)))
+
+    def find_duplicate_groups(self):
+        """
+        Return groups of indexed jokes which are near-duplicates of each other.
+
+        Returns:
+            list of sorted lists of joke ids, only groups with at least two jokes
+        """
+        parent = {}
+
+        def find(joke_id):
+            while parent.get(joke_id, joke_id) != joke_id:
+                joke_id = parent[joke_id]
+            return joke_id
+
+        for bucket in self.buckets:
+            for joke_ids in bucket.values():
+                if len(joke_ids) < 2:
+                    continue
+                joke_ids = sorted(joke_ids)
+                for i, joke_id in enumerate(joke_ids):
+                    for other_id in joke_ids[i + 1:]:
+                        if find(joke_id) == find(other_id):
+                            continue
+                        if self.similarity(self.signatures[joke_id], self.signatures[other_id]) >= self.threshold:
+                            parent[find(other_id)] = find(joke_id)
+
+        groups = {}
+        for joke_id in parent:
+            groups.setdefault(find(joke_id), set()).add(joke_id)
+        for root in list(groups):
+            groups[root].add(root)
+
+        return sorted(sorted(group) for group in groups.values())
@@ -0,0 +1,141 @@
+import logging
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from telegram.error import TelegramError, Unauthorized
+
+from app.models import Joke, Subscriber, association_table
+
+logger = logging.getLogger(__name__)
+
+
+class DailyDigest:
+    """
+    Class that computes the daily digest of best new jokes and delivers it to subscribers.
+
+    The digest is computed once per day (`self.compute`) and cached as a ready to send message.
+    Delivery (`self.deliver`) is a repeating job which sends the digest to the next batch of subscribers,
+    batches are sized so that all subscribers are reached within `delivery_hours`.
+    """
+
+    def __init__(self, Session, responses, size, delivery_hours, batch_interval, min_batch_size):
+        """
+        Arguments:
+            Session: sessionmaker, jobs run outside of the dispatcher thread and use their own sessions
+            responses: TelegramBotResponses
+            size: int, number of jokes in digest
+            delivery_hours: int, number of hours the delivery is spread across
+            batch_interval: int, number of seconds between two delivery batches
+            min_batch_size: int, minimal number of subscribers in one batch
+        """
+        self.Session = Session
+        self.responses = responses
+        self.size = size
+        self.delivery_hours = delivery_hours
+        self.batch_interval = batch_interval
+        self.min_batch_size = min_batch_size
+
+        self.digest = None  # message to be delivered, None if there is nothing to deliver
+        self.batch_size = min_batch_size
+        self.last_chat_id = None  # keyset cursor, chat id of the last subscriber the digest was sent to
+
+    def get_best_new_jokes(self, session, since):
+        """
+        Return jokes approved after `since` with the most votes.
+
+        Returns:
+            list of (id, body, votes) tuples
+        """
+        votes = func.count(association_table.c.users_id).label('votes')
+        return session.query(Joke.id, Joke.body, votes).\
+            outerjoin(association_table, association_table.c.jokes_id == Joke.id).\
+            filter(Joke.approved == True, Joke.approved_at >= since).\
+            group_by(Joke.id, Joke.body, Joke.vote_count).\
+            order_by(Joke.vote_count.desc(), votes.desc(), Joke.id).\
+            limit(self.size).all()
+
+    def format_digest(self, jokes):
+        """
+        Return digest message
+
+        Arguments:
+            jokes: list of (id, body, votes) tuples
+
+        Returns:
+            string
+        """
+        lines = [self.responses.get_random_response('digest_header')]
+        for position, (joke_id, body, votes) in enumerate(jokes, start=1):
+            lines.append('{position}. {body}'.format(position=position, body=body))
+
+        return '\n\n'.join(lines)
+
+    def compute(self, bot, job):
+        """
+        Job callback. Compute today's digest and restart delivery from the first subscriber.
+        """
+        session = self.Session()
+        try:
+            since = datetime.utcnow() - timedelta(days=1)
+            jokes = self.get_best_new_jokes(session, since)
+            subscriber_count = session.query(func.count(Subscriber.chat_id)).scalar()
+        finally:
+            session.close()
+
+        if not jokes:
+            logger.info('No new jokes for daily digest')
+            self.digest = None
+            return
+
+        batches_per_day = self.delivery_hours * 3600 // self.batch_interval
+        self.batch_size = max(self.min_batch_size, math.ceil(subscriber_count / batches_per_day))
+        self.digest = self.format_digest(jokes)
+        self.last_chat_id = None
+        logger.info('Daily digest with {jokes} jokes computed for {subscribers} subscribers'.format(
+            jokes=len(jokes), subscribers=subscriber_count))
+
+    def get_next_batch(self, session):
+        """
+        Return chat ids of the next `self.batch_size` subscribers.
+
+        Uses keyset pagination on chat id, so the subscribers table is never loaded as a whole
+        and no transaction is kept open between batches.
+
+        Returns:
+            list of ints
+        """
+        query = session.query(Subscriber.chat_id).order_by(Subscriber.chat_id)
+        if self.last_chat_id is not None:
+            query = query.filter(Subscriber.chat_id > self.last_chat_id)
+
+        return [chat_id for chat_id, in query.limit(self.batch_size)]
+
+    def deliver(self, bot, job):
+        """
+        Job callback. Send digest to the next batch of subscribers.
+        """
+        if self.digest is None:
+            return
+
+        session = self.Session()
+        try:
+            chat_ids = self.get_next_batch(session)
+            if not chat_ids:
+                logger.info('Daily digest delivered')
+                self.digest = None
+                return
+
+            for chat_id in chat_ids:
+                try:
+                    bot.send_message(chat_id=chat_id, text=self.digest)
+                except Unauthorized:
+                    # Bot was blocked or removed from the chat
+                    session.query(Subscriber).filter(Subscriber.chat_id == chat_id).delete()
+                except TelegramError as e:
+                    logger.error('Could not send digest to {chat_id}: {error}'.format(chat_id=chat_id, error=e))
+
+            session.commit()
+            self.last_chat_id = chat_ids[-1]
+        finally:
+            session.close()
@@ -14,4 +14,13 @@ class InvalidCharacters(Exception):
     pass
 
 class InvalidChoice(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidResponses(Exception):
+    pass
+
+class DuplicateJoke(Exception):
+    pass
+
+class InvalidExport(Exception):
+    pass
@@ -0,0 +1,263 @@
+"""
+Streaming export and import of users, jokes, votes and subscribers to a compact columnar file.
+
+Tables are read through server-side cursors in chunks of `CHUNK_SIZE` rows, so memory use doesn't grow with the
+database. Every chunk stores its rows column by column (integers and floats packed as 64-bit values, other columns
+as JSON lists) and is compressed with zlib. The importer bulk inserts chunk by chunk in one transaction into an
+empty database migrated to the same alembic revision.
+
+Usage, from the repository root (DATABASE_URL environment variable is used unless --database-url is given):
+    python -m app.export export backup.hon
+    python -m app.export import backup.hon --database-url sqlite:///clone.db
+
+For offline analysis `read_chunks` yields columns of one table chunk by chunk without a database.
+"""
+import argparse
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+
+from sqlalchemy import create_engine, select, text, func, DateTime, Float, Integer
+
+from app.models import Base
+from app.exceptions import InvalidExport
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HAHORNAH-EXPORT\n'
+FORMAT_VERSION = 1
+FRAME_SIZE = struct.Struct('<I')
+CHUNK_SIZE = 10000  # rows
+COMPRESSION_LEVEL = 6
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_column(column, values):
+    """
+    Returns:
+        tuple: string: encoding, one of `int64`, `float64` and `json`
+               bytes
+    """
+    if None not in values:
+        if isinstance(column.type, Integer):
+            return 'int64', struct.pack('<{}q'.format(len(values)), *values)
+        if isinstance(column.type, Float):
+            return 'float64', struct.pack('<{}d'.format(len(values)), *values)
+    if isinstance(column.type, DateTime):
+        values = [value.strftime(DATETIME_FORMAT) if value is not None else None for value in values]
+    return 'json', json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode_column(column, encoding, data, rows):
+    """
+    Returns:
+        list of values
+    """
+    if encoding == 'int64':
+        return list(struct.unpack('<{}q'.format(rows), data))
+    if encoding == 'float64':
+        return list(struct.unpack('<{}d'.format(rows), data))
+    values = json.loads(data.decode('utf-8'))
+    if isinstance(column.type, DateTime):
+        values = [datetime.strptime(value, DATETIME_FORMAT) if value is not None else None for value in values]
+    return values
+
+
+def write_frame(fp, header, blocks=()):
+    """
+    Write compressed frame: JSON header line followed by binary blocks, lengths of blocks are added to the header
+    """
+    header = dict(header, blocks=[len(block) for block in blocks])
+    payload = zlib.compress(json.dumps(header).encode('utf-8') + b'\n' + b''.join(blocks), COMPRESSION_LEVEL)
+    fp.write(FRAME_SIZE.pack(len(payload)))
+    fp.write(payload)
+
+
+def read_frames(fp):
+    """
+    Returns:
+        generator of (header dict, list of bytes blocks) tuples
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise InvalidExport('Not an export file')
+    while True:
+        size = fp.read(FRAME_SIZE.size)
+        if not size:
+            return
+        payload = zlib.decompress(fp.read(FRAME_SIZE.unpack(size)[0]))
+        header, _, body = payload.partition(b'\n')
+        header = json.loads(header.decode('utf-8'))
+
+        blocks = []
+        offset = 0
+        for length in header['blocks']:
+            blocks.append(body[offset:offset + length])
+            offset += length
+        yield header, blocks
+
+
+def get_revision(connection):
+    """
+    Returns:
+        string, alembic revision of database, None if it isn't managed by alembic
+    """
+    if not connection.dialect.has_table(connection, 'alembic_version'):
+        return None
+    return connection.execute(text('SELECT version_num FROM alembic_version')).scalar()
+
+
+def export_database(engine, fp, chunk_size=CHUNK_SIZE):
+    """
+    Stream all tables of `app.models` to file
+
+    Arguments:
+        engine: Engine
+        fp: file opened for writing in binary mode
+
+    Returns:
+        dict: table name -> exported rows
+    """
+    connection = engine.connect()
+    if engine.dialect.name == 'postgresql':
+        # Tables are read one after another, all of them have to come from the same snapshot
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+    counts = {}
+    with connection.begin():
+        fp.write(MAGIC)
+        write_frame(fp, {'type': 'header', 'format': FORMAT_VERSION, 'revision': get_revision(connection),
+                         'exported_at': datetime.utcnow().strftime(DATETIME_FORMAT)})
+
+        for table in Base.metadata.sorted_tables:
+            columns = list(table.columns)
+            query = select(columns).order_by(*table.primary_key.columns)
+            write_frame(fp, {'type': 'table', 'table': table.name, 'columns': [column.name for column in columns]})
+
+            result = connection.execution_options(stream_results=True).execute(query)
+            counts[table.name] = 0
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                encoded = [encode_column(column, [row[index] for row in rows]) for index, column in enumerate(columns)]
+                write_frame(fp, {'type': 'chunk', 'table': table.name, 'rows': len(rows),
+                                 'encodings': [encoding for encoding, _ in encoded]},
+                            [block for _, block in encoded])
+                counts[table.name] += len(rows)
+            result.close()
+
+        # Missing end frame means the file is truncated
+        write_frame(fp, {'type': 'end', 'counts': counts})
+    connection.close()
+    return counts
+
+
+def read_chunks(fp, table_name):
+    """
+    Read one table of an export file
+
+    Returns:
+        generator of dicts: column name -> list of values, one dict per chunk
+    """
+    table = Base.metadata.tables[table_name]
+    column_names = None
+    for header, blocks in read_frames(fp):
+        if header['type'] == 'table' and header['table'] == table_name:
+            column_names = header['columns']
+        elif header['type'] == 'chunk' and header['table'] == table_name:
+            yield {column_name: decode_column(table.c[column_name], encoding, block, header['rows'])
+                   for column_name, encoding, block in zip(column_names, header['encodings'], blocks)}
+
+
+def reset_sequences(connection):
+    """
+    Move PostgreSQL sequences of integer primary keys past the imported ids
+    """
+    for table in Base.metadata.sorted_tables:
+        primary_key = list(table.primary_key.columns)
+        if len(primary_key) != 1 or not isinstance(primary_key[0].type, Integer):
+            continue
+        connection.execute(text("SELECT setval(pg_get_serial_sequence(:table, :column), "
+                                "coalesce(max({column}), 0) + 1, false) FROM {table}".format(
+                                    table=table.name, column=primary_key[0].name)),
+                           table=table.name, column=primary_key[0].name)
+
+
+def import_database(engine, fp):
+    """
+    Bulk insert export file into empty database, in one transaction
+
+    Returns:
+        dict: table name -> imported rows
+
+    Raises:
+        InvalidExport: if the file is invalid or truncated, the database is not empty or at another revision
+    """
+    counts = {}
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if connection.execute(select([func.count()]).select_from(table)).scalar():
+                raise InvalidExport('Table {} is not empty'.format(table.name))
+
+        table = columns = None
+        ended = False
+        for header, blocks in read_frames(fp):
+            if header['type'] == 'header':
+                revision = get_revision(connection)
+                if header['revision'] != revision:
+                    raise InvalidExport('Export is at revision {}, database at {}'.format(header['revision'], revision))
+            elif header['type'] == 'table':
+                table = Base.metadata.tables[header['table']]
+                columns = [table.c[column_name] for column_name in header['columns']]
+                counts[table.name] = 0
+            elif header['type'] == 'chunk':
+                values = [decode_column(column, encoding, block, header['rows'])
+                          for column, encoding, block in zip(columns, header['encodings'], blocks)]
+                names = [column.name for column in columns]
+                connection.execute(table.insert(), [dict(zip(names, row)) for row in zip(*values)])
+                counts[table.name] += header['rows']
+            elif header['type'] == 'end':
+                if header['counts'] != counts:
+                    raise InvalidExport('Imported {}, export contains {}'.format(counts, header['counts']))
+                ended = True
+
+        if not ended:
+            raise InvalidExport('Export file is truncated')
+        if engine.dialect.name == 'postgresql':
+            reset_sequences(connection)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export database to a file or import it into an empty database')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('filename')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows per chunk when exporting')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not arguments.database_url:
+        parser.error('Missing database url, pass --database-url or set DATABASE_URL')
+
+    engine_options = {}
+    if arguments.database_url.startswith('postgres'):
+        engine_options['use_batch_mode'] = True  # executemany with few round trips
+
+    engine = create_engine(arguments.database_url, **engine_options)
+    start_time = time.perf_counter()
+    if arguments.command == 'export':
+        with open(arguments.filename, 'wb') as fp:
+            counts = export_database(engine, fp, arguments.chunk_size)
+    else:
+        with open(arguments.filename, 'rb') as fp:
+            counts = import_database(engine, fp)
+    logger.info('{}ed {} in {:.1f} s'.format(arguments.command.capitalize(), ', '.join(
+        '{} {} rows'.format(table, rows) for table, rows in counts.items()), time.perf_counter() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import logging
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+from sqlalchemy.exc import SQLAlchemyError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
+
+from app.models import Joke, User, association_table, wilson_lower_bound
+
+logger = logging.getLogger(__name__)
+
+
+class GroupVoteBuffer:
+    """
+    Class that collects votes cast on jokes posted in group chats and applies them in batches.
+
+    Handlers only add votes to a buffer. A job from the `JobQueue` (see `self.flush`) saves all buffered votes
+    with one commit and edits the tally of every message that got votes, so a message is edited at most once
+    per run of the job however many members vote on it.
+    """
+
+    def __init__(self, Session, responses, on_vote, message_cache_size):
+        """
+        Arguments:
+            Session: sessionmaker, `self.flush` runs outside of the dispatcher thread
+            responses: TelegramBotResponses, used to build tallies and buttons
+            on_vote: callable(user_id, joke, positive, positive_votes), called for every saved vote before the session
+                     is closed, with positive votes the joke had right after the vote
+            message_cache_size: int, number of messages whose last shown tally is remembered
+        """
+        self.Session = Session
+        self.responses = responses
+        self.on_vote = on_vote
+        self.message_cache_size = message_cache_size
+
+        self.lock = Lock()
+        self.votes = []  # (user id, joke id, positive) waiting to be saved
+        self.voters = set()  # (user id, joke id) of buffered votes
+        self.dirty_messages = {}  # (chat id, message id) -> joke id of messages whose tally has to be updated
+        self.shown_tallies = OrderedDict()  # (chat id, message id) -> (hahs, nahs) shown on message, LRU
+
+    def add_vote(self, chat_id, message_id, user_id, joke_id, positive):
+        """
+        Buffer a vote
+
+        Returns:
+            bool, False if user already has a vote for the joke in the buffer
+        """
+        with self.lock:
+            if (user_id, joke_id) in self.voters:
+                return False
+            self.voters.add((user_id, joke_id))
+            self.votes.append((user_id, joke_id, positive))
+            self.dirty_messages[(chat_id, message_id)] = joke_id
+        return True
+
+    def get_vote_buttons(self, joke_id):
+        """
+        Returns:
+            InlineKeyboardMarkup with hah and nah buttons for joke
+        """
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(self.responses.get_one_response('vote_hah_button'), callback_data='vote:hah:{}'.format(joke_id)),
+            InlineKeyboardButton(self.responses.get_one_response('vote_nah_button'), callback_data='vote:nah:{}'.format(joke_id)),
+        ]])
+
+    def format_message(self, joke):
+        """
+        Return text of group message: joke followed by its tally
+
+        Returns:
+            string
+        """
+        tally = self.responses.get_one_response('group_vote_tally').format(
+            hahs=joke.get_positive_votes(), nahs=joke.get_negative_votes())
+        return '{body}\n\n{tally}'.format(body=joke.get_body(), tally=tally)
+
+    def save_votes(self, session, votes):
+        """
+        Register votes and commit them at once. Invalid votes (own joke, already voted) are skipped.
+
+        Counters are incremented in SQL rather than written back from Python, the dispatcher thread saves votes
+        from private chats on the same jokes and users meanwhile and none of its increments are lost.
+
+        Returns:
+            dict: joke id -> Joke, for jokes that exist
+        """
+        user_ids = {user_id for user_id, joke_id, positive in votes}
+        joke_ids = {joke_id for user_id, joke_id, positive in votes}
+        existing_user_ids = {user_id for user_id, in session.query(User.id).filter(User.id.in_(user_ids))}
+        jokes = {joke.get_id(): joke for joke in session.query(Joke).filter(Joke.id.in_(joke_ids), Joke.approved == True)}
+        voted = set(session.query(association_table.c.users_id, association_table.c.jokes_id).
+                    filter(association_table.c.users_id.in_(user_ids), association_table.c.jokes_id.in_(joke_ids)))
+
+        saved_votes = []
+        vote_rows = []
+        joke_votes = defaultdict(lambda: [0, 0])  # joke id -> [hahs, nahs] of saved votes
+        score_changes = defaultdict(int)  # user id -> change of score
+        for user_id, joke_id, positive in votes:
+            joke = jokes.get(joke_id)
+            if user_id not in existing_user_ids or joke is None:
+                continue
+            if joke.user_id == user_id or (user_id, joke_id) in voted:
+                logger.info('Invalid group vote. Joke ID={} User ID={}'.format(joke_id, user_id))
+                continue
+            voted.add((user_id, joke_id))
+
+            # A positive vote is stored twice in `association` table, a negative one once
+            vote_rows.extend([{'users_id': user_id, 'jokes_id': joke_id}] * (2 if positive else 1))
+            joke_votes[joke_id][0 if positive else 1] += 1
+            score_changes[user_id] += 1 if positive else -1
+            # Number of this vote among the saved hahs of joke, turned into its positive votes below
+            saved_votes.append((user_id, joke_id, positive, joke_votes[joke_id][0]))
+
+        if not saved_votes:
+            logger.info('Saved 0 of {} group votes'.format(len(votes)))
+            return jokes
+
+        session.execute(association_table.insert(), vote_rows)
+        for joke_id, (hahs, nahs) in joke_votes.items():
+            session.query(Joke).filter(Joke.id == joke_id).update({
+                Joke.positive_votes: Joke.positive_votes + hahs,
+                Joke.negative_votes: Joke.negative_votes + nahs,
+                Joke.vote_count: Joke.vote_count + hahs - nahs,
+            }, synchronize_session=False)
+        for score_change in set(score_changes.values()):
+            changed_user_ids = [user_id for user_id, change in score_changes.items() if change == score_change]
+            session.query(User).filter(User.id.in_(changed_user_ids)).update(
+                {User.score: User.score + score_change}, synchronize_session=False)
+
+        # Rows are locked by the updates until commit, so ratios are computed from the counters as they are saved
+        hahs_before = {}
+        counters = session.query(Joke.id, Joke.positive_votes, Joke.negative_votes).\
+            filter(Joke.id.in_(list(joke_votes))).all()
+        for joke_id, positive_votes, negative_votes in counters:
+            hahs_before[joke_id] = positive_votes - joke_votes[joke_id][0]
+            session.query(Joke).filter(Joke.id == joke_id).update({
+                Joke.hah_ratio: positive_votes / (positive_votes + negative_votes),
+                Joke.wilson_score: wilson_lower_bound(positive_votes, negative_votes),
+            }, synchronize_session=False)
+
+        session.commit()
+        # Load saved counters of all voted jokes with one query, instead of one per joke on first access
+        session.query(Joke).filter(Joke.id.in_(list(joke_votes))).all()
+        for user_id, joke_id, positive, hah_number in saved_votes:
+            joke = jokes[joke_id]
+            self.on_vote(user_id, joke, positive, hahs_before[joke_id] + hah_number)
+        logger.info('Saved {} of {} group votes'.format(len(saved_votes), len(votes)))
+        return jokes
+
+    def flush(self, bot, job):
+        """
+        Job callback. Save buffered votes and update tallies of messages that got votes.
+        """
+        with self.lock:
+            votes, self.votes, self.voters = self.votes, [], set()
+            dirty_messages, self.dirty_messages = self.dirty_messages, {}
+
+        if not votes:
+            return
+
+        session = self.Session()
+        try:
+            try:
+                jokes = self.save_votes(session, votes)
+            except SQLAlchemyError as e:
+                session.rollback()
+                logger.error('Could not save {} group votes: {}'.format(len(votes), e))
+                return
+
+            for (chat_id, message_id), joke_id in dirty_messages.items():
+                joke = jokes.get(joke_id)
+                if joke is None:
+                    continue
+                self.update_tally(bot, chat_id, message_id, joke)
+        finally:
+            session.close()
+
+    def update_tally(self, bot, chat_id, message_id, joke):
+        """
+        Edit message with joke's tally, unless the same tally is already shown
+        """
+        key = (chat_id, message_id)
+        tally = (joke.get_positive_votes(), joke.get_negative_votes())
+        if self.shown_tallies.get(key) == tally:
+            return
+
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=self.format_message(joke),
+                                  reply_markup=self.get_vote_buttons(joke.get_id()))
+        except BadRequest as e:
+            # e.g. message was deleted from the group
+            logger.info('Could not update tally of message {}: {}'.format(message_id, e))
+        except TelegramError as e:
+            logger.error('Could not update tally of message {}: {}'.format(message_id, e))
+            return
+
+        self.shown_tallies[key] = tally
+        self.shown_tallies.move_to_end(key)
+        if len(self.shown_tallies) > self.message_cache_size:
+            self.shown_tallies.popitem(last=False)
@@ -0,0 +1,199 @@
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from threading import Lock
+
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+class InlineJokeIndex:
+    """
+    Snapshot of top jokes with a token index. Replaced as a whole when the cache is refreshed, in between
+    removed jokes are only left out of results (see `self.remove`).
+    """
+    def __init__(self, jokes):
+        """
+        Arguments:
+            jokes: list of (id, body) tuples, best joke first
+        """
+        self.jokes = jokes
+        postings = {}
+        for position, (joke_id, body) in enumerate(jokes):
+            for token in set(WORD.findall(body.lower())):
+                postings.setdefault(token, []).append(position)
+        self.postings = postings  # token -> positions of jokes containing it, in rank order
+        self.tokens = sorted(postings)
+        self.positions = {joke_id: position for position, (joke_id, body) in enumerate(jokes)}
+        self.removed = set()  # positions of removed jokes
+        self.results = OrderedDict()  # normalized query -> tuple of positions, LRU
+
+    def remove(self, joke_id):
+        position = self.positions.get(joke_id)
+        if position is None:
+            return
+        self.removed.add(position)
+        self.results.clear()
+
+
+class InlineJokeCache:
+    """
+    Class that serves inline queries from memory.
+
+    Top approved jokes are loaded periodically (`self.refresh`) into an `InlineJokeIndex`.
+    Every word of the query has to match a word of the joke, the last word is matched as a prefix because
+    inline queries are sent while the user is typing. Results of recent queries are cached.
+    """
+
+    def __init__(self, Session, size, page_size, result_cache_size, latency_samples=1000):
+        """
+        Arguments:
+            Session: sessionmaker, `self.refresh` runs outside of the dispatcher thread
+            size: int, number of top jokes kept in memory
+            page_size: int, number of results in one answer
+            result_cache_size: int, number of queries whose results are cached
+            latency_samples: int, number of latest lookups used to compute latency percentiles
+        """
+        self.Session = Session
+        self.size = size
+        self.page_size = page_size
+        self.result_cache_size = result_cache_size
+
+        self.index = InlineJokeIndex([])
+        self.lock = Lock()
+        self.removed_ids = set()  # jokes removed while the index is being refreshed
+        self.hits = 0
+        self.misses = 0
+        self.latencies = deque(maxlen=latency_samples)
+
+    def refresh(self, bot=None, job=None):
+        """
+        Job callback. Load top approved jokes and replace the index.
+        """
+        with self.lock:
+            self.removed_ids = set()
+        session = self.Session()
+        try:
+            # Ranked like /my_jokes and the joke cache, the vote count favours jokes shown to many users
+            jokes = session.query(Joke.id, Joke.body).\
+                filter(Joke.approved == True).\
+                order_by(Joke.wilson_score.desc(), Joke.id).\
+                limit(self.size).all()
+        finally:
+            session.close()
+
+        index = InlineJokeIndex([(joke_id, body) for joke_id, body in jokes])
+        with self.lock:
+            # Removals committed while the query ran may not be reflected in it
+            for joke_id in self.removed_ids:
+                index.remove(joke_id)
+            self.index = index
+
+    def remove(self, joke_id):
+        """
+        Leave removed joke out of results until the next refresh
+        """
+        with self.lock:
+            self.removed_ids.add(joke_id)
+            self.index.remove(joke_id)
+
+    def find_positions(self, index, tokens):
+        """
+        Return positions of jokes matching all tokens, last token is matched as a prefix
+
+        Returns:
+            tuple of ints, in rank order
+        """
+        if not tokens:
+            return tuple(position for position in range(len(index.jokes)) if position not in index.removed)
+
+        matching = None
+        for token in tokens[:-1]:
+            positions = set(index.postings.get(token, ()))
+            matching = positions if matching is None else matching & positions
+            if not matching:
+                return ()
+
+        prefix = tokens[-1]
+        prefix_positions = set()
+        start = bisect_left(index.tokens, prefix)
+        for token in index.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            prefix_positions.update(index.postings[token])
+
+        matching = prefix_positions if matching is None else matching & prefix_positions
+        return tuple(sorted(matching - index.removed))
+
+    def get_page(self, query, offset):
+        """
+        Return one page of jokes matching inline query
+
+        Arguments:
+            query: string
+            offset: int, position of the first result
+
+        Returns:
+            tuple: list of (id, body) tuples
+                   string: offset of next page, empty string if there are no more results
+        """
+        start_time = time.perf_counter()
+        index = self.index  # the same snapshot is used for the whole lookup
+        tokens = WORD.findall(query.lower())
+        key = ' '.join(tokens)
+
+        try:
+            positions = index.results[key]
+            index.results.move_to_end(key)
+            self.hits += 1
+        except KeyError:
+            positions = self.find_positions(index, tokens)
+            index.results[key] = positions
+            if len(index.results) > self.result_cache_size:
+                index.results.popitem(last=False)
+            self.misses += 1
+
+        page = [index.jokes[position] for position in positions[offset:offset + self.page_size]]
+        next_offset = offset + self.page_size
+        if next_offset >= len(positions):
+            next_offset = ''
+
+        self.latencies.append(time.perf_counter() - start_time)
+        return page, str(next_offset)
+
+    def get_latency_percentile(self, percentile):
+        """
+        Returns:
+            float, latency in milliseconds, 0 if there were no lookups
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        position = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[position] * 1000
+
+    def get_stats(self):
+        """
+        Returns:
+            dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'jokes': len(self.index.jokes),
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            'p50_ms': self.get_latency_percentile(50),
+            'p99_ms': self.get_latency_percentile(99),
+        }
+
+    def format_stats(self):
+        """
+        Returns:
+            string
+        """
+        return 'inline cache: {jokes} jokes, hit ratio {hit_ratio:.2f}, p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(
+            **self.get_stats())
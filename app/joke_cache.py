@@ -0,0 +1,125 @@
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+
+class JokeBodyCache:
+    """
+    Read-through cache of joke bodies keyed by joke id.
+
+    Bodies never change after a joke is submitted, so handlers can select joke ids only and resolve bodies here.
+    Least recently used bodies are evicted once their total size exceeds `max_bytes`. Entries are invalidated
+    explicitly when a joke is moderated or removed.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Arguments:
+            max_bytes: int, maximum total size of cached bodies encoded in UTF-8
+        """
+        self.max_bytes = max_bytes
+
+        self.lock = Lock()
+        self.bodies = OrderedDict()  # joke id -> body, LRU
+        self.sizes = {}  # joke id -> size of body in bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, joke_id, body):
+        """
+        Add body to cache and evict least recently used bodies if the cache is full.
+
+        Has to be called with `self.lock` acquired.
+        """
+        if joke_id in self.bodies:
+            self.bodies.move_to_end(joke_id)
+            return
+
+        size = len(body.encode('utf-8'))
+        self.bodies[joke_id] = body
+        self.sizes[joke_id] = size
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            evicted_id, _ = self.bodies.popitem(last=False)
+            self.used_bytes -= self.sizes.pop(evicted_id)
+
+    def get_bodies(self, session, joke_ids):
+        """
+        Return bodies of jokes, bodies missing in cache are loaded with one query
+
+        Arguments:
+            session: Session
+            joke_ids: iterable of ints
+
+        Returns:
+            dict: joke id -> body, jokes which don't exist are missing
+        """
+        bodies = {}
+        missing_ids = []
+        with self.lock:
+            for joke_id in joke_ids:
+                try:
+                    bodies[joke_id] = self.bodies[joke_id]
+                    self.bodies.move_to_end(joke_id)
+                    self.hits += 1
+                except KeyError:
+                    missing_ids.append(joke_id)
+                    self.misses += 1
+
+        if missing_ids:
+            rows = session.query(Joke.id, Joke.body).filter(Joke.id.in_(missing_ids)).all()
+            with self.lock:
+                for joke_id, body in rows:
+                    self.put(joke_id, body)
+                    bodies[joke_id] = body
+        return bodies
+
+    def get_body(self, session, joke_id):
+        """
+        Returns:
+            string, None if joke doesn't exist
+        """
+        return self.get_bodies(session, [joke_id]).get(joke_id)
+
+    def warm(self, session, limit):
+        """
+        Load bodies of the best scored approved jokes, those are shown most often. Hit ratio is not affected.
+        """
+        rows = session.query(Joke.id, Joke.body).\
+            filter(Joke.approved == True).\
+            order_by(Joke.wilson_score.desc()).\
+            limit(limit).all()
+        with self.lock:
+            for joke_id, body in rows:
+                self.put(joke_id, body)
+
+    def invalidate(self, joke_id):
+        with self.lock:
+            if self.bodies.pop(joke_id, None) is not None:
+                self.used_bytes -= self.sizes.pop(joke_id)
+
+    def get_stats(self):
+        """
+        Returns:
+            dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'jokes': len(self.bodies),
+            'used_bytes': self.used_bytes,
+            'max_bytes': self.max_bytes,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+        }
+
+    def format_stats(self):
+        """
+        Returns:
+            string
+        """
+        return 'joke cache: {jokes} jokes, {used_bytes}/{max_bytes} bytes, hit ratio {hit_ratio:.2f}'.format(
+            **self.get_stats())
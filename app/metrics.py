@@ -0,0 +1,202 @@
+import time
+from functools import wraps
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import event
+from telegram.ext import ConversationHandler, DispatcherHandlerStop, Updater
+from telegram.utils.webhookhandler import WebhookHandler, WebhookServer
+
+METRICS_PATH = '/metrics'  # followed by the metrics token, e.g. /metrics/<token>
+READY_PATH = '/ready'
+
+
+def get_handler_name(handler):
+    """
+    Return label of a handler, the command for command handlers and the callback name for others
+    """
+    command = getattr(handler, 'command', None)
+    if command:
+        return '/{}'.format(command[0] if isinstance(command, list) else command)
+    return getattr(handler.callback, '__name__', type(handler).__name__)
+
+
+class BotMetrics:
+    """
+    Class that collects Prometheus metrics of the bot: handler latency and errors, dispatcher queue depth,
+    database pool checkouts and Bot API call latency.
+
+    Metrics are kept in an own registry, so several bots can live in one process (e.g. benchmarks), and are
+    served on `METRICS_PATH` of the webhook server behind a secret token, see `self.webhook_handler_class`.
+    """
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.handler_latency = Histogram('hahornah_handler_seconds', 'Time spent in a handler callback',
+                                         ['handler'], registry=self.registry)
+        self.handler_errors = Counter('hahornah_handler_errors_total', 'Exceptions raised by handler callbacks',
+                                      ['handler'], registry=self.registry)
+        self.queue_depth = Gauge('hahornah_update_queue_depth', 'Updates waiting for the dispatcher',
+                                 registry=self.registry)
+        self.pool_checkouts = Counter('hahornah_db_pool_checkouts_total', 'Connections checked out of the pool',
+                                      registry=self.registry)
+        self.pool_checked_out = Gauge('hahornah_db_pool_checked_out', 'Connections currently checked out',
+                                      registry=self.registry)
+        self.api_latency = Histogram('hahornah_bot_api_seconds', 'Time spent in Bot API calls',
+                                     ['method'], registry=self.registry)
+        self.api_errors = Counter('hahornah_bot_api_errors_total', 'Failed Bot API calls',
+                                  ['method'], registry=self.registry)
+        self.startup_seconds = Gauge('hahornah_startup_seconds', 'Duration of startup steps', ['step'],
+                                     registry=self.registry)
+        self.instrumented_handlers = set()  # ids, handlers like /cancel are shared by several conversations
+
+    def instrument_callback(self, name, callback):
+        latency = self.handler_latency.labels(name)
+        errors = self.handler_errors.labels(name)
+
+        @wraps(callback)
+        def instrumented(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            except DispatcherHandlerStop:
+                raise
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start_time)
+
+        return instrumented
+
+    def instrument_handler(self, handler):
+        """
+        Wrap callback of a handler, handlers of conversations are wrapped recursively
+        """
+        if isinstance(handler, ConversationHandler):
+            nested = handler.entry_points + handler.fallbacks
+            for state_handlers in handler.states.values():
+                nested += state_handlers
+            for nested_handler in nested:
+                self.instrument_handler(nested_handler)
+            return
+        if id(handler) in self.instrumented_handlers:
+            return
+        self.instrumented_handlers.add(id(handler))
+        handler.callback = self.instrument_callback(get_handler_name(handler), handler.callback)
+
+    def instrument_dispatcher(self, dispatcher):
+        """
+        Wrap all handlers added to the dispatcher so far and report depth of its update queue
+        """
+        for group_handlers in dispatcher.handlers.values():
+            for handler in group_handlers:
+                self.instrument_handler(handler)
+        self.queue_depth.set_function(dispatcher.update_queue.qsize)
+
+    def instrument_engine(self, engine):
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.pool_checkouts.inc()
+        self.pool_checked_out.inc()
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        self.pool_checked_out.dec()
+
+    def instrument_request(self, request):
+        """
+        Wrap `post` of the `telegram.utils.request.Request` of a bot, every Bot API call goes through it
+        """
+        post = request.post
+
+        @wraps(post)
+        def instrumented_post(url, data, timeout=None):
+            method = url.rsplit('/', 1)[-1]
+            start_time = time.perf_counter()
+            try:
+                return post(url, data, timeout=timeout)
+            except Exception:
+                self.api_errors.labels(method).inc()
+                raise
+            finally:
+                self.api_latency.labels(method).observe(time.perf_counter() - start_time)
+
+        request.post = instrumented_post
+
+    def observe_startup(self, timings):
+        """
+        Arguments:
+            timings: dict, startup step -> seconds
+        """
+        for step, seconds in timings.items():
+            self.startup_seconds.labels(step).set(seconds)
+
+    def generate(self):
+        """
+        Returns:
+            bytes, metrics in Prometheus text format
+        """
+        return generate_latest(self.registry)
+
+    def webhook_handler_class(self, ready, metrics_token):
+        """
+        Return webhook request handler which also answers GET requests on `METRICS_PATH` and `READY_PATH`.
+
+        Updates posted before the bot is ready are answered with 503, Telegram delivers them again later.
+
+        Arguments:
+            ready: threading.Event, set when the bot is warmed up
+            metrics_token: string, metrics are served on `METRICS_PATH/<metrics_token>`, not at all if None
+        """
+        metrics = self
+        metrics_path = '{}/{}'.format(METRICS_PATH, metrics_token) if metrics_token else None
+
+        class MetricsWebhookHandler(WebhookHandler):
+            def send_body(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if metrics_path is not None and self.path == metrics_path:
+                    self.send_body(200, CONTENT_TYPE_LATEST, metrics.generate())
+                elif self.path == READY_PATH:
+                    if ready.is_set():
+                        self.send_body(200, 'text/plain', b'ready')
+                    else:
+                        self.send_body(503, 'text/plain', b'warming up')
+                else:
+                    super().do_GET()
+
+            def do_POST(self):
+                if not ready.is_set():
+                    self.send_body(503, 'text/plain', b'warming up')
+                    return
+                super().do_POST()
+
+        return MetricsWebhookHandler
+
+
+class WebhookUpdater(Updater):
+    """
+    Updater whose webhook server uses `self.webhook_handler_class` to handle requests, set it before
+    `self.start_webhook`.
+
+    SSL isn't supported, it is terminated in front of the bot (e.g. by Heroku's router).
+    """
+
+    webhook_handler_class = WebhookHandler
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, clean, webhook_url,
+                       allowed_updates):
+        if cert is not None or key is not None:
+            raise ValueError('WebhookUpdater does not support SSL certificates')
+        if not url_path.startswith('/'):
+            url_path = '/{0}'.format(url_path)
+
+        self.httpd = WebhookServer((listen, port), self.webhook_handler_class, self.update_queue, url_path,
+                                   self.bot)
+        self.httpd.serve_forever(poll_interval=1)
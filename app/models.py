@@ -1,35 +1,65 @@
-from sqlalchemy import Column, Integer, String, Boolean, Table, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Float, Table, ForeignKey, Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 
 from app.exceptions import InvalidVote
 
 import logging
+import math
+from datetime import datetime
 
 Base = declarative_base()
 
 
 association_table = Table('association', Base.metadata,
-                          Column('users_id', Integer, ForeignKey('users.id')),
-                          Column('jokes_id', Integer, ForeignKey('jokes.id')),
+                          # Votes are deleted by the database together with their user or joke
+                          Column('users_id', Integer, ForeignKey('users.id', ondelete='CASCADE')),
+                          Column('jokes_id', Integer, ForeignKey('jokes.id', ondelete='CASCADE')),
+                          Column('voted_at', DateTime, server_default=func.now(), index=True),
+                          # Votes are looked up and aggregated by user and by joke
+                          Index('ix_association_users_id_jokes_id', 'users_id', 'jokes_id'),
+                          Index('ix_association_jokes_id_users_id', 'jokes_id', 'users_id'),
                           )
 
 logger = logging.getLogger(__name__)
 
+WILSON_Z = 1.96  # 95% confidence
+
+
+def wilson_lower_bound(positive, negative):
+    """
+    Return lower bound of Wilson score interval for the ratio of positive votes.
+
+    Unlike the ratio itself it takes the number of votes into account, 90 hahs and 10 nahs score higher than 1 hah.
+
+    Returns:
+        float between 0 and 1, 0 if there are no votes
+    """
+    total = positive + negative
+    if total == 0:
+        return 0
+    ratio = positive / total
+    z_squared = WILSON_Z ** 2
+    return (ratio + z_squared / (2 * total) -
+            WILSON_Z * math.sqrt((ratio * (1 - ratio) + z_squared / (4 * total)) / total)) / (1 + z_squared / total)
+
+
 class User(Base):
     __tablename__ = 'users'
 
     id = Column('id', Integer, primary_key=True, unique=True)
     username = Column('username', String)
+    # passive_deletes: collections aren't loaded on delete, rows are removed by ON DELETE CASCADE
     jokes_voted_for = relationship('Joke',
                                    secondary=association_table,
-                                   back_populates='users_voted')
+                                   back_populates='users_voted',
+                                   passive_deletes=True)
     jokes_voted_positive = relationship('Joke',
                                         secondary=association_table,
                                         back_populates='users_voted_positive',
-                                        cascade='all, delete, delete-orphan',
-                                        single_parent=True)
-    jokes_submitted = relationship('Joke', backref='author',cascade='all, delete, delete-orphan', single_parent=True)
+                                        passive_deletes=True)
+    jokes_submitted = relationship('Joke', backref='author', cascade='all, delete-orphan', passive_deletes=True)
     score = Column('score', Integer, default=0)
 
     def get_id(self):
@@ -111,14 +141,25 @@ class Joke(Base):
     id = Column('id', Integer, primary_key=True, unique=True)
     body = Column('body', String(1000))
     vote_count = Column(Integer)
+    positive_votes = Column(Integer, default=0)
+    negative_votes = Column(Integer, default=0)
+    hah_ratio = Column(Float, default=0)
+    wilson_score = Column(Float, default=0, index=True)
     approved = Column(Boolean, unique=False, default=False)
+    approved_at = Column(DateTime, index=True)
+    leased_by = Column(Integer)  # id of moderator reviewing the joke
+    lease_expires = Column(DateTime)
+    prefilter_decision = Column(String(20))  # passed, rejected or approved, None until checked
+    prefilter_reason = Column(String(100))
     users_voted = relationship('User',
                                secondary=association_table,
-                               back_populates='jokes_voted_for')
+                               back_populates='jokes_voted_for',
+                               passive_deletes=True)
     users_voted_positive = relationship('User',
                                         secondary=association_table,
-                                        back_populates='jokes_voted_positive')
-    user_id = Column(Integer, ForeignKey('users.id'))
+                                        back_populates='jokes_voted_positive',
+                                        passive_deletes=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
 
     def get_id(self):
         return self.id
@@ -129,6 +170,18 @@ class Joke(Base):
     def get_vote_count(self):
         return self.vote_count
 
+    def get_positive_votes(self):
+        return self.positive_votes
+
+    def get_negative_votes(self):
+        return self.negative_votes
+
+    def get_hah_ratio(self):
+        return self.hah_ratio
+
+    def get_wilson_score(self):
+        return self.wilson_score
+
     def get_users_voted(self):
         return self.users_voted
 
@@ -137,15 +190,23 @@ class Joke(Base):
 
     def approve(self):
         self.approved = True
+        self.approved_at = datetime.utcnow()
 
     def is_approved(self):
         return self.approved
 
+    def lease(self, moderator_id, expires):
+        self.leased_by = moderator_id
+        self.lease_expires = expires
+
+    def is_leased_by(self, moderator_id):
+        return self.leased_by == moderator_id
+
     def register_vote(self, user, positive):
         """
         Register vote for joke.
 
-        Increments/decrements vote_count, adds user to user_voted.
+        Increments/decrements vote_count, updates vote statistics, adds user to user_voted.
 
         Args:
             user: instance of User class who voted for the joke
@@ -156,10 +217,14 @@ class Joke(Base):
         """
         if positive:
             self.vote_count += 1
+            self.positive_votes += 1
             self.users_voted_positive.append(user)
         else:
             self.vote_count -= 1
+            self.negative_votes += 1
 
+        self.hah_ratio = self.positive_votes / (self.positive_votes + self.negative_votes)
+        self.wilson_score = wilson_lower_bound(self.positive_votes, self.negative_votes)
         self.users_voted.append(user)
 
     def __repr__(self):
@@ -167,6 +232,23 @@ class Joke(Base):
         # For some reason the formatting is off when using multiline string
         return joke_info
 
+
+# Jokes of a user sorted by score, for /my_jokes pages, in the order they are shown
+Index('ix_jokes_user_id_wilson_score_id', Joke.user_id, Joke.wilson_score.desc(), Joke.id)
+
+
+class Subscriber(Base):
+    __tablename__ = 'subscribers'
+
+    chat_id = Column('chat_id', BigInteger, primary_key=True, autoincrement=False)  # group chat ids don't fit in Integer
+    subscribed_at = Column('subscribed_at', DateTime, default=datetime.utcnow)
+
+    def get_chat_id(self):
+        return self.chat_id
+
+    def __repr__(self):
+        return 'chat id: {chat_id}\nsubscribed at: {subscribed_at}'.format(chat_id=self.chat_id, subscribed_at=self.subscribed_at)
+
 if __name__ == '__main__':
     a = User(username='asdf', id=0)
     a.set_username('fasdljkfsadlfjda', 21039)
\ No newline at end of file
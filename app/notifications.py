@@ -0,0 +1,176 @@
+import logging
+import time
+from collections import deque
+from threading import Lock
+
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class AuthorNotifier:
+    """
+    Class that collects events about authors' jokes and sends them coalesced notifications.
+
+    Events are recorded by the handlers and only stored in memory. A job from the `JobQueue`
+    (see `self.send_notifications`) turns them into messages once an author's window has passed and sends
+    a limited number of messages per run, so the handler threads never talk to Telegram on behalf of authors.
+    """
+
+    def __init__(self, responses, window, batch_size, milestones, outbox_size):
+        """
+        Arguments:
+            responses: TelegramBotResponses, used to build notification messages
+            window: int, number of seconds events for one author are coalesced for
+            batch_size: int, maximum number of messages sent in one run of `self.send_notifications`
+            milestones: iterable of ints, numbers of positive votes of a joke which are reported to its author
+            outbox_size: int, maximum number of messages waiting to be sent, the oldest are dropped beyond it
+        """
+        self.responses = responses
+        self.window = window
+        self.batch_size = batch_size
+        self.milestones = set(milestones)
+
+        self.lock = Lock()
+        self.pending = {}  # author id -> dict with events collected in the current window
+        self.outbox = deque(maxlen=outbox_size)  # (chat_id, text) waiting to be sent
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def get_pending(self, author_id):
+        """
+        Return events collected for author, start a new window if there are none.
+
+        Has to be called with `self.lock` acquired.
+
+        Returns:
+            dict
+        """
+        try:
+            return self.pending[author_id]
+        except KeyError:
+            events = {'since': time.time(), 'approved': 0, 'hahs': {}, 'milestones': {}}
+            self.pending[author_id] = events
+            return events
+
+    def joke_approved(self, joke):
+        """
+        Record that joke was approved by a moderator.
+
+        Arguments:
+            joke: Joke
+        """
+        with self.lock:
+            events = self.get_pending(joke.user_id)
+            events['approved'] += 1
+
+    def joke_voted(self, joke, positive, positive_votes=None):
+        """
+        Record a vote for joke. Only positive votes and reached milestones are reported to the author.
+
+        Arguments:
+            joke: Joke, with vote already registered
+            positive: bool
+            positive_votes: int, positive votes of joke right after this vote, current ones if not given.
+                            Group votes are saved in batches, so joke already has the votes of the whole batch.
+        """
+        if not positive:
+            return
+
+        # Positive votes only grow by one with every vote, unlike the vote count (hahs minus nahs) which can reach
+        # a milestone repeatedly, so a milestone is reached by exactly one vote and nothing has to be remembered
+        if positive_votes is None:
+            positive_votes = joke.get_positive_votes()
+        with self.lock:
+            events = self.get_pending(joke.user_id)
+            hahs = events['hahs']
+            hahs[joke.get_id()] = hahs.get(joke.get_id(), 0) + 1
+            if positive_votes in self.milestones:
+                milestones = events['milestones']
+                milestones[joke.get_id()] = max(milestones.get(joke.get_id(), 0), positive_votes)
+
+    def format_notification(self, events):
+        """
+        Return notification message for events collected for one author.
+
+        Returns:
+            string
+        """
+        lines = []
+        if events['approved']:
+            lines.append(self.responses.get_random_response('notification_approved').format(
+                count=events['approved']))
+
+        if events['hahs']:
+            lines.append(self.responses.get_random_response('notification_votes').format(
+                jokes=len(events['hahs']), hahs=sum(events['hahs'].values())))
+
+        for joke_id, vote_count in sorted(events['milestones'].items()):
+            lines.append(self.responses.get_random_response('notification_milestone').format(
+                id=joke_id, votes=vote_count))
+
+        return '\n'.join(lines)
+
+    def collect_due(self, now=None):
+        """
+        Move authors whose window has passed from `self.pending` to `self.outbox`.
+
+        Returns:
+            None
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            due = [author_id for author_id, events in self.pending.items() if now - events['since'] >= self.window]
+            for author_id in due:
+                events = self.pending.pop(author_id)
+                if len(self.outbox) == self.outbox.maxlen:
+                    dropped_chat_id, _ = self.outbox[0]
+                    self.dropped += 1
+                    logger.warning('Notification outbox is full, dropped notification to {}'.format(dropped_chat_id))
+                self.outbox.append((author_id, self.format_notification(events)))
+
+    def send_notifications(self, bot, job):
+        """
+        Job callback. Send at most `self.batch_size` notifications whose window has passed.
+        """
+        self.collect_due()
+
+        for _ in range(self.batch_size):
+            try:
+                chat_id, text = self.outbox.popleft()
+            except IndexError:
+                return
+
+            try:
+                bot.send_message(chat_id=chat_id, text=text)
+            except TelegramError as e:
+                # User might have blocked the bot, notification is dropped
+                self.failed += 1
+                logger.error('Could not notify {chat_id}: {error}'.format(chat_id=chat_id, error=e))
+            else:
+                self.sent += 1
+
+    def get_stats(self):
+        """
+        Returns:
+            dict
+        """
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'outbox': len(self.outbox),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
+    def format_stats(self):
+        """
+        Returns:
+            string
+        """
+        return ('notifications: {pending} authors pending, {outbox} in outbox, {sent} sent, {failed} failed, '
+                '{dropped} dropped').format(**self.get_stats())
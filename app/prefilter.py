@@ -0,0 +1,285 @@
+import logging
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func, or_
+
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+PASSED = 'passed'
+REJECTED = 'rejected'
+APPROVED = 'approved'
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton, finds all blocklisted words in a text in a single pass.
+    """
+
+    def __init__(self, words):
+        """
+        Arguments:
+            words: iterable of strings, matched case-insensitively
+        """
+        self.transitions = [{}]  # state -> {character: state}
+        self.fail = [0]
+        self.output = [()]  # state -> words ending in the state
+
+        for word in words:
+            self.add_word(word.lower())
+        self.build_fail_links()
+
+    def add_word(self, word):
+        state = 0
+        for character in word:
+            try:
+                state = self.transitions[state][character]
+            except KeyError:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.transitions[state][character] = len(self.transitions) - 1
+                state = len(self.transitions) - 1
+        self.output[state] = self.output[state] + (word,)
+
+    def build_fail_links(self):
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and character not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(character, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """
+        Return words found in text as whole words.
+
+        Returns:
+            list of strings
+        """
+        text = text.lower()
+        found = []
+        state = 0
+        for end, character in enumerate(text):
+            while state and character not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(character, 0)
+            for word in self.output[state]:
+                start = end - len(word) + 1
+                before = text[start - 1] if start > 0 else ' '
+                after = text[end + 1] if end + 1 < len(text) else ' '
+                if not before.isalnum() and not after.isalnum():
+                    found.append(word)
+        return found
+
+
+class BlocklistRule:
+    """
+    Reject jokes containing blocklisted words.
+    """
+    def __init__(self, words):
+        self.automaton = AhoCorasick(words)
+
+    def check(self, body):
+        found = self.automaton.find(body)
+        if found:
+            return 'blocklisted word: {}'.format(found[0])
+        return None
+
+
+class SpamRule:
+    """
+    Reject jokes looking like advertisement or keyboard mashing.
+    """
+    LINK = re.compile(r'(https?://|www\.|t\.me/|@\w{5,})', re.IGNORECASE)
+    REPEATED_CHARACTER = re.compile(r'(.)\1{9,}')
+
+    def __init__(self, max_links, max_uppercase_ratio):
+        self.max_links = max_links
+        self.max_uppercase_ratio = max_uppercase_ratio
+
+    def check(self, body):
+        if len(self.LINK.findall(body)) > self.max_links:
+            return 'too many links'
+
+        if self.REPEATED_CHARACTER.search(body):
+            return 'repeated characters'
+
+        letters = [character for character in body if character.isalpha()]
+        if len(letters) >= 20:
+            uppercase_ratio = sum(character.isupper() for character in letters) / len(letters)
+            if uppercase_ratio > self.max_uppercase_ratio:
+                return 'too many uppercase letters'
+        return None
+
+
+class TextRule:
+    """
+    Reject jokes with too few words or made mostly of non-letter characters.
+    """
+    def __init__(self, min_words, min_letter_ratio):
+        self.min_words = min_words
+        self.min_letter_ratio = min_letter_ratio
+
+    def check(self, body):
+        if len(body.split()) < self.min_words:
+            return 'too few words'
+
+        non_space = [character for character in body if not character.isspace()]
+        letter_ratio = sum(character.isalpha() for character in non_space) / max(len(non_space), 1)
+        if letter_ratio < self.min_letter_ratio:
+            return 'too few letters'
+        return None
+
+
+class PrefilterPipeline:
+    """
+    Runs rules one after another, first rule which returns a reason rejects the joke.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+
+    def run(self, body):
+        """
+        Returns:
+            tuple: string: PASSED or REJECTED
+                   string: reason of rejection, None if joke passed
+        """
+        for rule in self.rules:
+            reason = rule.check(body)
+            if reason is not None:
+                return REJECTED, reason
+        return PASSED, None
+
+
+# Pipeline of the worker process, built once by `init_worker`
+worker_pipeline = None
+
+
+def init_worker(blocklist):
+    global worker_pipeline
+    worker_pipeline = PrefilterPipeline([
+        TextRule(min_words=3, min_letter_ratio=0.5),
+        SpamRule(max_links=0, max_uppercase_ratio=0.7),
+        BlocklistRule(blocklist),
+    ])
+
+
+def run_pipeline(joke_id, body):
+    decision, reason = worker_pipeline.run(body)
+    return joke_id, decision, reason
+
+
+def read_blocklist(filename):
+    """
+    Read blocklist file, one word or phrase per line, lines starting with # are ignored
+
+    Returns:
+        list of strings
+    """
+    try:
+        with open(filename, 'r', encoding='utf-8') as fp:
+            lines = [line.strip() for line in fp]
+    except FileNotFoundError:
+        logger.info('Blocklist file {} not found, blocklist is empty'.format(filename))
+        return []
+
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+class AutoModerator:
+    """
+    Class that runs new jokes through `PrefilterPipeline` in a process pool.
+
+    `self.submit` only schedules the check, so the submission handler isn't slowed down by it.
+    Decisions are stored in the joke's `prefilter_decision`/`prefilter_reason` columns:
+    obvious junk is rejected and hidden from moderators, jokes of trusted authors which passed are approved.
+
+    Authors are trusted for jokes approved by moderators and liked by voters, see `self.is_trusted_author`.
+    """
+
+    def __init__(self, Session, notifier, blocklist_filename, workers, trusted_author_jokes,
+                 trusted_author_wilson_score):
+        """
+        Arguments:
+            Session: sessionmaker, decisions are stored from the pool's callback thread
+            notifier: AuthorNotifier, authors are notified about auto-approved jokes
+            blocklist_filename: string
+            workers: int, number of worker processes
+            trusted_author_jokes: int, jokes approved by moderators from which passed jokes are approved
+                                  automatically
+            trusted_author_wilson_score: float, minimal average Wilson score of these jokes
+        """
+        self.Session = Session
+        self.notifier = notifier
+        self.trusted_author_jokes = trusted_author_jokes
+        self.trusted_author_wilson_score = trusted_author_wilson_score
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=init_worker,
+                                            initargs=(read_blocklist(blocklist_filename),))
+
+    def submit(self, joke):
+        """
+        Schedule prefilter check of a new joke.
+
+        Arguments:
+            joke: Joke, already committed
+        """
+        future = self.executor.submit(run_pipeline, joke.get_id(), joke.get_body())
+        future.add_done_callback(self.store_decision)
+
+    def is_trusted_author(self, session, author_id):
+        """
+        Return True if the author has at least `self.trusted_author_jokes` jokes approved by moderators, with
+        average Wilson score of at least `self.trusted_author_wilson_score`.
+
+        Auto-approved jokes don't count, so trust can't be gained without moderators. The score of the author
+        (`User.score`) isn't used, it grows with votes the user casts, not with votes for the user's jokes.
+        """
+        approved_jokes, wilson_score = session.query(func.count(Joke.id), func.avg(Joke.wilson_score)).\
+            filter(Joke.user_id == author_id, Joke.approved == True).\
+            filter(or_(Joke.prefilter_decision == None, Joke.prefilter_decision != APPROVED)).one()
+        return approved_jokes >= self.trusted_author_jokes and (wilson_score or 0) >= self.trusted_author_wilson_score
+
+    def store_decision(self, future):
+        """
+        Future callback. Store decision of the pipeline, approve joke of trusted author if it passed.
+        """
+        try:
+            joke_id, decision, reason = future.result()
+        except Exception as e:
+            logger.error('Prefilter failed: {}'.format(e))
+            return
+
+        session = self.Session()
+        try:
+            joke = session.query(Joke).filter(Joke.id == joke_id).first()
+            if joke is None or joke.is_approved():  # removed or approved by moderator in the meantime
+                return
+
+            if decision == PASSED and self.is_trusted_author(session, joke.user_id):
+                decision = APPROVED
+            joke.prefilter_decision = decision
+            joke.prefilter_reason = reason
+            if decision == APPROVED:
+                joke.approve()
+            session.commit()
+
+            if decision == APPROVED:
+                self.notifier.joke_approved(joke)
+        finally:
+            session.close()
+
+        logger.info('Prefilter decision for joke {id}: {decision} {reason}'.format(
+            id=joke_id, decision=decision, reason=reason or ''))
+
+    def shutdown(self):
+        # Without waiting, Python 3.7 deadlocks at exit if a worker is still busy with jokes being checked
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,157 @@
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from app.query_stats import get_update_name
+
+
+def get_function_label(filename, line, function):
+    return '{} ({}:{})'.format(function, os.path.basename(filename), line)
+
+
+class UpdateProfiler:
+    """
+    Class that profiles updates processed by the dispatcher on demand, for a limited time.
+
+    While a session runs, a sampler thread records the function the dispatcher thread is executing every
+    `sample_interval` seconds, which is cheap enough for all updates, and a `fraction` of updates is run under
+    cProfile for exact timings. Both are aggregated per update name (see `app.query_stats.get_update_name`).
+    Outside sessions the only overhead is one attribute check per update.
+    """
+
+    def __init__(self, sample_interval, top_functions):
+        """
+        Arguments:
+            sample_interval: float, seconds between samples
+            top_functions: int, functions listed per update name in the report
+        """
+        self.sample_interval = sample_interval
+        self.top_functions = top_functions
+
+        self.lock = threading.Lock()
+        self.active = False
+        self.reset()
+
+    def reset(self):
+        self.fraction = 0
+        self.start_time = None
+        self.dispatcher_thread_id = None
+        self.current_name = None  # name of update being processed, None between updates
+        self.updates = Counter()
+        self.profiled = Counter()
+        self.profiles = {}  # update name -> pstats.Stats
+        self.samples = defaultdict(Counter)  # update name -> function label -> samples
+        self.sampler = None
+
+    def start(self, fraction):
+        """
+        Arguments:
+            fraction: float between 0 and 1, share of updates run under cProfile
+
+        Returns:
+            bool, False if a session is already running
+        """
+        with self.lock:
+            if self.active:
+                return False
+            self.reset()
+            self.fraction = fraction
+            self.start_time = time.time()
+            self.active = True
+        self.sampler = threading.Thread(target=self.sample, name='profiler_sampler', daemon=True)
+        self.sampler.start()
+        return True
+
+    def stop(self):
+        """
+        End session
+
+        Returns:
+            string, report, None if no session was running
+        """
+        with self.lock:
+            if not self.active:
+                return None
+            self.active = False
+        self.sampler.join()
+        return self.format_report()
+
+    def sample(self):
+        while self.active:
+            time.sleep(self.sample_interval)
+            name = self.current_name
+            if name is None:
+                continue
+            frame = sys._current_frames().get(self.dispatcher_thread_id)
+            if frame is None:
+                continue
+            code = frame.f_code
+            self.samples[name][get_function_label(code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+    def instrument_dispatcher(self, dispatcher):
+        process_update = dispatcher.process_update
+
+        def profiled_process_update(update):
+            if not self.active:
+                return process_update(update)
+
+            name = get_update_name(update)
+            self.dispatcher_thread_id = threading.get_ident()
+            self.current_name = name
+            try:
+                if random.random() < self.fraction:
+                    profile = cProfile.Profile()
+                    profile.runcall(process_update, update)
+                    self.add_profile(name, profile)
+                else:
+                    process_update(update)
+            finally:
+                self.current_name = None
+                with self.lock:
+                    self.updates[name] += 1
+
+        dispatcher.process_update = profiled_process_update
+
+    def add_profile(self, name, profile):
+        with self.lock:
+            self.profiled[name] += 1
+            if name in self.profiles:
+                self.profiles[name].add(profile)
+            else:
+                self.profiles[name] = pstats.Stats(profile)
+
+    def format_report(self):
+        """
+        Return hot functions per update name: own time per profiled update from cProfile and share of samples
+
+        Returns:
+            string
+        """
+        lines = ['Profiled {} updates in {:.0f} s, {} under cProfile, {} samples'.format(
+            sum(self.updates.values()), time.time() - self.start_time, sum(self.profiled.values()),
+            sum(sum(samples.values()) for samples in self.samples.values()))]
+
+        for name, count in self.updates.most_common():
+            lines.append('')
+            lines.append('{}: {} updates, {} profiled'.format(name, count, self.profiled[name]))
+
+            stats = self.profiles.get(name)
+            if stats is not None:
+                profiled = self.profiled[name]
+                functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+                for (filename, line, function), (_, calls, own_time, cumulative_time, _) in functions[:self.top_functions]:
+                    lines.append('  {:8.2f} ms own {:8.2f} ms cum {:7.0f} calls  {}'.format(
+                        own_time * 1000 / profiled, cumulative_time * 1000 / profiled, calls / profiled,
+                        get_function_label(filename, line, function)))
+
+            samples = self.samples.get(name)
+            if samples:
+                total = sum(samples.values())
+                for label, count in samples.most_common(self.top_functions):
+                    lines.append('  {:6.1%} of samples  {}'.format(count / total, label))
+        return '\n'.join(lines)
@@ -0,0 +1,236 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+
+from sqlalchemy import event
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_STATEMENT_LENGTH = 500  # characters of a slow statement logged
+MAX_UPDATE_NAMES = 200  # further names (e.g. mistyped commands) are accounted as `other`
+
+# Rules making statements differing only in values identical, applied in order
+FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                  # string literals
+    (re.compile(r'%\(\w+\)s|:\w+|\$\d+'), '?'),            # named parameters
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),               # number literals
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),    # IN lists of any length
+    (re.compile(r'\s+'), ' '),
+]
+
+
+@lru_cache(maxsize=1024)  # statements are generated by the same code over and over
+def fingerprint(statement):
+    """
+    Return statement with literals and parameters replaced by `?`, equal for queries of the same shape
+    """
+    for pattern, replacement in FINGERPRINT_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def get_update_name(update):
+    """
+    Return name updates are accounted under, e.g. `/random_joke`, `callback vote`, `inline` or `text`
+    """
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query is not None:
+        return 'callback {}'.format((update.callback_query.data or '').split(':', 1)[0])
+    if update.inline_query is not None:
+        return 'inline'
+    message = update.effective_message
+    text = message.text if message is not None else None
+    if not text:
+        return 'other'
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0]
+    return 'text'
+
+
+class UpdateQueries:
+    """
+    Statements executed while processing one update
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.rows = 0  # rows reported by the driver, SQLite doesn't report rows of SELECTs
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def add(self, statement_fingerprint, rows, seconds):
+        self.queries += 1
+        self.rows += rows
+        self.seconds += seconds
+        self.fingerprints[statement_fingerprint] += 1
+
+    def repeated(self, threshold):
+        """
+        Return statements executed at least `threshold` times, usually lazy loads in a loop (N+1 queries)
+
+        Returns:
+            list of (fingerprint, count) tuples, most repeated first
+        """
+        return [(statement, count) for statement, count in self.fingerprints.most_common() if count >= threshold]
+
+    def assert_max_queries(self, max_queries):
+        """
+        Raises:
+            AssertionError: if more than `max_queries` statements were executed
+        """
+        if self.queries > max_queries:
+            raise AssertionError('{} executed {} queries, expected at most {}'.format(
+                self.name, self.queries, max_queries))
+
+    def assert_no_repeated(self, threshold):
+        """
+        Raises:
+            AssertionError: if a statement was executed at least `threshold` times
+        """
+        repeated = self.repeated(threshold)
+        if repeated:
+            statement, count = repeated[0]
+            raise AssertionError('{} executed {} times: {}'.format(self.name, count, statement))
+
+
+class QueryAccountant:
+    """
+    Class that accounts SQL statements per update using engine events.
+
+    `self.instrument_dispatcher` tracks every update processed by the dispatcher. Statements, rows and time are
+    aggregated per update name, statements repeated at least `repeated_threshold` times within one update are
+    logged as possible N+1 queries and statements slower than `slow_query_seconds` are logged with the update name
+    (or the thread name for jobs).
+    """
+
+    def __init__(self, slow_query_seconds, repeated_threshold):
+        """
+        Arguments:
+            slow_query_seconds: float
+            repeated_threshold: int, executions of one fingerprint within an update flagged as N+1
+        """
+        self.slow_query_seconds = slow_query_seconds
+        self.repeated_threshold = repeated_threshold
+
+        self.local = threading.local()  # `tracked`: list of UpdateQueries collecting statements of this thread
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: {'updates': 0, 'queries': 0, 'rows': 0, 'seconds': 0.0, 'repeated': 0})
+        self.repeated_fingerprints = Counter()  # fingerprint -> updates it was repeated in
+        self.slow_queries = 0
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - connection.info['query_start_times'].pop()
+        tracked = getattr(self.local, 'tracked', None)
+
+        if seconds >= self.slow_query_seconds:
+            name = tracked[-1].name if tracked else threading.current_thread().name
+            with self.lock:
+                self.slow_queries += 1
+            logger.warning('Slow query in {} ({:.0f} ms): {}'.format(
+                name, seconds * 1000, statement[:SLOW_QUERY_STATEMENT_LENGTH]))
+
+        if tracked:
+            statement_fingerprint = fingerprint(statement)
+            rows = max(cursor.rowcount, 0)
+            for update_queries in tracked:
+                update_queries.add(statement_fingerprint, rows, seconds)
+
+    @contextmanager
+    def track(self, name, aggregate=True):
+        """
+        Collect statements executed by this thread inside the block, blocks can be nested
+
+        Arguments:
+            name: string, e.g. command
+            aggregate: bool, False to leave statistics and the N+1 log alone, e.g. for assertions in benchmarks
+
+        Returns:
+            context manager yielding UpdateQueries
+        """
+        update_queries = UpdateQueries(name)
+        if getattr(self.local, 'tracked', None) is None:
+            self.local.tracked = []
+        self.local.tracked.append(update_queries)
+        try:
+            yield update_queries
+        finally:
+            self.local.tracked.remove(update_queries)
+            if aggregate:
+                self.aggregate(update_queries)
+
+    def aggregate(self, update_queries):
+        repeated = update_queries.repeated(self.repeated_threshold)
+        with self.lock:
+            name = update_queries.name
+            if name not in self.totals and len(self.totals) >= MAX_UPDATE_NAMES:
+                name = 'other'
+            totals = self.totals[name]
+            totals['updates'] += 1
+            totals['queries'] += update_queries.queries
+            totals['rows'] += update_queries.rows
+            totals['seconds'] += update_queries.seconds
+            if repeated:
+                totals['repeated'] += 1
+            for statement, _ in repeated:
+                self.repeated_fingerprints[statement] += 1
+
+        for statement, count in repeated:
+            logger.warning('Possible N+1 queries in {}, executed {} times: {}'.format(
+                update_queries.name, count, statement[:SLOW_QUERY_STATEMENT_LENGTH]))
+
+    def instrument_dispatcher(self, dispatcher):
+        """
+        Track statements of every update processed by the dispatcher
+        """
+        process_update = dispatcher.process_update
+
+        def tracked_process_update(update):
+            with self.track(get_update_name(update)):
+                process_update(update)
+
+        dispatcher.process_update = tracked_process_update
+
+    def get_stats(self):
+        """
+        Returns:
+            dict
+        """
+        with self.lock:
+            return {
+                'commands': {name: dict(totals) for name, totals in self.totals.items()},
+                'repeated_fingerprints': self.repeated_fingerprints.most_common(),
+                'slow_queries': self.slow_queries,
+            }
+
+    def format_stats(self, limit=5):
+        """
+        Return updates with most queries on average and statements most often repeated
+
+        Returns:
+            string
+        """
+        stats = self.get_stats()
+        commands = sorted(stats['commands'].items(), key=lambda item: item[1]['queries'] / item[1]['updates'],
+                          reverse=True)[:limit]
+        lines = ['queries: {} slow'.format(stats['slow_queries'])]
+        for name, totals in commands:
+            lines.append('{} {:.1f} queries, {:.1f} ms per update, N+1 in {}/{}'.format(
+                name, totals['queries'] / totals['updates'], totals['seconds'] * 1000 / totals['updates'],
+                totals['repeated'], totals['updates']))
+        for statement, updates in stats['repeated_fingerprints'][:limit]:
+            lines.append('N+1 in {} updates: {}'.format(updates, statement[:200]))
+        return '\n'.join(lines)
@@ -0,0 +1,173 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from telegram.ext import DispatcherHandlerStop
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Class that limits the number of updates every user can send, before they reach the handlers.
+
+    Every private chat, and every user within a group chat, has a token bucket per command class (e.g. cheap reads,
+    expensive reads, writes), so members of a group voting on the same message don't use up each other's tokens.
+    `self.check_update` is registered with a `TypeHandler` in a group that runs before all other handlers and
+    stops the update with `DispatcherHandlerStop` when the bucket is empty.
+
+    A bucket that has been idle long enough to refill is equivalent to a missing one, so such buckets are
+    dropped by `self.evict_idle`. The number of buckets is also capped, least recently used ones are dropped first.
+    """
+
+    def __init__(self, responses, limits, command_classes, default_class, max_buckets):
+        """
+        Arguments:
+            responses: TelegramBotResponses, used for the reply to rejected updates
+            limits: dict, command class -> (capacity, tokens added per second)
+            command_classes: dict, command (e.g. '/my_jokes') or update type ('callback_query', 'inline_query',
+                             'text') -> command class
+            default_class: string, command class of commands missing in `command_classes`
+            max_buckets: int, maximum number of buckets kept in memory
+        """
+        self.responses = responses
+        self.limits = limits
+        self.command_classes = command_classes
+        self.default_class = default_class
+        self.max_buckets = max_buckets
+
+        self.lock = Lock()
+        self.buckets = OrderedDict()  # (sender, command class) -> [tokens, updated at, rejection replied], LRU
+        self.allowed = {command_class: 0 for command_class in limits}
+        self.blocked = {command_class: 0 for command_class in limits}
+        self.evicted = 0
+
+    def classify(self, update):
+        """
+        Return command class of update
+
+        Returns:
+            string
+        """
+        if update.callback_query is not None:
+            return self.command_classes['callback_query']
+        if update.inline_query is not None:
+            return self.command_classes['inline_query']
+
+        message = update.effective_message
+        text = message.text if message is not None else None
+        if not text:
+            return self.default_class
+        if text.startswith('/'):
+            command = text.split()[0].split('@')[0]
+            return self.command_classes.get(command, self.default_class)
+        return self.command_classes['text']
+
+    def get_sender(self, update):
+        """
+        Return key of the sender whose bucket is used: chat id for private chats, (chat id, user id) tuple for
+        updates from users in groups, user id for inline queries which have no chat
+
+        Returns:
+            int or tuple
+        """
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None:
+            return user.id
+        if chat.type == 'private' or user is None:  # channel posts have no user
+            return chat.id
+        return chat.id, user.id
+
+    def take_token(self, key, command_class, now):
+        """
+        Take a token from bucket, refilled for the time since it was last used.
+
+        Returns:
+            tuple: bool: True if there was a token
+                   bool: True if this is the first rejection since the bucket was last allowed
+        """
+        capacity, rate = self.limits[command_class]
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [capacity, now, False]
+                self.buckets[key] = bucket
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                self.allowed[command_class] += 1
+                return True, False
+
+            first_rejection = not bucket[2]
+            bucket[2] = True
+            self.blocked[command_class] += 1
+            return False, first_rejection
+
+    def check_update(self, bot, update):
+        """
+        TypeHandler callback. Stop update if sender has no token left for its command class.
+
+        Only the first rejected update gets a reply, later ones are dropped silently until a token is available.
+
+        Raises:
+            DispatcherHandlerStop
+        """
+        command_class = self.classify(update)
+        allowed, first_rejection = self.take_token((self.get_sender(update), command_class), command_class, time.time())
+        if allowed:
+            return
+
+        if update.callback_query is not None:
+            # Callback queries have to be answered, otherwise the button keeps spinning
+            update.callback_query.answer(text=self.responses.get_one_response('rate_limited'))
+        elif first_rejection and update.effective_message is not None:
+            update.effective_message.reply_text(self.responses.get_one_response('rate_limited'))
+
+        raise DispatcherHandlerStop
+
+    def evict_idle(self, bot=None, job=None):
+        """
+        Job callback. Drop buckets which have refilled since they were last used.
+        """
+        now = time.time()
+        with self.lock:
+            idle = [key for key, (tokens, updated_at, replied) in self.buckets.items()
+                    if tokens + (now - updated_at) * self.limits[key[1]][1] >= self.limits[key[1]][0]]
+            for key in idle:
+                del self.buckets[key]
+            self.evicted += len(idle)
+
+    def get_stats(self):
+        """
+        Returns:
+            dict
+        """
+        with self.lock:
+            return {
+                'buckets': len(self.buckets),
+                'evicted': self.evicted,
+                'allowed': dict(self.allowed),
+                'blocked': dict(self.blocked),
+            }
+
+    def format_stats(self):
+        """
+        Returns:
+            string
+        """
+        stats = self.get_stats()
+        blocked = ', '.join('{} {}/{}'.format(command_class, stats['blocked'][command_class],
+                                              stats['allowed'][command_class] + stats['blocked'][command_class])
+                            for command_class in sorted(self.limits))
+        return 'rate limiter: {buckets} buckets, {evicted} evicted, blocked {blocked}'.format(
+            buckets=stats['buckets'], evicted=stats['evicted'], blocked=blocked)
@@ -0,0 +1,187 @@
+import logging
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from sqlalchemy import create_engine, func, select
+
+from app.models import association_table
+
+logger = logging.getLogger(__name__)
+
+
+def load_votes(connection):
+    """
+    Stream votes from `association` table.
+
+    A positive vote is stored twice (in `jokes_voted_for` and `jokes_voted_positive`), a negative one once.
+
+    Returns:
+        generator of (user id, joke id, +1 or -1) tuples
+    """
+    votes = func.count().label('votes')
+    query = select([association_table.c.users_id, association_table.c.jokes_id, votes]).\
+        group_by(association_table.c.users_id, association_table.c.jokes_id)
+
+    result = connection.execution_options(stream_results=True).execute(query)
+    for user_id, joke_id, vote_rows in result:
+        yield user_id, joke_id, 1 if vote_rows > 1 else -1
+
+
+def build_neighbours(database_url, neighbours_count, block_size=1000):
+    """
+    Compute `neighbours_count` most similar jokes for every joke from the vote matrix.
+
+    Similarity is cosine similarity of joke columns of the sparse user x joke matrix of votes.
+    It is computed for `block_size` jokes at once, so the full joke x joke matrix never exists in memory.
+    Runs in a worker process.
+
+    Returns:
+        dict: joke id -> list of (joke id, similarity) tuples, most similar first
+    """
+    # Imported here, only the worker process needs them
+    import numpy as np
+    from scipy import sparse
+
+    engine = create_engine(database_url)
+    user_ids, joke_ids, values = [], [], []
+    with engine.connect() as connection:
+        for user_id, joke_id, value in load_votes(connection):
+            user_ids.append(user_id)
+            joke_ids.append(joke_id)
+            values.append(value)
+    engine.dispose()
+
+    if not values:
+        return {}
+
+    user_index, user_rows = np.unique(np.array(user_ids), return_inverse=True)
+    joke_index, joke_columns = np.unique(np.array(joke_ids), return_inverse=True)
+    matrix = sparse.csr_matrix((np.array(values, dtype=np.float32), (user_rows, joke_columns)),
+                               shape=(len(user_index), len(joke_index)))
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1
+    matrix = (matrix @ sparse.diags(1 / norms)).tocsc()
+    transposed = matrix.T.tocsr()
+
+    neighbours = {}
+    for start in range(0, len(joke_index), block_size):
+        stop = min(start + block_size, len(joke_index))
+        similarities = (transposed[start:stop] @ matrix).tocsr()
+        for row in range(stop - start):
+            row_start, row_stop = similarities.indptr[row], similarities.indptr[row + 1]
+            columns = similarities.indices[row_start:row_stop]
+            scores = similarities.data[row_start:row_stop]
+
+            keep = (columns != start + row) & (scores > 0)
+            columns, scores = columns[keep], scores[keep]
+            if len(scores) > neighbours_count:
+                best = np.argpartition(-scores, neighbours_count)[:neighbours_count]
+                columns, scores = columns[best], scores[best]
+            order = np.argsort(-scores)
+            neighbours[int(joke_index[start + row])] = [(int(joke_index[column]), float(score))
+                                                         for column, score in zip(columns[order], scores[order])]
+    return neighbours
+
+
+class Recommender:
+    """
+    Class that recommends jokes similar to the ones the user laughed at.
+
+    Neighbours of every joke are rebuilt from the whole vote matrix in a background process (`self.rebuild`).
+    Between rebuilds new positive votes are added to `self.co_votes`, so jokes liked by the same users are
+    recommended together right away. Serving a recommendation only looks up neighbours of the user's likes.
+    """
+
+    def __init__(self, database_url, neighbours_count, recent_likes_count):
+        """
+        Arguments:
+            database_url: string, the worker process opens its own connection
+            neighbours_count: int, number of neighbours stored for every joke
+            recent_likes_count: int, number of user's latest likes used to recommend jokes
+        """
+        self.database_url = database_url
+        self.neighbours_count = neighbours_count
+        self.recent_likes_count = recent_likes_count
+
+        self.executor = ProcessPoolExecutor(max_workers=1)
+        self.rebuild_running = False
+        self.lock = Lock()
+        self.neighbours = {}
+        self.co_votes = defaultdict(lambda: defaultdict(int))  # joke id -> {joke id: likes by same users since rebuild}
+        self.recent_likes = {}  # user id -> deque of joke ids
+
+    def rebuild(self, bot=None, job=None):
+        """
+        Job callback. Start rebuilding neighbours in the worker process, unless a rebuild is already running.
+        """
+        if self.rebuild_running:
+            return
+
+        self.rebuild_running = True
+        future = self.executor.submit(build_neighbours, self.database_url, self.neighbours_count)
+        future.add_done_callback(self.rebuild_done)
+
+    def rebuild_done(self, future):
+        self.rebuild_running = False
+        try:
+            neighbours = future.result()
+        except Exception as e:
+            logger.error('Recommender rebuild failed: {}'.format(e))
+            return
+
+        with self.lock:
+            self.neighbours = neighbours
+            self.co_votes = defaultdict(lambda: defaultdict(int))
+        logger.info('Recommender rebuilt with {} jokes'.format(len(neighbours)))
+
+    def record_vote(self, user_id, joke_id, positive):
+        """
+        Update co-votes with a new vote. Only positive votes are used.
+        """
+        if not positive:
+            return
+
+        with self.lock:
+            likes = self.recent_likes.setdefault(user_id, deque(maxlen=self.recent_likes_count))
+            for liked_joke_id in likes:
+                self.co_votes[liked_joke_id][joke_id] += 1
+                self.co_votes[joke_id][liked_joke_id] += 1
+            likes.append(joke_id)
+
+    def get_recent_likes(self, user_id):
+        """
+        Returns:
+            list of joke ids, empty if the user hasn't liked anything since the bot started
+        """
+        with self.lock:
+            return list(self.recent_likes.get(user_id, ()))
+
+    def recommend(self, liked_joke_ids, count):
+        """
+        Return jokes most similar to liked jokes
+
+        Arguments:
+            liked_joke_ids: iterable of ints
+            count: int, maximum number of jokes returned
+
+        Returns:
+            list of joke ids, best first, may contain jokes the user has already seen
+        """
+        liked_joke_ids = set(liked_joke_ids)
+        scores = defaultdict(float)
+        with self.lock:
+            for liked_joke_id in liked_joke_ids:
+                for joke_id, similarity in self.neighbours.get(liked_joke_id, ()):
+                    scores[joke_id] += similarity
+                for joke_id, co_votes in self.co_votes.get(liked_joke_id, {}).items():
+                    scores[joke_id] += co_votes / (co_votes + 1)
+
+        candidates = [joke_id for joke_id in scores if joke_id not in liked_joke_ids]
+        candidates.sort(key=lambda joke_id: scores[joke_id], reverse=True)
+        return candidates[:count]
+
+    def shutdown(self):
+        # Without waiting, Python 3.7 deadlocks at exit if a worker is still busy with a running rebuild
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,236 @@
+"""
+Reconciliation of denormalized vote counters with the `association` table.
+
+`Joke.vote_count`, `positive_votes`, `negative_votes`, `hah_ratio`, `wilson_score` and `User.score` are updated in
+Python on every vote and drift after failed commits or removed jokes. Drifted rows are found with one aggregate
+query per key range and only those are rewritten, each batch in its own short transaction.
+
+Usage, from the repository root, to reconcile once (the bot also runs it as a job):
+    python -m app.reconcile --database-url sqlite:///hahornah.db
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, func, select, text
+
+from app.models import Joke, User, wilson_lower_bound
+
+logger = logging.getLogger(__name__)
+
+EXAMPLES_KEPT = 10  # drifted rows kept in a report
+NULL_VALUE = -2 ** 31  # stands for NULL in comparisons of old values, counters can be negative
+
+# A positive vote is stored twice in `association` table, a negative one once
+JOKE_DRIFT = text("""
+SELECT jokes.id, jokes.positive_votes, jokes.negative_votes, jokes.vote_count,
+       COALESCE(counts.positive_votes, 0), COALESCE(counts.negative_votes, 0)
+FROM jokes
+LEFT JOIN (
+    SELECT jokes_id,
+           SUM(CASE WHEN votes > 1 THEN 1 ELSE 0 END) AS positive_votes,
+           SUM(CASE WHEN votes = 1 THEN 1 ELSE 0 END) AS negative_votes
+    FROM (SELECT users_id, jokes_id, COUNT(*) AS votes FROM association
+          WHERE jokes_id >= :start AND jokes_id < :stop
+          GROUP BY jokes_id, users_id) user_votes
+    GROUP BY jokes_id
+) counts ON counts.jokes_id = jokes.id
+WHERE jokes.id >= :start AND jokes.id < :stop
+  AND (jokes.positive_votes IS NULL OR jokes.negative_votes IS NULL OR jokes.vote_count IS NULL
+       OR jokes.positive_votes != COALESCE(counts.positive_votes, 0)
+       OR jokes.negative_votes != COALESCE(counts.negative_votes, 0)
+       OR jokes.vote_count != COALESCE(counts.positive_votes, 0) - COALESCE(counts.negative_votes, 0))
+""")
+
+USER_DRIFT = text("""
+SELECT users.id, users.score,
+       COALESCE(SUM(CASE WHEN user_votes.votes > 1 THEN 1 WHEN user_votes.votes = 1 THEN -1 ELSE 0 END), 0)
+FROM users
+LEFT JOIN (SELECT users_id, jokes_id, COUNT(*) AS votes FROM association
+           WHERE users_id >= :start AND users_id < :stop
+           GROUP BY users_id, jokes_id) user_votes ON user_votes.users_id = users.id
+WHERE users.id >= :start AND users.id < :stop
+GROUP BY users.id, users.score
+HAVING users.score IS NULL
+    OR users.score != COALESCE(SUM(CASE WHEN user_votes.votes > 1 THEN 1 WHEN user_votes.votes = 1 THEN -1 ELSE 0 END), 0)
+""")
+
+# Rows are only rewritten if they still hold the values read, a vote cast in between is fixed by the next run
+FIX_JOKE = text("""
+UPDATE jokes SET positive_votes = :positive_votes, negative_votes = :negative_votes, vote_count = :vote_count,
+                 hah_ratio = :hah_ratio, wilson_score = :wilson_score
+WHERE id = :id AND COALESCE(positive_votes, :null) = :old_positive_votes
+  AND COALESCE(negative_votes, :null) = :old_negative_votes AND COALESCE(vote_count, :null) = :old_vote_count
+""")
+
+FIX_USER = text("""
+UPDATE users SET score = :score WHERE id = :id AND COALESCE(score, :null) = :old_score
+""")
+
+
+def get_key_ranges(connection, column, batch_size):
+    """
+    Split values of an indexed integer column into ranges of `batch_size` rows, ids don't have to be dense
+
+    Returns:
+        generator of (start, stop) tuples, `stop` is exclusive
+    """
+    start, last = connection.execute(select([func.min(column), func.max(column)])).first()
+    while start is not None:
+        stop = connection.execute(select([column]).where(column >= start).
+                                  order_by(column).offset(batch_size).limit(1)).scalar()
+        yield start, stop if stop is not None else last + 1
+        start = stop
+
+
+class VoteReconciler:
+    """
+    Class that finds and fixes drifted vote counters of jokes and scores of users, see module docstring.
+
+    Runs in its own thread, so the job queue isn't blocked, and pauses between batches to leave the database
+    to the handlers.
+    """
+
+    def __init__(self, engine, batch_size, pause):
+        """
+        Arguments:
+            engine: Engine
+            batch_size: int, rows checked per transaction
+            pause: float, seconds between batches
+        """
+        self.engine = engine
+        self.batch_size = batch_size
+        self.pause = pause
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = False
+        self.last_report = None
+
+    def run(self, bot=None, job=None):
+        """
+        Job callback. Start reconciliation in the worker thread, unless it is already running.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.executor.submit(self.reconcile).add_done_callback(self.reconcile_done)
+
+    def reconcile_done(self, future):
+        self.running = False
+        try:
+            future.result()
+        except Exception as e:
+            logger.error('Reconciliation failed: {}'.format(e))
+
+    def reconcile(self):
+        """
+        Returns:
+            dict: `jokes` and `users` -> dict with numbers of checked, drifted, fixed and skipped rows
+                  and examples of drifted rows
+        """
+        start_time = time.time()
+        report = {
+            'jokes': self.reconcile_table(Joke.__table__.c.id, JOKE_DRIFT, self.fix_joke),
+            'users': self.reconcile_table(User.__table__.c.id, USER_DRIFT, self.fix_user),
+            'seconds': time.time() - start_time,
+        }
+        self.last_report = report
+
+        message = 'Reconciled in {:.1f} s: {}'.format(report['seconds'], self.format_report(report))
+        if report['jokes']['drifted'] or report['users']['drifted']:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        return report
+
+    def reconcile_table(self, column, drift_query, fix):
+        report = {'checked': 0, 'drifted': 0, 'fixed': 0, 'skipped': 0, 'examples': []}
+        with self.engine.connect() as connection:
+            key_ranges = list(get_key_ranges(connection, column, self.batch_size))
+
+        for start, stop in key_ranges:
+            with self.engine.begin() as connection:
+                report['checked'] += connection.execute(
+                    select([func.count()]).select_from(column.table).where(column >= start).where(column < stop)).scalar()
+                for row in connection.execute(drift_query, start=start, stop=stop).fetchall():
+                    report['drifted'] += 1
+                    if len(report['examples']) < EXAMPLES_KEPT:
+                        report['examples'].append(tuple(row))
+                    if fix(connection, row):
+                        report['fixed'] += 1
+                    else:
+                        report['skipped'] += 1
+            time.sleep(self.pause)
+        return report
+
+    def fix_joke(self, connection, row):
+        """
+        Returns:
+            bool, False if the joke changed since it was read
+        """
+        joke_id, old_positive_votes, old_negative_votes, old_vote_count, positive_votes, negative_votes = row
+        total = positive_votes + negative_votes
+        result = connection.execute(FIX_JOKE, {
+            'id': joke_id,
+            'positive_votes': positive_votes,
+            'negative_votes': negative_votes,
+            'vote_count': positive_votes - negative_votes,
+            'hah_ratio': positive_votes / total if total else 0,
+            'wilson_score': wilson_lower_bound(positive_votes, negative_votes),
+            'old_positive_votes': NULL_VALUE if old_positive_votes is None else old_positive_votes,
+            'old_negative_votes': NULL_VALUE if old_negative_votes is None else old_negative_votes,
+            'old_vote_count': NULL_VALUE if old_vote_count is None else old_vote_count,
+            'null': NULL_VALUE,
+        })
+        return result.rowcount == 1
+
+    def fix_user(self, connection, row):
+        """
+        Returns:
+            bool, False if the user changed since it was read
+        """
+        user_id, old_score, score = row
+        result = connection.execute(FIX_USER, {'id': user_id, 'score': score, 'null': NULL_VALUE,
+                                               'old_score': NULL_VALUE if old_score is None else old_score})
+        return result.rowcount == 1
+
+    def format_report(self, report):
+        """
+        Returns:
+            string
+        """
+        return ', '.join('{} {checked} checked, {drifted} drifted, {fixed} fixed, {skipped} skipped'.format(
+            table, **report[table]) for table in ('jokes', 'users'))
+
+    def format_stats(self):
+        if self.last_report is None:
+            return 'reconciliation: not run yet'
+        return 'reconciliation: {}'.format(self.format_report(self.last_report))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute denormalized vote counters from votes')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0, help='seconds between batches')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not arguments.database_url:
+        parser.error('Missing database url, pass --database-url or set DATABASE_URL')
+
+    reconciler = VoteReconciler(create_engine(arguments.database_url), arguments.batch_size, arguments.pause)
+    report = reconciler.reconcile()
+    for table in ('jokes', 'users'):
+        for example in report[table]['examples']:
+            print('{} drifted: {}'.format(table, example))
+    reconciler.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Objects whose `id` is a user or chat id
+IDENTITY_KEYS = {'chat', 'from', 'user', 'forward_from', 'forward_from_chat', 'left_chat_member', 'new_chat_members'}
+NAME_KEYS = {'first_name', 'last_name', 'username', 'title', 'phone_number'}
+TEXT_KEYS = {'text', 'query', 'caption'}
+# Heavy or personal payloads which handlers don't use
+DROPPED_KEYS = {'photo', 'document', 'audio', 'voice', 'video', 'sticker', 'contact', 'location', 'venue'}
+
+WORD_CHARACTER = re.compile(r'\w', re.UNICODE)
+
+
+class UpdateRecorder:
+    """
+    Class that writes incoming updates to a gzip-compressed JSON lines log, for replaying them later.
+
+    User and chat ids are replaced by pseudonyms derived with a secret key that is never written. Pseudonyms stay
+    the same within a log and across restarts with the same key, but can't be traced back to ids. Names are removed
+    and every letter and digit of texts is replaced with `x`, except commands, numbers and `preserved_texts`
+    (e.g. keyboard buttons), so conversation flows and text lengths are kept.
+    """
+
+    def __init__(self, filename, preserved_texts, key=None):
+        """
+        Arguments:
+            filename: string, log is appended to the file if it exists
+            preserved_texts: iterable of strings, texts recorded as they are
+            key: string, secret key of pseudonyms. A random one is used if not given, then the same user gets
+                 a different pseudonym after a restart
+        """
+        self.filename = filename
+        self.preserved_texts = set(preserved_texts)
+        if key is None:
+            logger.warning('No key for pseudonyms given, ids in {} will change after a restart'.format(filename))
+            self.key = os.urandom(32)
+        else:
+            self.key = key.encode('utf-8')
+
+        self.lock = Lock()
+        self.file = gzip.open(filename, 'at', encoding='utf-8')
+        self.recorded = 0
+
+    def pseudonymize_id(self, identifier):
+        """
+        Returns:
+            int with the same sign as `identifier`, group chat ids are negative
+        """
+        digest = hmac.new(self.key, str(abs(identifier)).encode('ascii'), hashlib.sha256).digest()
+        pseudonym = int.from_bytes(digest[:4], 'big') % 1000000000 + 1
+        return -pseudonym if identifier < 0 else pseudonym
+
+    def anonymize_text(self, text):
+        if text in self.preserved_texts or text.isdigit():
+            return text
+        if text.startswith('/'):
+            command, separator, arguments = text.partition(' ')
+            return command + separator + WORD_CHARACTER.sub('x', arguments)
+        return WORD_CHARACTER.sub('x', text)
+
+    def anonymize(self, value, identity=False):
+        """
+        Return copy of update dict with personal data replaced
+
+        Arguments:
+            value: dict, list or value from `Update.to_dict()`
+            identity: bool, True if `value` is a user or a chat
+        """
+        if isinstance(value, list):
+            return [self.anonymize(item, identity) for item in value]
+        if not isinstance(value, dict):
+            return value
+
+        anonymized = {}
+        for key, item in value.items():
+            if key in DROPPED_KEYS:
+                continue
+            if key in NAME_KEYS:
+                anonymized[key] = 'x'
+            elif key in TEXT_KEYS and isinstance(item, str):
+                anonymized[key] = self.anonymize_text(item)
+            elif key == 'id' and identity:
+                anonymized[key] = self.pseudonymize_id(item)
+            else:
+                anonymized[key] = self.anonymize(item, identity=key in IDENTITY_KEYS)
+        return anonymized
+
+    def record(self, bot, update):
+        """
+        TypeHandler callback. Append anonymized update to the log, never stops the update.
+        """
+        line = json.dumps({'time': time.time(), 'update': self.anonymize(update.to_dict())})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.recorded += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info('Recorded {} updates to {}'.format(self.recorded, self.filename))
+
+
+def read_update_log(filename):
+    """
+    Read log up to its end or up to where it's truncated, e.g. by a bot killed before closing it
+
+    Returns:
+        generator of (time, update dict) tuples, in recorded order
+    """
+    records = 0
+    with gzip.open(filename, 'rt', encoding='utf-8') as fp:
+        try:
+            for line in fp:
+                if not line.endswith('\n'):  # last line written partially
+                    raise EOFError('incomplete line')
+                record = json.loads(line)
+                yield record['time'], record['update']
+                records += 1
+        except (EOFError, OSError, zlib.error, ValueError) as e:
+            logger.warning('Update log {} is truncated after {} updates ({}), the rest is skipped'.format(
+                filename, records, e))
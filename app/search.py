@@ -0,0 +1,106 @@
+import logging
+import re
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Full-text index is created by migration 7f3a9c1d5e24: `jokes.search_vector` with a GIN index on PostgreSQL,
+# `jokes_fts` FTS5 table on SQLite. Both are kept up to date by triggers.
+POSTGRESQL_SEARCH = """
+SELECT jokes.id, jokes.body, ts_rank(jokes.search_vector, query) AS score
+FROM jokes, plainto_tsquery('english', :query) query
+WHERE jokes.approved AND jokes.search_vector @@ query {keyset}
+ORDER BY score DESC, jokes.id
+LIMIT :limit
+"""
+# ts_rank is real, the cursor score comes back as double precision and wouldn't compare equal without the cast
+POSTGRESQL_KEYSET = """
+AND (ts_rank(jokes.search_vector, query) < CAST(:score AS real)
+     OR (ts_rank(jokes.search_vector, query) = CAST(:score AS real) AND jokes.id > :id))
+"""
+
+# bm25() is lower for better matches
+SQLITE_SEARCH = """
+SELECT jokes.id, jokes.body, bm25(jokes_fts) AS score
+FROM jokes_fts JOIN jokes ON jokes.id = jokes_fts.rowid
+WHERE jokes_fts MATCH :query AND jokes.approved {keyset}
+ORDER BY score, jokes.id
+LIMIT :limit
+"""
+SQLITE_KEYSET = """
+AND (bm25(jokes_fts) > :score OR (bm25(jokes_fts) = :score AND jokes.id > :id))
+"""
+
+
+class JokeSearch:
+    """
+    Class that searches approved jokes by text using the full-text index of the database.
+
+    Results are ranked and paginated with a keyset cursor (score and id of the last joke shown),
+    so every page costs the same no matter how far the user has scrolled.
+    """
+
+    def __init__(self, dialect_name, page_size):
+        """
+        Arguments:
+            dialect_name: string, name of SQLAlchemy dialect, `postgresql` or `sqlite`
+            page_size: int, number of jokes on one page
+        """
+        self.page_size = page_size
+        if dialect_name == 'sqlite':
+            self.statement, self.keyset = SQLITE_SEARCH, SQLITE_KEYSET
+        else:
+            self.statement, self.keyset = POSTGRESQL_SEARCH, POSTGRESQL_KEYSET
+        self.dialect_name = dialect_name
+
+    def prepare_query(self, query_text):
+        """
+        Return search query for database, None if there is nothing to search for.
+
+        Words are quoted for FTS5, so that user input can't be interpreted as FTS5 query syntax.
+
+        Returns:
+            string
+        """
+        words = WORD.findall(query_text)
+        if not words:
+            return None
+
+        if self.dialect_name == 'sqlite':
+            return ' '.join('"{}"'.format(word) for word in words)
+        return ' '.join(words)
+
+    def search(self, session, query_text, cursor=None):
+        """
+        Return one page of approved jokes matching query
+
+        Arguments:
+            session: Session
+            query_text: string, words to search for
+            cursor: tuple (score, id) returned with previous page, None for first page
+
+        Returns:
+            tuple: list of (id, body) tuples
+                   tuple (score, id) to get next page, None if this is the last page
+        """
+        query = self.prepare_query(query_text)
+        if query is None:
+            return [], None
+
+        parameters = {'query': query, 'limit': self.page_size + 1}
+        keyset = ''
+        if cursor is not None:
+            keyset = self.keyset
+            parameters['score'], parameters['id'] = cursor
+
+        rows = session.execute(text(self.statement.format(keyset=keyset)), parameters).fetchall()
+
+        next_cursor = None
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            next_cursor = (rows[-1].score, rows[-1].id)
+
+        return [(row.id, row.body) for row in rows], next_cursor
@@ -0,0 +1,200 @@
+import calendar
+import heapq
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import func
+
+from app.models import association_table
+
+logger = logging.getLogger(__name__)
+
+# Scores are stored multiplied by exp(decay_rate * (t - reference_time)), rebased before they overflow
+MAX_EXPONENT = 500
+MIN_SCORE = 1e-3
+
+
+class TrendingJokes:
+    """
+    Class that keeps exponentially decayed vote scores of jokes and a heap of the top jokes.
+
+    Every hah adds 1 to the joke's score, and scores halve every `half_life` seconds. Instead of decaying all
+    scores over time, new votes are weighted by exp(decay_rate * (t - reference_time)), which keeps the order
+    of jokes the same and makes a vote an O(1) update.
+    """
+
+    def __init__(self, half_life, size, snapshot_filename):
+        """
+        Arguments:
+            half_life: int, number of seconds after which a vote counts half
+            size: int, number of top jokes kept in the heap
+            snapshot_filename: string, file where scores are saved so they survive a restart
+        """
+        self.half_life = half_life
+        self.decay_rate = math.log(2) / half_life
+        self.size = size
+        self.snapshot_filename = snapshot_filename
+
+        self.lock = Lock()
+        self.reference_time = time.time()
+        self.scores = {}  # joke id -> scaled score
+        self.heap = []  # [scaled score, joke id] entries of top jokes, min-heap
+        self.heap_entries = {}  # joke id -> its heap entry
+        self.heap_dirty = False  # heap entry was increased in place and heap needs to be fixed
+
+    def rebase(self, reference_time):
+        """
+        Rescale scores to a new reference time and forget jokes whose score has decayed away.
+
+        Has to be called with `self.lock` acquired.
+        """
+        factor = math.exp(-self.decay_rate * (reference_time - self.reference_time))
+        self.scores = {joke_id: score * factor for joke_id, score in self.scores.items() if score * factor >= MIN_SCORE}
+        self.reference_time = reference_time
+
+        top = heapq.nlargest(self.size, self.scores.items(), key=lambda item: item[1])
+        self.heap = [[score, joke_id] for joke_id, score in top]
+        heapq.heapify(self.heap)
+        self.heap_entries = {entry[1]: entry for entry in self.heap}
+        self.heap_dirty = False
+
+    def record_vote(self, joke_id, timestamp=None):
+        """
+        Add a positive vote to joke's score
+
+        Arguments:
+            joke_id: int
+            timestamp: float, time of the vote in seconds since epoch, now if None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            exponent = self.decay_rate * (timestamp - self.reference_time)
+            if exponent > MAX_EXPONENT:
+                self.rebase(timestamp)
+                exponent = 0
+
+            score = self.scores.get(joke_id, 0) + math.exp(exponent)
+            self.scores[joke_id] = score
+
+            entry = self.heap_entries.get(joke_id)
+            if entry is not None:
+                entry[0] = score
+                self.heap_dirty = True
+                return
+
+            if len(self.heap) < self.size:
+                entry = [score, joke_id]
+                heapq.heappush(self.heap, entry)
+                self.heap_entries[joke_id] = entry
+                return
+
+            if self.heap_dirty:
+                heapq.heapify(self.heap)
+                self.heap_dirty = False
+
+            if score > self.heap[0][0]:
+                entry = [score, joke_id]
+                evicted = heapq.heapreplace(self.heap, entry)
+                del self.heap_entries[evicted[1]]
+                self.heap_entries[joke_id] = entry
+
+    def forget(self, joke_id):
+        """
+        Remove joke, e.g. after it was deleted
+        """
+        with self.lock:
+            self.scores.pop(joke_id, None)
+            entry = self.heap_entries.pop(joke_id, None)
+            if entry is not None:
+                self.heap.remove(entry)
+                heapq.heapify(self.heap)
+
+    def top(self, count):
+        """
+        Return jokes with the highest scores
+
+        Returns:
+            list of (joke id, current score) tuples, best first
+        """
+        with self.lock:
+            factor = math.exp(-self.decay_rate * (time.time() - self.reference_time))
+            top = sorted(self.heap, reverse=True)[:count]
+            return [(joke_id, score * factor) for score, joke_id in top]
+
+    def save_snapshot(self, bot=None, job=None):
+        """
+        Job callback. Save scores to snapshot file, the file is replaced atomically.
+        """
+        with self.lock:
+            snapshot = {
+                'saved_at': time.time(),
+                'reference_time': self.reference_time,
+                'scores': self.scores.copy(),
+            }
+
+        temporary_filename = self.snapshot_filename + '.tmp'
+        with open(temporary_filename, 'w') as fp:
+            json.dump(snapshot, fp)
+        os.replace(temporary_filename, self.snapshot_filename)
+
+    def load_snapshot(self):
+        """
+        Load scores from snapshot file
+
+        Returns:
+            float, time the snapshot was saved at, None if there is no valid snapshot
+        """
+        try:
+            with open(self.snapshot_filename, 'r') as fp:
+                snapshot = json.load(fp)
+        except (FileNotFoundError, ValueError) as e:
+            logger.info('No trending snapshot loaded: {}'.format(e))
+            return None
+
+        with self.lock:
+            self.reference_time = snapshot['reference_time']
+            self.scores = {int(joke_id): score for joke_id, score in snapshot['scores'].items()}
+            self.rebase(time.time())
+        return snapshot['saved_at']
+
+    def replay_votes(self, session, since):
+        """
+        Add positive votes cast after `since` to scores, votes are streamed from database.
+
+        Arguments:
+            session: Session
+            since: float, seconds since epoch
+        """
+        since_datetime = datetime.utcfromtimestamp(since)
+        # A positive vote is stored twice in `association` table
+        votes = session.query(association_table.c.jokes_id, func.max(association_table.c.voted_at)).\
+            filter(association_table.c.voted_at > since_datetime).\
+            group_by(association_table.c.users_id, association_table.c.jokes_id).\
+            having(func.count() > 1).\
+            execution_options(stream_results=True).\
+            yield_per(1000)
+
+        replayed = 0
+        for joke_id, voted_at in votes:
+            self.record_vote(joke_id, calendar.timegm(voted_at.utctimetuple()))
+            replayed += 1
+        logger.info('Replayed {} votes for trending jokes'.format(replayed))
+
+    def load(self, session):
+        """
+        Restore scores from snapshot and votes cast after it was saved.
+
+        Without a snapshot, only votes from the last 10 half-lives are replayed, older ones would have
+        decayed to less than 0.1% anyway.
+        """
+        saved_at = self.load_snapshot()
+        if saved_at is None:
+            saved_at = time.time() - 10 * self.half_life
+        self.replay_votes(session, saved_at)
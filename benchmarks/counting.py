@@ -0,0 +1,88 @@
+import sqlite3
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """
+    Counts statements executed by an engine and rows fetched from their results.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.queries += 1
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+
+class CountingCursor:
+    """
+    sqlite3 cursor proxy counting fetched rows
+    """
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._counter.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection:
+    """
+    sqlite3 connection proxy whose cursors count fetched rows
+    """
+
+    def __init__(self, connection, counter):
+        self.__dict__['_connection'] = connection
+        self.__dict__['_counter'] = counter
+
+    def cursor(self, *args):
+        return CountingCursor(self._connection.cursor(*args), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+
+def counting_engine_options(database_path, counter):
+    """
+    Return `create_engine` keyword arguments for a SQLite database whose fetched rows are counted
+
+    Returns:
+        dict
+    """
+    def connect():
+        return CountingConnection(sqlite3.connect(database_path, check_same_thread=False), counter)
+    return {'creator': connect}
@@ -0,0 +1,160 @@
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+
+from benchmarks.stub import fake_result
+
+REPLIES_KEPT = 100  # per chat, replies nobody waits for (e.g. notifications to authors) are dropped
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body.decode('utf-8')) if body else {}
+        else:
+            data = dict(parse_qsl(body.decode('utf-8')))
+
+        method = self.path.rsplit('/', 1)[-1]
+        status, response = self.server.api.call(method, data)
+
+        response_body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+
+class FakeBotAPI:
+    """
+    Local HTTP server answering Bot API calls like Telegram, see `benchmarks.stub.fake_result`.
+
+    Calls are counted per method and delivered to whoever waits for the chat, callback query or inline query
+    they answer (`self.wait_for_reply`). Latency and `429 Too Many Requests` errors can be injected.
+    """
+
+    def __init__(self, port, latency=0, error_rate=0, retry_after=1):
+        """
+        Arguments:
+            port: int, 0 to pick a free port
+            latency: float, seconds every call is delayed by
+            error_rate: float between 0 and 1, share of calls answered with 429
+            retry_after: int, seconds the bot is asked to wait after a 429
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.message_ids = itertools.count(1)
+        self.replies = defaultdict(lambda: deque(maxlen=REPLIES_KEPT))  # reply key -> (method, data) not taken yet
+        self.reply_events = defaultdict(threading.Event)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeBotAPIHandler)
+        self.server.api = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake_bot_api', daemon=True)
+
+    @property
+    def base_url(self):
+        """
+        Bot API url to pass to `telegram.Bot`, the token is appended by the bot
+        """
+        return 'http://127.0.0.1:{}/bot'.format(self.port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_reply_key(self, data):
+        """
+        Return key identifying the simulated user a call answers
+
+        Returns:
+            string, None if the call doesn't answer anybody
+        """
+        for parameter in ('callback_query_id', 'inline_query_id', 'chat_id'):
+            if parameter in data:
+                return '{}:{}'.format(parameter, data[parameter])
+        return None
+
+    def call(self, method, data):
+        """
+        Returns:
+            tuple: int: HTTP status
+                   dict: response
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors[method] += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+                         'parameters': {'retry_after': self.retry_after}}
+
+        key = self.get_reply_key(data)
+        with self.lock:
+            self.calls[method] += 1
+            message_id = next(self.message_ids)
+            if key is not None:
+                self.replies[key].append((method, data))
+                self.reply_events[key].set()
+
+        return 200, {'ok': True, 'result': fake_result(method, data, message_id)}
+
+    def clear_replies(self, key):
+        with self.lock:
+            self.replies.pop(key, None)
+            self.reply_events[key].clear()
+
+    def wait_for_reply(self, key, timeout, method_prefix=''):
+        """
+        Wait for the first call answering `key`, calls of other methods are skipped
+
+        Arguments:
+            key: string, see `self.get_reply_key`
+            timeout: float, seconds
+            method_prefix: string, e.g. `send` to skip edits of earlier messages
+
+        Returns:
+            tuple (method, data), None on timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                replies = self.replies.get(key)
+                while replies:
+                    method, data = replies.popleft()
+                    if method.startswith(method_prefix):
+                        return method, data
+                event = self.reply_events[key]
+                event.clear()
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not event.wait(remaining):
+                return None
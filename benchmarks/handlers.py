@@ -0,0 +1,215 @@
+"""
+Benchmark of HahOrNahBot handlers against a local SQLite database with generated data.
+
+Synthetic updates are fed directly into `dispatcher.process_update`, Bot API calls are answered by a stub.
+For every command latency percentiles, executed queries and fetched rows per update are reported, as well as
+updates which executed the same statement repeatedly (N+1 queries, see `app.query_stats`). The bot runs without rate
+limits, updates blocked by the limiter anyway are reported so that they can't pass for fast ones.
+
+Usage, from the repository root:
+    python -m benchmarks.handlers --scale 1k --scale 100k
+    python -m benchmarks.handlers --strict  # exit with an error if any command has N+1 queries
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from benchmarks.counting import QueryCounter, counting_engine_options
+from benchmarks.seed import SCALES, seed
+from benchmarks.stub import UNLIMITED_RATE_LIMITS, UpdateFactory, make_stub_bot
+
+from app.HahOrNahBot import HahOrNahBot
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+TOKEN = '123456:BENCHMARK'
+FIRST_GROUP_CHAT_ID = -1001  # group chat ids are negative, every group update comes from a new group
+SEARCH_WORDS = ['ba', 'kori', 'tume', 'salo']
+# Commands starting a conversation, the conversation is cancelled after every measured update
+CONVERSATION_COMMANDS = {'/my_jokes', '/search'}
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts errors logged by the dispatcher, exceptions raised by handlers don't reach the benchmark
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors = 0
+
+    def emit(self, record):
+        self.errors += 1
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    position = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[position]
+
+
+class HandlerBenchmark:
+    def __init__(self, database_path, user_ids, rng):
+        self.counter = QueryCounter()
+        self.bot, self.request = make_stub_bot(TOKEN)
+        self.user_ids = user_ids
+        self.rng = rng
+
+        start_time = time.perf_counter()
+        self.hah_or_nah_bot = HahOrNahBot(TOKEN, 'sqlite:///{}'.format(database_path), bot=self.bot,
+                                          engine_options=counting_engine_options(database_path, self.counter),
+                                          rate_limits=UNLIMITED_RATE_LIMITS)
+        self.hah_or_nah_bot.warm_up()
+        self.startup_seconds = time.perf_counter() - start_time
+        self.startup_timings = self.hah_or_nah_bot.startup_timings
+        self.counter.listen(self.hah_or_nah_bot.engine)
+        self.dispatcher = self.hah_or_nah_bot.dispatcher
+        self.updates = UpdateFactory(self.bot)
+        self.group_chat_ids = itertools.count(FIRST_GROUP_CHAT_ID, -1)
+
+        self.error_counter = ErrorCounter()
+        logging.getLogger('telegram.ext.dispatcher').addHandler(self.error_counter)
+
+        session = self.hah_or_nah_bot.Session()
+        self.approved_joke_ids = [joke_id for joke_id, in session.query(Joke.id).filter(Joke.approved == True).limit(10000)]
+        session.close()
+
+    def make_update(self, command, user_id):
+        """
+        Returns:
+            Update
+        """
+        return self.updates.parse(self.make_update_data(command, user_id))
+
+    def make_update_data(self, command, user_id):
+        if command == 'vote':
+            return self.updates.callback_query(user_id, 'vote:hah:{}'.format(self.rng.choice(self.approved_joke_ids)))
+        if command == 'group_vote':
+            return self.updates.callback_query(user_id, 'vote:nah:{}'.format(self.rng.choice(self.approved_joke_ids)),
+                                               chat_id=next(self.group_chat_ids), chat_type='group')
+        if command == 'group /random_joke':
+            return self.updates.message(user_id, '/random_joke', chat_id=next(self.group_chat_ids), chat_type='group')
+        if command == 'inline':
+            return self.updates.inline_query(user_id, self.rng.choice(SEARCH_WORDS))
+        if command == '/search':
+            return self.updates.message(user_id, '/search {}'.format(self.rng.choice(SEARCH_WORDS)))
+        return self.updates.message(user_id, command)
+
+    def count_blocked(self):
+        return sum(self.hah_or_nah_bot.rate_limiter.get_stats()['blocked'].values())
+
+    def run_command(self, command, iterations):
+        """
+        Returns:
+            dict with latency percentiles in milliseconds, queries and rows per update, errors and updates blocked by
+            the rate limiter
+        """
+        latencies = []
+        queries = rows = repeated = 0
+        repeated_example = None
+        query_stats = self.hah_or_nah_bot.query_stats
+        errors_before = self.error_counter.errors
+        blocked_before = self.count_blocked()
+        for _ in range(iterations):
+            # Votes of one user for one joke are rejected as duplicates, so every update comes from a random user
+            user_id = self.rng.choice(self.user_ids)
+            update = self.make_update(command, user_id)
+
+            self.counter.reset()
+            with query_stats.track(command, aggregate=False) as update_queries:
+                start_time = time.perf_counter()
+                self.dispatcher.process_update(update)
+                latencies.append(time.perf_counter() - start_time)
+            queries += self.counter.queries
+            rows += self.counter.rows
+            try:
+                update_queries.assert_no_repeated(query_stats.repeated_threshold)
+            except AssertionError as e:
+                repeated += 1
+                repeated_example = str(e)
+
+            if command in CONVERSATION_COMMANDS:
+                self.dispatcher.process_update(self.updates.parse(self.updates.message(user_id, '/cancel')))
+
+        return {
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries': queries / iterations,
+            'rows': rows / iterations,
+            'errors': self.error_counter.errors - errors_before,
+            'blocked': self.count_blocked() - blocked_before,
+            'n_plus_one': repeated,
+            'n_plus_one_example': repeated_example,
+        }
+
+
+COMMANDS = ['/help', '/stats', '/menu', '/profile', '/random_joke', '/recommended_joke', '/random_favorite_joke',
+            '/trending', '/my_jokes', '/search', 'inline', 'vote', 'group /random_joke', 'group_vote']
+
+
+def format_startup_timings(startup_timings):
+    return 'startup: {}'.format(', '.join('{} {:.2f} s'.format(step, seconds) for step, seconds in startup_timings.items()))
+
+
+def format_results(scale, startup_seconds, startup_timings, results):
+    lines = ['scale {} (startup {:.2f} s)'.format(scale, startup_seconds),
+             format_startup_timings(startup_timings),
+             '{:<22} {:>9} {:>9} {:>9} {:>11} {:>7} {:>7} {:>7}'.format('command', 'p50 ms', 'p99 ms', 'queries', 'rows',
+                                                                        'errors', 'blocked', 'N+1')]
+    for command, result in results.items():
+        lines.append('{:<22} {p50_ms:>9.2f} {p99_ms:>9.2f} {queries:>9.1f} {rows:>11.1f} {errors:>7} {blocked:>7} '
+                     '{n_plus_one:>7}'.format(command, **result))
+    for command, result in results.items():
+        if result['n_plus_one_example']:
+            lines.append('N+1 example: {}'.format(result['n_plus_one_example']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HahOrNahBot handlers')
+    parser.add_argument('--scale', action='append', choices=sorted(SCALES), help='can be repeated, default 1k')
+    parser.add_argument('--iterations', type=int, default=200, help='updates per command')
+    parser.add_argument('--data-dir', default='benchmarks/data', help='where generated databases are kept')
+    parser.add_argument('--command', action='append', choices=COMMANDS, help='can be repeated, default all')
+    parser.add_argument('--output', help='file to write results to as JSON')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strict', action='store_true', help='exit with status 1 if any command has N+1 queries')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.makedirs(arguments.data_dir, exist_ok=True)
+
+    all_results = {}
+    for scale in arguments.scale or ['1k']:
+        database_path = os.path.join(arguments.data_dir, '{}-{}.db'.format(scale, arguments.seed))
+        if os.path.exists(database_path):
+            os.remove(database_path)  # handlers write votes, every run starts from the same data
+        user_ids = seed('sqlite:///{}'.format(database_path), scale, arguments.seed)
+
+        benchmark = HandlerBenchmark(database_path, user_ids, random.Random(arguments.seed))
+        results = {}
+        for command in arguments.command or COMMANDS:
+            results[command] = benchmark.run_command(command, arguments.iterations)
+        benchmark.hah_or_nah_bot.shutdown()
+
+        print(format_results(scale, benchmark.startup_seconds, benchmark.startup_timings, results))
+        all_results[scale] = {'startup_seconds': benchmark.startup_seconds, 'startup_timings': benchmark.startup_timings,
+                              'commands': results}
+
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(all_results, fp, indent=2)
+
+    if arguments.strict and any(result['n_plus_one'] for scale_results in all_results.values()
+                                for result in scale_results['commands'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Replay of updates recorded in production (see `app.recorder`) against a copy of a database snapshot.
+
+Updates are fed into `dispatcher.process_update` of a fresh bot in recorded order, Bot API calls are answered
+by a stub. Run it on two builds with the same log and snapshot and pass the results of the first one as
+`--baseline` to compare them.
+
+Usage, from the repository root:
+    python -m benchmarks.replay update_log.jsonl.gz snapshot.db --speed 0 --output results.json
+    python -m benchmarks.replay update_log.jsonl.gz snapshot.db --speed 0 --baseline results.json
+
+`--speed 1` keeps the recorded pace, `--speed 10` replays ten times faster, `--speed 0` as fast as possible.
+The bot's rate limits are lifted, a sped-up replay would otherwise mostly measure the rate limiter. Pass
+`--production-rate-limits` to keep them, updates blocked by the limiter are then reported.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from collections import defaultdict
+
+from benchmarks.counting import QueryCounter, counting_engine_options
+from benchmarks.handlers import ErrorCounter, format_startup_timings, percentile
+from benchmarks.stub import UNLIMITED_RATE_LIMITS, UpdateFactory, make_stub_bot
+
+from app.HahOrNahBot import HahOrNahBot
+from app.models import User
+from app.recorder import read_update_log
+
+logger = logging.getLogger(__name__)
+
+TOKEN = '123456:REPLAY'
+
+
+def get_update_kind(data):
+    """
+    Return name updates are grouped by in results, e.g. `/random_joke`, `group vote` or `inline`
+    """
+    if 'callback_query' in data:
+        callback_query = data['callback_query']
+        chat = callback_query.get('message', {}).get('chat', {})
+        kind = callback_query.get('data', '').split(':', 1)[0]
+    elif 'inline_query' in data:
+        return 'inline'
+    elif 'message' in data:
+        chat = data['message'].get('chat', {})
+        text = data['message'].get('text', '')
+        kind = text.split()[0].split('@')[0] if text.startswith('/') else 'text'
+    else:
+        return 'other'
+    return kind if chat.get('type', 'private') == 'private' else 'group {}'.format(kind)
+
+
+def get_user_ids(update_log_filename):
+    user_ids = set()
+    for _, data in read_update_log(update_log_filename):
+        for key in ('message', 'callback_query', 'inline_query'):
+            user = data.get(key, {}).get('from')
+            if user is not None and not user.get('is_bot'):
+                user_ids.add(user['id'])
+    return user_ids
+
+
+def register_users(Session, user_ids):
+    """
+    Add users missing in the snapshot, recorded ids are pseudonyms so nobody in the log is registered otherwise
+    """
+    session = Session()
+    registered = {user_id for user_id, in session.query(User.id)}
+    for user_id in user_ids - registered:
+        session.add(User(id=user_id, username='replay{}'.format(user_id), score=0))
+    session.commit()
+    session.close()
+    return len(user_ids - registered)
+
+
+class Replay:
+    def __init__(self, database_path, rate_limits):
+        """
+        Arguments:
+            database_path: string, SQLite database the bot runs on
+            rate_limits: dict passed to `HahOrNahBot`, None for production limits
+        """
+        self.counter = QueryCounter()
+        self.bot, self.request = make_stub_bot(TOKEN)
+
+        start_time = time.perf_counter()
+        self.hah_or_nah_bot = HahOrNahBot(TOKEN, 'sqlite:///{}'.format(database_path), bot=self.bot,
+                                          engine_options=counting_engine_options(database_path, self.counter),
+                                          rate_limits=rate_limits)
+        self.hah_or_nah_bot.warm_up()
+        self.startup_seconds = time.perf_counter() - start_time
+        self.startup_timings = self.hah_or_nah_bot.startup_timings
+        self.counter.listen(self.hah_or_nah_bot.engine)
+        self.dispatcher = self.hah_or_nah_bot.dispatcher
+        self.updates = UpdateFactory(self.bot)
+
+        self.error_counter = ErrorCounter()
+        logging.getLogger('telegram.ext.dispatcher').addHandler(self.error_counter)
+
+    def run(self, update_log_filename, speed):
+        """
+        Arguments:
+            update_log_filename: string
+            speed: float, 1 keeps recorded pace, 0 replays as fast as possible
+
+        Returns:
+            dict with results
+        """
+        latencies = defaultdict(list)
+        lags = []  # seconds updates were processed later than scheduled, because earlier ones took too long
+        queries = defaultdict(int)
+        rows = defaultdict(int)
+        errors = defaultdict(int)
+
+        # Jobs flushing group votes and refreshing caches run as in production
+        self.hah_or_nah_bot.job_queue.start()
+        try:
+            start_time = time.perf_counter()
+            first_recorded_time = None
+            for recorded_time, data in read_update_log(update_log_filename):
+                if first_recorded_time is None:
+                    first_recorded_time = recorded_time
+                if speed:
+                    lag = time.perf_counter() - (start_time + (recorded_time - first_recorded_time) / speed)
+                    if lag < 0:
+                        time.sleep(-lag)
+                    lags.append(max(lag, 0))
+
+                kind = get_update_kind(data)
+                update = self.updates.parse(data)
+                errors_before = self.error_counter.errors
+                self.counter.reset()
+                update_start_time = time.perf_counter()
+                self.dispatcher.process_update(update)
+                latencies[kind].append(time.perf_counter() - update_start_time)
+                queries[kind] += self.counter.queries
+                rows[kind] += self.counter.rows
+                errors[kind] += self.error_counter.errors - errors_before
+            elapsed = time.perf_counter() - start_time
+        finally:
+            self.hah_or_nah_bot.job_queue.stop()
+            self.hah_or_nah_bot.shutdown()
+
+        updates = sum(len(kind_latencies) for kind_latencies in latencies.values())
+        return {
+            'startup_seconds': self.startup_seconds,
+            'startup_timings': self.startup_timings,
+            'updates': updates,
+            'updates_per_second': updates / elapsed if elapsed else 0,
+            'lag_p99_ms': percentile(lags, 99) * 1000 if lags else 0,
+            'calls': dict(self.request.calls),
+            'blocked': sum(self.hah_or_nah_bot.rate_limiter.get_stats()['blocked'].values()),
+            'kinds': {kind: {
+                'updates': len(kind_latencies),
+                'p50_ms': percentile(kind_latencies, 50) * 1000,
+                'p99_ms': percentile(kind_latencies, 99) * 1000,
+                'queries': queries[kind] / len(kind_latencies),
+                'rows': rows[kind] / len(kind_latencies),
+                'errors': errors[kind],
+            } for kind, kind_latencies in sorted(latencies.items())},
+        }
+
+
+def format_results(results, baseline=None):
+    """
+    Arguments:
+        results: dict, see `Replay.run`
+        baseline: dict, results of another build, differences in p50 and queries are shown if given
+    """
+    lines = ['{updates} updates, {updates_per_second:.1f} updates/s, startup {startup_seconds:.2f} s, '
+             'lag p99 {lag_p99_ms:.1f} ms, {blocked} blocked by rate limiter'.format(**results),
+             format_startup_timings(results['startup_timings']),
+             '{:<26} {:>8} {:>9} {:>9} {:>9} {:>11} {:>7}'.format('update', 'count', 'p50 ms', 'p99 ms', 'queries',
+                                                                   'rows', 'errors')]
+    for kind, result in results['kinds'].items():
+        line = '{:<26} {updates:>8} {p50_ms:>9.2f} {p99_ms:>9.2f} {queries:>9.1f} {rows:>11.1f} {errors:>7}'.format(
+            kind, **result)
+        base = baseline['kinds'].get(kind) if baseline else None
+        if base is not None:
+            line += '   p50 {:+.2f} ms, queries {:+.1f}'.format(result['p50_ms'] - base['p50_ms'],
+                                                                 result['queries'] - base['queries'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded updates against a database snapshot')
+    parser.add_argument('update_log', help='log written with UPDATE_LOG_FILENAME set')
+    parser.add_argument('database', help='SQLite snapshot, it is copied and never modified')
+    parser.add_argument('--speed', type=float, default=0, help='1 for recorded pace, 0 for as fast as possible')
+    parser.add_argument('--no-register', action='store_true', help="don't register users found in the log")
+    parser.add_argument('--data-dir', default='benchmarks/data')
+    parser.add_argument('--output', help='file to write results to as JSON')
+    parser.add_argument('--baseline', help='results of another build written with --output')
+    parser.add_argument('--production-rate-limits', action='store_true',
+                        help="keep the bot's rate limits, blocked updates are reported")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.makedirs(arguments.data_dir, exist_ok=True)
+    database_path = os.path.join(arguments.data_dir, 'replay.db')
+    shutil.copyfile(arguments.database, database_path)
+
+    replay = Replay(database_path, None if arguments.production_rate_limits else UNLIMITED_RATE_LIMITS)
+    if not arguments.no_register:
+        registered = register_users(replay.hah_or_nah_bot.Session, get_user_ids(arguments.update_log))
+        logger.warning('Registered {} users from the update log'.format(registered))
+    results = replay.run(arguments.update_log, arguments.speed)
+
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as fp:
+            baseline = json.load(fp)
+    print(format_results(results, baseline))
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine
+
+from app.models import Base, Joke, User, association_table, wilson_lower_bound
+
+logger = logging.getLogger(__name__)
+
+# number of jokes -> users and votes cast by every user
+SCALES = {
+    '1k': {'jokes': 1000, 'users': 100, 'votes_per_user': 20},
+    '100k': {'jokes': 100000, 'users': 5000, 'votes_per_user': 100},
+    '1m': {'jokes': 1000000, 'users': 20000, 'votes_per_user': 250},
+}
+APPROVED_RATIO = 0.95
+POSITIVE_RATIO = 0.6
+VOCABULARY_SIZE = 5000
+BATCH_SIZE = 10000
+FIRST_USER_ID = 1000  # user ids are private chat ids, below are left for other purposes
+
+# Full-text index created by migration 7f3a9c1d5e24 on SQLite
+SQLITE_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE jokes_fts USING fts5(body, content='jokes', content_rowid='id')",
+    """
+    CREATE TRIGGER jokes_fts_insert AFTER INSERT ON jokes BEGIN
+        INSERT INTO jokes_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+    """
+    CREATE TRIGGER jokes_fts_delete AFTER DELETE ON jokes BEGIN
+        INSERT INTO jokes_fts(jokes_fts, rowid, body) VALUES ('delete', old.id, old.body);
+    END""",
+    """
+    CREATE TRIGGER jokes_fts_update AFTER UPDATE OF body ON jokes BEGIN
+        INSERT INTO jokes_fts(jokes_fts, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO jokes_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+]
+
+
+def make_vocabulary(rng, size):
+    syllables = ['ba', 'ko', 'ri', 'tu', 'me', 'sa', 'lo', 'ni', 'pe', 'da', 'fu', 'gi', 'ha', 'jo', 'ke', 'wu']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def create_schema(database_url):
+    """
+    Create tables including what only migrations create (e.g. full-text index) and mark database as migrated.
+
+    The baseline migrations alter constraints, which SQLite doesn't support, so on SQLite tables are created from
+    the models and the full-text index is added by hand.
+    """
+    config = Config('alembic.ini')
+    config.set_main_option('sqlalchemy.url', database_url)
+    engine = create_engine(database_url)
+    if engine.dialect.name != 'sqlite':
+        engine.dispose()
+        command.upgrade(config, 'head')
+        return
+
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        for statement in SQLITE_SEARCH_INDEX:
+            connection.execute(statement)
+    engine.dispose()
+    command.stamp(config, 'head')
+
+
+def insert_in_batches(connection, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def seed(database_url, scale, seed=0):
+    """
+    Fill empty database with generated users, jokes and votes
+
+    Arguments:
+        database_url: string
+        scale: string, key of `SCALES`
+        seed: int, seed of the random generator, the same seed generates the same data
+    """
+    sizes = SCALES[scale]
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, VOCABULARY_SIZE)
+    start_time = time.time()
+
+    create_schema(database_url)
+    engine = create_engine(database_url)
+
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + sizes['users']))
+    authors = [rng.choice(user_ids) for _ in range(sizes['jokes'])]
+    approved = [rng.random() < APPROVED_RATIO for _ in range(sizes['jokes'])]
+    approved_joke_ids = [joke_id for joke_id in range(sizes['jokes']) if approved[joke_id]]
+
+    # A positive vote is stored twice in `association` table, a negative one once
+    positive_votes = [0] * sizes['jokes']
+    negative_votes = [0] * sizes['jokes']
+    user_scores = dict.fromkeys(user_ids, 0)
+    vote_rows = []
+    now = datetime.utcnow()
+    for user_id in user_ids:
+        for joke_id in rng.sample(approved_joke_ids, min(sizes['votes_per_user'], len(approved_joke_ids))):
+            if authors[joke_id] == user_id:
+                continue
+            voted_at = now - timedelta(seconds=rng.randint(0, 7 * 24 * 60 * 60))
+            vote_row = {'users_id': user_id, 'jokes_id': joke_id, 'voted_at': voted_at}
+            if rng.random() < POSITIVE_RATIO:
+                positive_votes[joke_id] += 1
+                user_scores[user_id] += 1
+                vote_rows.extend([vote_row, vote_row])
+            else:
+                negative_votes[joke_id] += 1
+                user_scores[user_id] -= 1
+                vote_rows.append(vote_row)
+
+    user_rows = [{'id': user_id, 'username': 'user{}'.format(user_id), 'score': score}
+                 for user_id, score in user_scores.items()]
+
+    joke_rows = []
+    for joke_id in range(sizes['jokes']):
+        positive, negative = positive_votes[joke_id], negative_votes[joke_id]
+        total = positive + negative
+        joke_rows.append({
+            'id': joke_id,
+            'body': ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(8, 30))),
+            'vote_count': positive - negative,
+            'positive_votes': positive,
+            'negative_votes': negative,
+            'hah_ratio': positive / total if total else 0,
+            'wilson_score': wilson_lower_bound(positive, negative),
+            'approved': approved[joke_id],
+            'approved_at': now - timedelta(seconds=rng.randint(0, 30 * 24 * 60 * 60)) if approved[joke_id] else None,
+            'prefilter_decision': 'passed',
+            'user_id': authors[joke_id],
+        })
+
+    with engine.begin() as connection:
+        insert_in_batches(connection, User.__table__, user_rows)
+        insert_in_batches(connection, Joke.__table__, joke_rows)
+        insert_in_batches(connection, association_table, vote_rows)
+    engine.dispose()
+
+    logger.info('Seeded {users} users, {jokes} jokes and {votes} vote rows in {seconds:.0f} s'.format(
+        users=len(user_rows), jokes=len(joke_rows), votes=len(vote_rows), seconds=time.time() - start_time))
+    return user_ids
@@ -0,0 +1,134 @@
+import itertools
+import time
+from collections import Counter
+
+from telegram import Bot, Update
+from telegram.utils.request import Request
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'HahOrNahBot', 'username': 'HahOrNahBot'}
+# Rate limits passed to the bot in benchmarks, otherwise fast synthetic traffic would mostly measure the limiter
+UNLIMITED = (10 ** 9, 10 ** 9)  # burst size, tokens added per second
+UNLIMITED_RATE_LIMITS = {'cheap': UNLIMITED, 'expensive': UNLIMITED, 'write': UNLIMITED}
+
+
+def fake_result(method, data, message_id):
+    """
+    Return result Telegram would send for Bot API call
+
+    Methods returning a message get a message echoing the request, all other methods get True.
+
+    Arguments:
+        method: string, e.g. `sendMessage`
+        data: dict, parameters of the call
+        message_id: int, id of a new message
+    """
+    if method == 'getMe':
+        return BOT_USER
+    if method.startswith('send') or method == 'editMessageText':
+        chat_id = int(data.get('chat_id', 0))
+        return {
+            'message_id': data.get('message_id', message_id),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': BOT_USER,
+            'text': data.get('text', ''),
+        }
+    return True
+
+
+class StubRequest(Request):
+    """
+    Request that answers Bot API calls locally instead of sending them to Telegram, see `fake_result`.
+
+    Calls are counted per method.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        return fake_result(method, data, next(self.message_ids))
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout)
+
+
+def make_stub_bot(token):
+    """
+    Returns:
+        tuple: Bot, StubRequest used by the bot
+    """
+    request = StubRequest()
+    return Bot(token, request=request), request
+
+
+class UpdateFactory:
+    """
+    Class that builds synthetic updates as Telegram would send them to the webhook, as JSON-like dicts.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'user{}'.format(user_id)}
+
+    def message_data(self, user_id, text, chat_id=None, chat_type='private'):
+        data = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id if chat_id is None else chat_id, 'type': chat_type},
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return data
+
+    def parse(self, data):
+        """
+        Returns:
+            Update
+        """
+        return Update.de_json(data, self.bot)
+
+    def message(self, user_id, text, chat_id=None, chat_type='private'):
+        """
+        Returns:
+            dict, update with text message, commands get a `bot_command` entity
+        """
+        return {'update_id': next(self.update_ids), 'message': self.message_data(user_id, text, chat_id, chat_type)}
+
+    def callback_query(self, user_id, callback_data, chat_id=None, chat_type='private'):
+        """
+        Returns:
+            dict, update with a pressed inline button on a message sent by the bot
+        """
+        message = self.message_data(user_id, 'joke', chat_id, chat_type)
+        message['from'] = BOT_USER
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.user(user_id),
+                'chat_instance': '1',
+                'data': callback_data,
+                'message': message,
+            },
+        }
+
+    def inline_query(self, user_id, query, offset=''):
+        """
+        Returns:
+            dict, update with inline query
+        """
+        return {
+            'update_id': next(self.update_ids),
+            'inline_query': {'id': str(next(self.update_ids)), 'from': self.user(user_id), 'query': query, 'offset': offset},
+        }
@@ -0,0 +1,292 @@
+"""
+End-to-end load test of HahOrNahBot in webhook mode against a local fake Bot API server.
+
+Simulated users post updates to the bot's webhook and wait for the bot's reply to reach the fake Bot API,
+so the latency includes the webhook server, JSON decoding, handlers, the database and the outbound HTTP client.
+The bot is started with `HahOrNahBot.start_webhook` as in production: updates are refused with 503 until it is
+warmed up, the webhook is registered with the fake Bot API and metrics are served next to the webhook.
+
+The bot's rate limits are lifted, otherwise a script this fast would measure the rate limiter. Pass
+`--production-rate-limits` to keep them, rate-limited replies are then counted separately from timeouts.
+
+Usage, from the repository root:
+    python -m benchmarks.webhook --scale 1k --users 20 --duration 60 --api-latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from telegram import Bot
+
+from benchmarks.fake_api import FakeBotAPI
+from benchmarks.handlers import percentile
+from benchmarks.seed import SCALES, seed
+from benchmarks.stub import UNLIMITED_RATE_LIMITS, UpdateFactory
+
+from app.HahOrNahBot import HahOrNahBot
+
+logger = logging.getLogger(__name__)
+
+TOKEN = '123456:LOADTEST'
+METRICS_TOKEN = 'loadtest'
+PROBE_USER_ID = 10 ** 9  # not registered, sends /help until the bot accepts updates
+PROBE_INTERVAL = 0.05  # seconds
+# Steps of a simulated user, repeated until the test ends. `vote` presses a button of the last joke shown.
+SCRIPT = ['/random_joke', 'vote', '/trending', '/recommended_joke', 'vote', '/random_favorite_joke',
+          '/search kori', '/cancel', 'inline tu', '/profile', '/random_joke', 'vote', '/my_jokes', '/cancel']
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class SimulatedUser(threading.Thread):
+    """
+    Runs `SCRIPT` in a loop, every step waits for the bot's reply before the next one is sent.
+    """
+
+    def __init__(self, user_id, load_test, rng):
+        super().__init__(name='user{}'.format(user_id), daemon=True)
+        self.user_id = user_id
+        self.load_test = load_test
+        self.rng = rng
+        self.vote_data = None  # callback data of a button of the last joke shown
+        self.latencies = []
+        self.timeouts = 0
+        self.rate_limited = 0  # replies telling the user to slow down, later updates are dropped without reply
+        self.sent = 0
+
+    def make_step(self, step):
+        """
+        Returns:
+            tuple: dict: update, None if the step can't be done now
+                   string: key of the reply to wait for
+                   string: prefix of the method of the reply
+        """
+        updates = self.load_test.updates
+        if step == 'vote':
+            if self.vote_data is None:
+                return None, None, None
+            update = updates.callback_query(self.user_id, self.vote_data)
+            self.vote_data = None
+            return update, 'callback_query_id:{}'.format(update['callback_query']['id']), 'answerCallbackQuery'
+        if step.startswith('inline '):
+            update = updates.inline_query(self.user_id, step.split(' ', 1)[1])
+            return update, 'inline_query_id:{}'.format(update['inline_query']['id']), 'answerInlineQuery'
+        return updates.message(self.user_id, step), 'chat_id:{}'.format(self.user_id), 'send'
+
+    def remember_vote_buttons(self, data):
+        try:
+            keyboard = json.loads(data['reply_markup'])['inline_keyboard']
+            callback_data = keyboard[0][self.rng.randint(0, 1)]['callback_data']
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        if callback_data.startswith('vote:'):
+            self.vote_data = callback_data
+
+    def run(self):
+        api = self.load_test.api
+        while time.time() < self.load_test.end_time:
+            for step in SCRIPT:
+                if time.time() >= self.load_test.end_time:
+                    return
+                update, key, method_prefix = self.make_step(step)
+                if update is None:
+                    continue
+
+                api.clear_replies(key)
+                start_time = time.perf_counter()
+                self.load_test.post_update(update)
+                self.sent += 1
+                reply = api.wait_for_reply(key, self.load_test.timeout, method_prefix)
+                if reply is None:
+                    self.timeouts += 1
+                    continue
+
+                method, data = reply
+                if data.get('text') == self.load_test.rate_limited_text:
+                    self.rate_limited += 1
+                    continue
+                self.latencies.append(time.perf_counter() - start_time)
+                self.remember_vote_buttons(data)
+
+
+class WebhookLoadTest:
+    def __init__(self, database_path, api, timeout, rate_limits):
+        self.api = api
+        self.timeout = timeout
+        self.webhook_port = get_free_port()
+        self.base_url = 'http://127.0.0.1:{}/'.format(self.webhook_port)
+        self.webhook_url = self.base_url + TOKEN
+        self.end_time = 0
+
+        bot = Bot(TOKEN, base_url=api.base_url)
+        self.hah_or_nah_bot = HahOrNahBot(TOKEN, 'sqlite:///{}'.format(database_path), bot=bot,
+                                          rate_limits=rate_limits, metrics_token=METRICS_TOKEN)
+        self.rate_limited_text = self.hah_or_nah_bot.get_one_response('rate_limited')
+        self.updates = UpdateFactory(bot)
+
+    def post_update(self, update):
+        request = Request(self.webhook_url, data=json.dumps(update).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def wait_until_accepted(self):
+        """
+        Post updates until the bot accepts one and replies to it
+
+        Returns:
+            tuple: float: seconds from the first attempt
+                   int: updates refused with 503 while the bot was warming up
+        """
+        start_time = time.time()
+        refused = 0
+        key = 'chat_id:{}'.format(PROBE_USER_ID)
+        while True:
+            try:
+                self.post_update(self.updates.message(PROBE_USER_ID, '/help'))
+            except HTTPError as e:
+                if e.code != 503:
+                    raise
+                refused += 1
+            except URLError:
+                pass  # webhook port isn't bound yet
+            else:
+                if self.api.wait_for_reply(key, self.timeout, 'send') is None:
+                    raise RuntimeError('Bot accepted an update but did not reply')
+                return time.time() - start_time, refused
+            time.sleep(PROBE_INTERVAL)
+
+    def get_metrics(self):
+        """
+        Returns:
+            bytes, metrics served by the bot in Prometheus text format
+        """
+        with urlopen('{}metrics/{}'.format(self.base_url, METRICS_TOKEN), timeout=self.timeout) as response:
+            return response.read()
+
+    def drive(self, user_ids, duration, rng, results):
+        """
+        Run simulated users once the bot accepts updates, then stop the bot. Results are written to `results`.
+        """
+        try:
+            results['accepted_seconds'], results['refused'] = self.wait_until_accepted()
+            users = [SimulatedUser(user_id, self, random.Random(rng.random())) for user_id in user_ids]
+
+            start_time = time.time()
+            self.end_time = start_time + duration
+            for user in users:
+                user.start()
+            for user in users:
+                user.join()
+            results['elapsed'] = time.time() - start_time
+            results['users'] = users
+            results['metrics_bytes'] = len(self.get_metrics())
+        finally:
+            # What a signal does to the updater, `start_webhook` returns and shuts the bot down
+            self.hah_or_nah_bot.updater.stop()
+            self.hah_or_nah_bot.updater.is_idle = False
+
+    def run(self, user_ids, duration, rng):
+        """
+        Returns:
+            dict with results
+        """
+        results = {}
+        driver = threading.Thread(target=self.drive, args=(user_ids, duration, rng, results), name='load_test',
+                                  daemon=True)
+        driver.start()
+        # Blocks until the driver stops the updater, `Updater.idle` handles signals only in the main thread
+        self.hah_or_nah_bot.start_webhook(self.base_url, self.webhook_port)
+        driver.join()
+        if 'users' not in results:
+            raise RuntimeError('Load test failed, see the log')
+
+        users = results['users']
+        latencies = [latency for user in users for latency in user.latencies]
+        sent = sum(user.sent for user in users)
+        return {
+            'accepted_seconds': results['accepted_seconds'],
+            'refused': results['refused'],
+            'metrics_bytes': results['metrics_bytes'],
+            'updates': sent,
+            'updates_per_second': sent / results['elapsed'],
+            'timeouts': sum(user.timeouts for user in users),
+            'rate_limited': sum(user.rate_limited for user in users),
+            'blocked': sum(self.hah_or_nah_bot.rate_limiter.get_stats()['blocked'].values()),
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else 0,
+            'p90_ms': percentile(latencies, 90) * 1000 if latencies else 0,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else 0,
+            'max_ms': max(latencies) * 1000 if latencies else 0,
+            'calls': dict(self.api.calls),
+            'injected_429': dict(self.api.errors),
+        }
+
+
+def format_results(scale, results):
+    lines = [
+        'scale {scale}: {updates} updates, {updates_per_second:.1f} updates/s, {timeouts} timeouts'.format(
+            scale=scale, **results),
+        'startup: updates accepted after {accepted_seconds:.2f} s, {refused} refused with 503 before, '
+        'metrics {metrics_bytes} bytes'.format(**results),
+        'rate limiter: {rate_limited} rate-limited replies, {blocked} updates blocked'.format(**results),
+        'latency p50 {p50_ms:.1f} ms, p90 {p90_ms:.1f} ms, p99 {p99_ms:.1f} ms, max {max_ms:.1f} ms'.format(**results),
+        'outbound calls: {}'.format(', '.join('{} {}'.format(method, count)
+                                               for method, count in sorted(results['calls'].items()))),
+    ]
+    if results['injected_429']:
+        lines.append('injected 429: {}'.format(', '.join('{} {}'.format(method, count)
+                                                          for method, count in sorted(results['injected_429'].items()))))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test HahOrNahBot in webhook mode')
+    parser.add_argument('--scale', default='1k', choices=sorted(SCALES))
+    parser.add_argument('--users', type=int, default=20, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds every Bot API call takes')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of Bot API calls answered with 429')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds a user waits for a reply')
+    parser.add_argument('--production-rate-limits', action='store_true',
+                        help="keep the bot's rate limits, blocked updates time out")
+    parser.add_argument('--data-dir', default='benchmarks/data')
+    parser.add_argument('--output', help='file to write results to as JSON')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.makedirs(arguments.data_dir, exist_ok=True)
+    database_path = os.path.join(arguments.data_dir, 'webhook-{}-{}.db'.format(arguments.scale, arguments.seed))
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    user_ids = seed('sqlite:///{}'.format(database_path), arguments.scale, arguments.seed)
+
+    api = FakeBotAPI(0, latency=arguments.api_latency, error_rate=arguments.error_rate)
+    api.start()
+    try:
+        rng = random.Random(arguments.seed)
+        rate_limits = None if arguments.production_rate_limits else UNLIMITED_RATE_LIMITS
+        load_test = WebhookLoadTest(database_path, api, arguments.timeout, rate_limits)
+        results = load_test.run(rng.sample(user_ids, min(arguments.users, len(user_ids))), arguments.duration, rng)
+    finally:
+        api.stop()
+
+    print(format_results(arguments.scale, results))
+    if arguments.output:
+        with open(arguments.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import os
 import logging
-
-from app.HahOrNahBot import HahOrNahBot
+import time
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO,
@@ -22,6 +21,19 @@ if __name__ == '__main__':
 
     port = int(os.environ.get('PORT', 8443))
 
-    bot = HahOrNahBot(token, database_url)
+    # Optional, e.g. update_log.jsonl.gz, replay it with `python -m benchmarks.replay`
+    update_log_filename = os.environ.get('UPDATE_LOG_FILENAME')
+    # Secret key of pseudonyms in the update log, keeps them stable across restarts
+    update_log_key = os.environ.get('UPDATE_LOG_KEY')
+    # Optional, Prometheus metrics are served on /metrics/<METRICS_TOKEN> of the webhook port if set
+    metrics_token = os.environ.get('METRICS_TOKEN')
+
+    # Imported once configuration is known to be complete, the telegram and SQLAlchemy stacks take a while
+    import_start_time = time.perf_counter()
+    from app.HahOrNahBot import HahOrNahBot
+    logging.getLogger(__name__).info('Imported bot in {:.2f} s'.format(time.perf_counter() - import_start_time))
+
+    bot = HahOrNahBot(token, database_url, update_log_filename=update_log_filename, update_log_key=update_log_key,
+                      metrics_token=metrics_token)
     bot.start_webhook("https://hah-or-nah-bot.herokuapp.com/", port)
     #bot.start_local()